@@ -16,15 +16,93 @@ MODULE_NAME = "ogpsd.gpsdevice"
 DBUS_INTERFACE_PREFIX = "org.freedesktop.Gypsy"
 DBUS_PATH_PREFIX = "/org/freedesktop/Gypsy"
 
+DBUS_INTERFACE_GPS = "org.freesmartphone.GPS"
+DBUS_PATH_SUBSCRIPTIONS = "/org/freesmartphone/GPS/Subscriptions"
+
 from framework import resource
+from framework.config import config
 import framework.patterns.tasklet as tasklet
 
+from helpers import distance
+from track import TrackRecorder
+
 import dbus
 import dbus.service
+import gobject
+import time
 
 import logging
 logger = logging.getLogger( MODULE_NAME )
 
+# milliseconds to collect the changes of one navigation epoch before signalling them
+SIGNAL_COALESCE_WINDOW = config.getInt( "ogpsd", "signal_coalesce_window", 100 )
+# send the Gypsy *Changed signals in addition to the combined Update signal
+LEGACY_SIGNALS = config.getBool( "ogpsd", "legacy_signals", True )
+
+class GPSSubscription( dbus.service.Object ):
+    """
+    A client's subscription to the combined updates of a GPSDevice.
+
+    Updates are sent at most every interval seconds. With a distance,
+    they are only sent when the position moved at least distance meters
+    or the fix status changed. Changes held back by the interval are sent
+    once it has passed, those held back by the distance with the next
+    update sent.
+    """
+    def __init__( self, bus, path, owner, interval, distance ):
+        self.path = path
+        self.owner = owner
+        self.interval = interval
+        self.distance = distance
+        self.pending = {}
+        self.sent = 0
+        self.position = None
+        self.removed = None
+        self.timeout = None
+        dbus.service.Object.__init__( self, bus, path )
+
+    def update( self, update ):
+        self.pending.update( update )
+        if self.timeout is None:
+            self._send()
+
+    def _send( self ):
+        self.timeout = None
+        wait = self.sent + self.interval - time.time()
+        if wait > 0:
+            self.timeout = gobject.timeout_add( int( wait * 1000 ) + 1, self._send )
+            return False
+        if self.distance and "fixstatus" not in self.pending and not self._moved():
+            return False
+        if "position" in self.pending:
+            self.position = self.pending["position"][2:4]
+        self.sent = time.time()
+        self.Update( self.pending )
+        self.pending = {}
+        return False
+
+    def _moved( self ):
+        if "position" not in self.pending:
+            return False
+        if self.position is None:
+            return True
+        ( lat, lon ) = self.pending["position"][2:4]
+        return distance( self.position[0], self.position[1], lat, lon ) >= self.distance
+
+    def remove( self ):
+        if self.timeout is not None:
+            gobject.source_remove( self.timeout )
+            self.timeout = None
+        self.remove_from_connection()
+
+    @dbus.service.method( DBUS_INTERFACE_GPS + ".Subscription", "", "" )
+    def Remove( self ):
+        self.removed( self )
+
+    @dbus.service.signal( DBUS_INTERFACE_GPS + ".Subscription", "a{sv}" )
+    def Update( self, update ):
+        pass
+
 class GPSDevice( resource.Resource ):
     """An Dbus Object implementing org.freedesktop.Gypsy"""
 
@@ -36,6 +114,11 @@ class GPSDevice( resource.Resource ):
         self._satellites = []
         self._time = 0
         self._users = []
+        self._pending = set()
+        self._flushTimeout = None
+        self._subscriptions = {}
+        self._nextSubscription = 0
+        self._recorder = TrackRecorder()
 
         self.channel = channel
         self.interface = DBUS_INTERFACE_PREFIX
@@ -58,6 +141,9 @@ class GPSDevice( resource.Resource ):
         if old_owner and not new_owner:
             if old_owner in self._users:
                 self.Stop( old_owner, lambda :None, lambda x:None)
+            for subscription in self._subscriptions.values():
+                if subscription.owner == old_owner:
+                    self._removeSubscription( subscription )
 
 
     #
@@ -118,22 +204,28 @@ class GPSDevice( resource.Resource ):
     def _reset( self ):
         if self._fixstatus:
             self._fixstatus = 0
-            self.FixStatusChanged( self._fixstatus )
+            self._pending.add( "fixstatus" )
         if self._position[0]:
             self._position[0] = 0
-            self.PositionChanged( *self._position )
+            self._pending.add( "position" )
         if self._accuracy[0]:
             self._accuracy[0] = 0
-            self.AccuracyChanged( *self._accuracy )
+            self._pending.add( "accuracy" )
         if self._course[0]:
             self._course[0] = 0
-            self.CourseChanged( *self._course )
+            self._pending.add( "course" )
         if self._satellites != []:
             self._satellites = []
-            self.SatellitesChanged( self._satellites )
+            self._pending.add( "satellites" )
         if self._time:
             self._time = 0
-            self.TimeChanged( self._time )
+            self._pending.add( "time" )
+        # don't wait for the end of the epoch, there won't be any
+        if self._flushTimeout is not None:
+            gobject.source_remove( self._flushTimeout )
+        if self._pending:
+            self._flush()
+        self._recorder.flush()
 
     #
     # update functions
@@ -141,7 +233,7 @@ class GPSDevice( resource.Resource ):
     def _updateFixStatus( self, fixstatus ):
         if self._fixstatus != fixstatus:
             self._fixstatus = fixstatus
-            self.FixStatusChanged( self._fixstatus )
+            self._changed( "fixstatus" )
 
     def _updatePosition( self, fields, lat, lon, alt ):
         changed = False
@@ -160,7 +252,7 @@ class GPSDevice( resource.Resource ):
             self._position[4] = alt
             changed = True
         if changed:
-            self.PositionChanged( *self._position )
+            self._changed( "position" )
 
     def _updateAccuracy( self, fields, pdop, hdop, vdop ):
         changed = False
@@ -177,7 +269,7 @@ class GPSDevice( resource.Resource ):
             self._accuracy[3] = vdop
             changed = True
         if changed:
-            self.AccuracyChanged( *self._accuracy )
+            self._changed( "accuracy" )
 
     def _updateCourse( self, fields, speed, heading, climb ):
         changed = False
@@ -196,19 +288,77 @@ class GPSDevice( resource.Resource ):
             self._course[4] = climb
             changed = True
         if changed:
-            self.CourseChanged( *self._course )
+            self._changed( "course" )
 
     def _updateSatellites( self, satellites ):
         # Is this check sufficient or could some SVs switch channels, but
         # otherwise stay identical?
         if self._satellites != satellites:
             self._satellites = satellites
-            self.SatellitesChanged( self._satellites )
+            self._changed( "satellites" )
 
     def _updateTime( self, time ):
         if self._time != time:
             self._time = time
-            self.TimeChanged( self._time )
+            self._changed( "time" )
+
+    #
+    # signalling
+    #
+    def _changed( self, name ):
+        self._pending.add( name )
+        if self._flushTimeout is None:
+            if SIGNAL_COALESCE_WINDOW:
+                self._flushTimeout = gobject.timeout_add( SIGNAL_COALESCE_WINDOW, self._flush )
+            else:
+                self._flushTimeout = gobject.idle_add( self._flush )
+
+    def _flush( self ):
+        """
+        Send the changes collected in one navigation epoch.
+        """
+        self._flushTimeout = None
+        pending = self._pending
+        self._pending = set()
+
+        update = {}
+        if "fixstatus" in pending:
+            update["fixstatus"] = dbus.Int32( self._fixstatus )
+            if LEGACY_SIGNALS:
+                self.FixStatusChanged( self._fixstatus )
+        if "time" in pending:
+            update["time"] = dbus.Int32( self._time )
+            if LEGACY_SIGNALS:
+                self.TimeChanged( self._time )
+        if "position" in pending:
+            update["position"] = dbus.Struct( self._position, signature="iiddd" )
+            if LEGACY_SIGNALS:
+                self.PositionChanged( *self._position )
+        if "accuracy" in pending:
+            update["accuracy"] = dbus.Struct( self._accuracy, signature="iddd" )
+            if LEGACY_SIGNALS:
+                self.AccuracyChanged( *self._accuracy )
+        if "course" in pending:
+            update["course"] = dbus.Struct( self._course, signature="iiddd" )
+            if LEGACY_SIGNALS:
+                self.CourseChanged( *self._course )
+        if "satellites" in pending:
+            update["satellites"] = dbus.Array( self._satellites, signature="(ubuuu)" )
+            if LEGACY_SIGNALS:
+                self.SatellitesChanged( self._satellites )
+
+        self.Update( update )
+        for subscription in self._subscriptions.values():
+            subscription.update( update )
+
+        if "position" in pending and self._position[0] & 3 and self._position[1]:
+            self._recorder.add( self._position[1], self._position[0], self._position[2], self._position[3],
+                                self._position[4], self._course[2], self._course[3], self._accuracy[2] )
+        return False
+
+    def _removeSubscription( self, subscription ):
+        del self._subscriptions[subscription.path]
+        subscription.remove()
 
     # Gypsy Server interface
     # This should be implemented somewhere else once we allow different devices
@@ -289,6 +439,31 @@ class GPSDevice( resource.Resource ):
     def GetTime( self ):
         return self._time
 
+    @dbus.service.method( DBUS_INTERFACE_GPS, "dd", "o", sender_keyword="sender" )
+    def AddSubscription( self, interval, distance, sender ):
+        path = "%s/%i" % ( DBUS_PATH_SUBSCRIPTIONS, self._nextSubscription )
+        self._nextSubscription += 1
+        subscription = GPSSubscription( self.bus, path, sender, interval, distance )
+        subscription.removed = self._removeSubscription
+        self._subscriptions[path] = subscription
+        return path
+
+    @dbus.service.method( DBUS_INTERFACE_GPS + ".Track", "dd", "" )
+    def StartRecording( self, interval, distance ):
+        self._recorder.start( interval, distance )
+
+    @dbus.service.method( DBUS_INTERFACE_GPS + ".Track", "", "" )
+    def StopRecording( self ):
+        self._recorder.stop()
+
+    @dbus.service.method( DBUS_INTERFACE_GPS + ".Track", "", "b" )
+    def GetRecording( self ):
+        return self._recorder.isRecording()
+
+    @dbus.service.method( DBUS_INTERFACE_GPS + ".Track", "uuu", "a(uddddd)" )
+    def GetTrack( self, start, end, maxpoints ):
+        return self._recorder.query( start, end, maxpoints )
+
 
     #
     # dbus signals
@@ -328,6 +503,11 @@ class GPSDevice( resource.Resource ):
     def TimeChanged( self, time ):
         logger.debug( "TimeChanged %i" % time )
 
+    @dbus.service.signal( DBUS_INTERFACE_GPS, "a{sv}" )
+    @resource.queuedsignal
+    def Update( self, update ):
+        logger.debug( "Update %s" % update )
+
 
 class DummyDevice( GPSDevice ):
     """A dummy device that reports a static position"""
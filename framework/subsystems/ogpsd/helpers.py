@@ -1,6 +1,10 @@
+import math
+
 import logging
 logger = logging.getLogger('ogpsd')
 
+EARTH_RADIUS = 6371000.0
+
 #============================================================================#
 def readFromFile( path ):
 #============================================================================#
@@ -23,3 +27,14 @@ def writeToFile( path, value ):
         logger.warning( "(could not write to '%s': %s)" % ( path, e ) )
     else:
         f.write( "%s\n" % value )
+
+#============================================================================#
+def distance( lat1, lon1, lat2, lon2 ):
+#============================================================================#
+    """
+    Returns the approximate distance in meters between two positions,
+    which is good enough for the short distances between fixes.
+    """
+    x = math.radians( lon2 - lon1 ) * math.cos( math.radians( ( lat1 + lat2 ) / 2 ) )
+    y = math.radians( lat2 - lat1 )
+    return EARTH_RADIUS * math.hypot( x, y )
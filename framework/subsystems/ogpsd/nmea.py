@@ -17,19 +17,96 @@ __version__ = "0.0.0"
 
 import math
 import string
+import struct
+import operator
 import time
 from gpsdevice import GPSDevice
+from framework.config import config
 
 import logging
 logger = logging.getLogger('ogpsd')
 
+NMEA_CHECKSUM = config.getBool( "ogpsd", "nmea_checksum", True )
+
+# Talkers whose sentences are handled like the GPS (GP) ones:
+# GN = combined GNSS, GL = GLONASS
+TALKERS = [ "GN", "GL" ]
+# Only the position sentences are shared. GSV and GSA describe the
+# satellites of one talker and would overwrite the GPS satellite table,
+# so they are ignored for the other talkers.
+TALKER_SENTENCES = [ "RMC", "GGA" ]
+TALKER_IGNORED = [ "GSV", "GSA" ]
+
+def checksum( sentence ):
+    """
+    Returns the XOR of all characters of sentence.
+
+    The sentence is XORed in 8 byte words, which are folded at the end.
+    """
+    padding = -len( sentence ) % 8
+    words = struct.unpack( "<%dQ" % ( ( len( sentence ) + padding ) / 8 ), sentence + "\0" * padding )
+    csum = reduce( operator.xor, words, 0 )
+    csum ^= csum >> 32
+    csum ^= csum >> 16
+    csum ^= csum >> 8
+    return csum & 0xff
+
+class NMEAParser( object ):
+    """
+    Splits a stream of data into NMEA sentences.
+
+    The sentences found are passed to callback( sentence ) without the
+    leading $ and the checksum. With NMEA_CHECKSUM, sentences with a wrong
+    checksum are dropped.
+    """
+    def __init__( self, callback ):
+        self.callback = callback
+        self.reset()
+
+    def reset( self ):
+        self.buffer = ""
+
+    def feed( self, data ):
+        lines = ( self.buffer + data ).split( "\r\n" )
+        # the last line is not complete yet
+        self.buffer = lines.pop()
+        for line in lines:
+            result = self.handle_line( line.strip() )
+            if result:
+                logger.debug( result )
+
+    def handle_line( self, line ):
+        if not line.startswith( '$' ):
+            return "Not NMEA"
+        end = line.rfind( '*' )
+        if end == -1:
+            return
+        if NMEA_CHECKSUM:
+            try:
+                if checksum( line[1:end] ) != int( line[end+1:], 16 ):
+                    return "Bad checksum"
+            except ValueError:
+                return "Bad checksum"
+        self.callback( line[1:end] )
+
 class NMEADevice( GPSDevice ):
     def __init__( self, bus, channel ):
         super( NMEADevice, self ).__init__( bus, channel )
 
-        self.buffer = ""
+        self.parser = NMEAParser( self.handle_sentence )
         self.channel.setCallback( self.parse )
 
+        # sentence -> method
+        self.handlers = {}
+        for methodname in dir( self ):
+            if methodname.startswith( "process" ):
+                self.handlers[methodname[7:]] = getattr( self, methodname )
+        for talker in TALKERS:
+            for sentence in TALKER_SENTENCES:
+                self.handlers.setdefault( talker + sentence, self.handlers["GP" + sentence] )
+            for sentence in TALKER_IGNORED:
+                self.handlers.setdefault( talker + sentence, self.ignoreSentence )
+
         self.prn = range(12)
         self.elevation = range(12)
         self.azimuth = range(12)
@@ -47,24 +124,7 @@ class NMEADevice( GPSDevice ):
         self.in_view = 0
 
     def parse( self, data ):
-        self.buffer += data
-
-        while True:
-            try:
-                line, self.buffer = self.buffer.split( "\r\n", 1 )
-            except:
-                break
-            else:
-                result = self.handle_line( line.strip() )
-                if result:
-                    logger.debug( result )
-
-
-    def checksum(self,sentence, cksum):
-        csum = 0
-        for c in sentence:
-            csum = csum ^ ord(c)
-        return "%02X" % csum == cksum
+        self.parser.feed( data )
 
 #$GPGGA,000032.997,0000.0000,N,00000.0000,E,0,00,50.0,0.0,M,,.j...«.æ.ÆV.æ.ÆV.æ.|.VÖL²4jj.h..00032.997,V,0000.0000,N,00000.0006
 #Lat: 0.000000 Lon: 0.000000 Alt: 0.000000 Sat: 0 Mod: 1 Time: 11/26/2000 00:00:31
@@ -243,26 +303,20 @@ class NMEADevice( GPSDevice ):
         # FIXME: Do we do anything with this sentence?
         pass
 
-    def handle_line(self, line):
-        if line[0] == '$':
-            line = string.split(line[1:-1], '*')
-            if len(line) != 2: return
-#            if not self.checksum(line[0], line[1]):
-#                return "Bad checksum"
-            words = string.split(line[0], ',')
-            methodname = "process"+words[0]
-            try:
-                method = getattr( self, methodname )
-            except AttributeError:
-                logger.error( "Line: %s" % line)
-                return "Unknown sentence"
-            else:
-                try:
-                    method( words[1:] )
-                except Exception, e:
-                    logger.error( "Line: %s" % line)
-                    logger.error( "Error in %s method: %s" % ( methodname, e ) )
+    def ignoreSentence(self,words):
+        pass
+
+    def handle_sentence( self, sentence ):
+        words = sentence.split( ',' )
+        try:
+            method = self.handlers[words[0]]
+        except KeyError:
+            logger.error( "Unknown sentence: %s" % sentence )
         else:
-            return "Not NMEA"
+            try:
+                method( words[1:] )
+            except Exception, e:
+                logger.error( "Line: %s" % sentence )
+                logger.error( "Error in %s method: %s" % ( method.__name__, e ) )
 
 #vim: expandtab
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Open GPS Daemon - Track recorder
+
+GPLv2 or later
+
+A track file starts with a header and continues with fixed size records.
+After every INDEX_INTERVAL position records, an index record with the
+first and last time of these records is appended, so a time range can be
+found by reading the index records only. Files are rotated when they
+reach track_file_size bytes, only the last track_files files are kept.
+Files are named after their creation time plus a sequence number, so
+sorting the names sorts them by age.
+"""
+
+__version__ = "0.1.0"
+MODULE_NAME = "ogpsd.track"
+
+from framework.config import config, rootdir
+
+from helpers import distance
+
+import os
+import time
+import struct
+
+import logging
+logger = logging.getLogger( MODULE_NAME )
+
+TRACK_DIR = config.getValue( "ogpsd", "track_dir", os.path.join( rootdir, "tracks" ) )
+TRACK_FILE_SIZE = config.getInt( "ogpsd", "track_file_size", 1048576 )
+TRACK_FILES = config.getInt( "ogpsd", "track_files", 16 )
+
+MAGIC = "OGPSTRK1"
+# magic, creation time
+HEADER = struct.Struct( "<8sI12x" )
+# time, latitude and longitude in 1e-7 degrees, altitude in cm,
+# speed in 0.01 knots, heading in 0.01 degrees, hdop in 0.01, position fields
+RECORD = struct.Struct( "<IiiiHHHBx" )
+# INDEX_MARKER, first time, last time, number of records
+INDEX = struct.Struct( "<IIIH10x" )
+INDEX_MARKER = 0xffffffff
+INDEX_INTERVAL = 256
+
+# index record plus the records before it
+BLOCK_SIZE = ( INDEX_INTERVAL + 1 ) * RECORD.size
+
+def _clamp( value ):
+    return max( 0, min( 0xffff, int( round( value ) ) ) )
+
+def _points( data, start, end ):
+    points = []
+    for offset in range( 0, len( data ) - RECORD.size + 1, RECORD.size ):
+        ( tstamp, lat, lon, alt, speed, heading, hdop, fields ) = RECORD.unpack_from( data, offset )
+        if start <= tstamp <= end:
+            points.append( ( tstamp, lat / 1e7, lon / 1e7, alt / 100.0, speed / 100.0, heading / 100.0 ) )
+    return points
+
+def readTrackFile( path, start, end ):
+    """
+    Returns the points of a track file between start and end (inclusive)
+    as ( time, lat, lon, alt, speed, heading ) tuples.
+    """
+    points = []
+    f = open( path, "rb" )
+    try:
+        header = f.read( HEADER.size )
+        if len( header ) < HEADER.size or HEADER.unpack( header )[0] != MAGIC:
+            logger.warning( "%s is no track file", path )
+            return points
+        size = os.fstat( f.fileno() ).st_size - HEADER.size
+        blocks = size // BLOCK_SIZE
+        for block in range( blocks ):
+            offset = HEADER.size + block * BLOCK_SIZE
+            f.seek( offset + INDEX_INTERVAL * RECORD.size )
+            ( marker, first, last, count ) = INDEX.unpack( f.read( INDEX.size ) )
+            if marker != INDEX_MARKER:
+                logger.warning( "%s has a broken index at %d", path, offset )
+            elif last < start or first > end:
+                continue
+            f.seek( offset )
+            points.extend( _points( f.read( INDEX_INTERVAL * RECORD.size ), start, end ) )
+        # the records after the last index, a partial record is ignored
+        f.seek( HEADER.size + blocks * BLOCK_SIZE )
+        points.extend( _points( f.read(), start, end ) )
+    finally:
+        f.close()
+    return points
+
+#=========================================================================#
+class TrackRecorder( object ):
+#=========================================================================#
+    """
+    Appends fixes to the track files in TRACK_DIR.
+
+    While recording, a fix is only recorded when at least interval seconds
+    have passed and the position moved at least distance meters since the
+    last one recorded.
+    """
+    def __init__( self, path=TRACK_DIR ):
+        self.path = path
+        self.file = None
+        self.interval = 0
+        self.distance = 0
+        self.last = None
+        self.first = None
+        self.count = 0
+
+    def isRecording( self ):
+        return self.file is not None
+
+    def start( self, interval, distance ):
+        if self.file is not None:
+            self.stop()
+        self.interval = interval
+        self.distance = distance
+        self.last = None
+        self._open()
+
+    def stop( self ):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def flush( self ):
+        if self.file is not None:
+            self.file.flush()
+
+    def add( self, tstamp, fields, lat, lon, alt, speed, heading, hdop ):
+        if self.file is None:
+            return
+        if self.last is not None:
+            ( lasttime, lastlat, lastlon ) = self.last
+            if tstamp - lasttime < self.interval:
+                return
+            if self.distance and distance( lastlat, lastlon, lat, lon ) < self.distance:
+                return
+        self.last = ( tstamp, lat, lon )
+
+        self.file.write( RECORD.pack( tstamp, int( round( lat * 1e7 ) ), int( round( lon * 1e7 ) ), int( round( alt * 100 ) ),
+                                      _clamp( speed * 100 ), _clamp( heading * 100 ), _clamp( hdop * 100 ), fields ) )
+        if self.first is None:
+            self.first = tstamp
+        self.count += 1
+        if self.count == INDEX_INTERVAL:
+            self.file.write( INDEX.pack( INDEX_MARKER, self.first, tstamp, self.count ) )
+            self.file.flush()
+            self.first = None
+            self.count = 0
+            if self.file.tell() >= TRACK_FILE_SIZE:
+                self.file.close()
+                self._open()
+
+    def query( self, start, end, maxpoints ):
+        """
+        Returns the points recorded between start and end, at most maxpoints
+        of them (0 for all), evenly spread over the ones found.
+        """
+        self.flush()
+        points = []
+        for filename in self._files():
+            points.extend( readTrackFile( os.path.join( self.path, filename ), start, end ) )
+        # the clock may have been set back while recording
+        points.sort( key=lambda point: point[0] )
+        if maxpoints and len( points ) > maxpoints:
+            points = [ points[i * len( points ) // maxpoints] for i in range( maxpoints ) ]
+        return points
+
+    def _files( self ):
+        try:
+            return sorted( [ name for name in os.listdir( self.path ) if name.endswith( ".track" ) ] )
+        except OSError:
+            return []
+
+    def _open( self ):
+        if not os.path.isdir( self.path ):
+            os.makedirs( self.path )
+        now = time.time()
+        name = time.strftime( "%Y%m%d-%H%M%S", time.gmtime( now ) )
+        # continue after the newest file of the same second, even if older
+        # ones have been removed already
+        sequence = 0
+        for old in self._files():
+            if old.startswith( name + "-" ):
+                try:
+                    sequence = max( sequence, int( old[len( name ) + 1:-len( ".track" )] ) + 1 )
+                except ValueError:
+                    pass
+        filename = os.path.join( self.path, "%s-%03d.track" % ( name, sequence ) )
+        logger.info( "recording track to %s", filename )
+        self.file = open( filename, "wb" )
+        self.file.write( HEADER.pack( MAGIC, int( now ) ) )
+        self.first = None
+        self.count = 0
+        # forget the oldest tracks
+        for old in self._files()[:-TRACK_FILES]:
+            logger.info( "removing old track %s", old )
+            os.remove( os.path.join( self.path, old ) )
+
+#vim: expandtab
@@ -14,6 +14,7 @@ from gpsdevice import GPSDevice
 from framework import resource
 import struct
 import calendar
+from collections import namedtuple
 import dbus
 import dbus.service
 from framework.config import config
@@ -25,6 +26,10 @@ DBUS_INTERFACE = "org.freesmartphone.GPS"
 
 SYNC1=0xb5
 SYNC2=0x62
+SYNC=chr( SYNC1 ) + chr( SYNC2 )
+
+# consumed data is only removed from the parser buffer when it exceeds this
+COMPACT_SIZE=4096
 
 CLASS = {
     "NAV" : 0x01,
@@ -260,20 +265,168 @@ MSGFMT = {
 # TIM - Timekeeping
 }
 
-MSGFMT_INV = dict( [ [(CLIDPAIR[clid], le),v + [clid]] for (clid, le),v in MSGFMT.items() ] )
+# Messages received at navigation rate, decoded to tuples with named fields
+# instead of dicts
+RECORD_MESSAGES = [ "NAV-STATUS", "NAV-POSLLH", "NAV-VELNED", "NAV-DOP", "NAV-TIMEUTC", "NAV-SVINFO" ]
+
+class UBXDecoder( object ):
+    """
+    Decodes the payload of one message type with the structs compiled
+    from its MSGFMT entries.
+
+    The payload is decoded to a list of records, one for the fixed part
+    and one for each repeated block of variable length messages.
+    """
+    def __init__( self, clid ):
+        self.clid = clid
+        self.fixed = {}         # length -> ( struct, record )
+        self.variable = None    # ( base length, struct, record, block length, block format, block record )
+        self.blocks = {}        # number of blocks -> struct
+
+    def add( self, length, format ):
+        if length is not None:
+            self.fixed[length] = ( struct.Struct( format[0] ), self.recordType( self.clid, format[1] ) )
+        else:
+            self.variable = ( format[0], struct.Struct( format[1] ), self.recordType( self.clid, format[2] ),
+                              format[3], format[4].lstrip( "<" ), self.recordType( self.clid + "-block", format[5] ) )
+
+    def recordType( self, name, fields ):
+        if self.clid in RECORD_MESSAGES:
+            return namedtuple( name.replace( "-", "_" ), fields )._make
+        return lambda values: dict( zip( fields, values ) )
+
+    def decode( self, length, payload ):
+        """
+        Returns the list of records, None if length doesn't fit the message.
+        """
+        try:
+            ( base, make ) = self.fixed[length]
+        except KeyError:
+            pass
+        else:
+            return [ make( base.unpack( payload ) ) ]
+
+        if self.variable is None:
+            return None
+        ( baselength, base, make, blocklength, blockformat, makeblock ) = self.variable
+        ( count, rest ) = divmod( length - baselength, blocklength )
+        if rest or count < 0:
+            return None
+        try:
+            blocks = self.blocks[count]
+        except KeyError:
+            # all blocks are unpacked at once
+            blocks = self.blocks[count] = struct.Struct( "<" + blockformat * count )
+        data = [ make( base.unpack_from( payload ) ) ]
+        if count:
+            values = blocks.unpack_from( payload, baselength )
+            size = len( values ) / count
+            data.extend( [ makeblock( values[i:i+size] ) for i in range( 0, len( values ), size ) ] )
+        return data
+
+    def asDicts( self, data ):
+        return [ dict( zip( record._fields, record ) ) if isinstance( record, tuple ) else record for record in data ]
+
+def _compileDecoders():
+    decoders = {}
+    for ( ( clid, length ), format ) in MSGFMT.items():
+        if CLIDPAIR[clid] not in decoders:
+            decoders[CLIDPAIR[clid]] = UBXDecoder( clid )
+        decoders[CLIDPAIR[clid]].add( length, format )
+    return decoders
+
+DECODERS = _compileDecoders()
+
+def fletcher( data ):
+    """
+    Returns the 8-bit Fletcher checksum (ck_a, ck_b) of data (a bytearray).
+    """
+    ck_a = 0
+    ck_b = 0
+    for byte in data:
+        ck_a += byte
+        ck_b += ck_a
+    return ( ck_a & 0xff, ck_b & 0xff )
+
+class UBXParser( object ):
+    """
+    Splits a stream of data into UBX packets.
+
+    Data is collected in a bytearray, the start of the unprocessed data
+    is tracked by an offset. The packets found are passed to
+    callback( cl, id, length, payload ).
+    """
+    def __init__( self, callback ):
+        self.callback = callback
+        self.reset()
+
+    def reset( self ):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def feed( self, data ):
+        buffer = self.buffer
+        buffer.extend( data )
+        end = len( buffer )
+        # start of unprocessed data, where to look for the next packet
+        pos = search = self.offset
+        # Minimum packet length is 8
+        while end >= search + 8:
+            # Find the beginning of a UBX message
+            start = buffer.find( SYNC, search )
+
+            if search == pos and start != pos:
+                if start == -1:
+                    # the last byte could be the start of a sync
+                    start = end - 1
+                logger.debug( "Discarded data not UBX %s", repr( str( buffer[pos:start] ) ) )
+                pos = search = start
+                continue
+
+            if start == -1 or start + 8 > end:
+                break
+
+            length = buffer[start+4] | buffer[start+5] << 8
+            if end < start + length + 8:
+                search = start + 2
+                continue
+
+            if fletcher( buffer[start+2:start+length+6] ) != ( buffer[start+length+6], buffer[start+length+7] ):
+                search = start + 2
+                continue
+
+            if start != pos:
+                logger.warning( " UBX packet ignored %s", repr( str( buffer[pos:start] ) ) )
+                pos = search = start
+                continue
+
+            self.callback( buffer[start+2], buffer[start+3], length, str( buffer[start+6:start+length+6] ) )
+
+            # Skip packet
+            pos = search = start + length + 8
+
+        if pos >= COMPACT_SIZE or pos == end:
+            del buffer[:pos]
+            pos = 0
+        self.offset = pos
 
 class UBXDevice( GPSDevice ):
     def __init__( self, bus, channel ):
         super( UBXDevice, self ).__init__( bus, channel )
 
         self.gpsfixstatus = 0
-        self.buffer = ""
+        self.parser = UBXParser( self.decode )
         self.channel.setCallback( self.parse )
 
         self.ack = {"CFG-PRT" : 0}
         self.ubx = {}
         self.debugfilter = {}
 
+        # look up the handlers only once
+        self.handlers = {}
+        for ( clidpair, decoder ) in DECODERS.items():
+            self.handlers[clidpair] = getattr( self, "handle_" + decoder.clid.replace( "-", "_" ), None )
+
     def initializeDevice( self ):
         # Use high sensitivity mode
         #self.send("CFG-RXM", 2, {"gps_mode" : 2, "lp_mode" : 0})
@@ -333,46 +486,12 @@ class UBXDevice( GPSDevice ):
         self.send("CFG-PRT", 0, [])
         # Reset
         self.gpsfixstatus = 0
-        self.buffer = ""
+        self.parser.reset()
 
         super( UBXDevice, self ).shutdownDevice()
 
     def parse( self, data ):
-        self.buffer += data
-        buffer_offset = 0
-        # Minimum packet length is 8
-        while len(self.buffer) >= buffer_offset + 8:
-            # Find the beginning of a UBX message
-            start = self.buffer.find( chr( SYNC1 ) + chr( SYNC2 ), buffer_offset )
-
-            if buffer_offset == 0 and start != 0:
-                logger.debug( "Discarded data not UBX %s" % repr(self.buffer[:start]) )
-                self.buffer = self.buffer[start:]
-                continue
-
-            if start == -1 or start + 8 > len(self.buffer):
-                return
-
-            (cl, id, length) = struct.unpack("<BBH", self.buffer[start+2:start+6])
-            if len(self.buffer) < start + length + 8:
-                buffer_offset = start + 2
-                continue
-
-            if self.checksum(self.buffer[start+2:start+length+6]) != struct.unpack("<BB", self.buffer[start+length+6:start+length+8]):
-                buffer_offset = start + 2
-                continue
-
-            if start != 0:
-                logger.warning(" UBX packet ignored %s" % repr(self.buffer[:start]) )
-                self.buffer = self.buffer[start:]
-                buffer_offset = 0
-                continue
-
-            self.decode(cl, id, length, self.buffer[start+6:start+length+6])
-
-            # Discard packet
-            self.buffer = self.buffer[start+length+8:]
-            buffer_offset = 0
+        self.parser.feed( data )
 
     def send( self, clid, length, payload ):
         logger.debug( "Sending UBX packet of type %s: %s" % ( clid, payload ) )
@@ -401,53 +520,34 @@ class UBXDevice( GPSDevice ):
         self.channel.send( stream )
 
     def checksum( self, msg ):
-        ck_a = 0
-        ck_b = 0
-        for i in msg:
-            ck_a = ck_a + ord(i)
-            ck_b = ck_b + ck_a
-        ck_a = ck_a % 256
-        ck_b = ck_b % 256
-        return (ck_a, ck_b)
+        return fletcher( bytearray( msg ) )
 
     def decode( self, cl, id, length, payload ):
-        data = []
-        try:
-            format = MSGFMT_INV[((cl, id), length)]
-            data.append(dict(zip(format[1], struct.unpack(format[0], payload))))
-        except KeyError:
-            try:
-                # Try if this is one of the variable field messages
-                format = MSGFMT_INV[((cl, id), None)]
-                fmt_base = format[:3]
-                fmt_rep = format[3:]
-                # Check if the length matches
-                if (length - fmt_base[0])%fmt_rep[0] != 0:
-                    logger.error( "Variable length message class 0x%x, id 0x%x \
-                        has wrong length %i" % ( cl, id, length ) )
-                    return
-                data.append(dict(zip(fmt_base[2], struct.unpack(fmt_base[1], payload[:fmt_base[0]]))))
-                for i in range(0, (length - fmt_base[0])/fmt_rep[0]):
-                    offset = fmt_base[0] + fmt_rep[0] * i
-                    data.append(dict(zip(fmt_rep[2], struct.unpack(fmt_rep[1], payload[offset:offset+fmt_rep[0]]))))
-
-            except KeyError:
+        decoder = DECODERS.get( ( cl, id ) )
+        if decoder is None:
+            logger.info( "Unknown message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
+            return
+        data = decoder.decode( length, payload )
+        if data is None:
+            if decoder.variable is None:
                 logger.info( "Unknown message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
-                return
-
-        logger.debug( "Got UBX packet of type %s: %s" % (format[-1] , data ) )
-        methodname = "handle_"+format[-1].replace("-", "_")
-        try:
-            method = getattr( self, methodname )
-        except AttributeError:
-            logger.debug( "No method to handle %s: %s" % ( format[-1], data ) )
+            else:
+                logger.error( "Variable length message class 0x%x, id 0x%x \
+                    has wrong length %i" % ( cl, id, length ) )
+            return
+
+        clid = decoder.clid
+        logger.debug( "Got UBX packet of type %s: %s", clid, data )
+        method = self.handlers[( cl, id )]
+        if method is None:
+            logger.debug( "No method to handle %s: %s", clid, data )
         else:
             try:
                 method( data )
             except Exception, e:
-                logger.error( "Error in %s method: %s" % ( methodname, e ) )
-        if self.debugfilter.get( format[-1], False ):
-            self.DebugPacket( format[-1], length, data )
+                logger.error( "Error in %s method: %s" % ( method.__name__, e ) )
+        if self.debugfilter.get( clid, False ):
+            self.DebugPacket( clid, length, decoder.asDicts( data ) )
 
     def handle_CFG_PRT( self, data ):
         data = data[1]
@@ -464,8 +564,8 @@ class UBXDevice( GPSDevice ):
     def handle_NAV_STATUS( self, data ):
         data = data[0]
         fixtranstbl = [ 1, 1, 2, 3, 2, 1 ]
-        self.gpsfixstatus = fixtranstbl[ data["GPSfix"] ]
-        if data["Flags"]&0x01 == 0:
+        self.gpsfixstatus = fixtranstbl[ data.GPSfix ]
+        if data.Flags&0x01 == 0:
             self.gpsfixstatus = 1
         self._updateFixStatus( self.gpsfixstatus )
 
@@ -478,8 +578,8 @@ class UBXDevice( GPSDevice ):
         else:
             valid = 0
         data = data[0]
-        self._updatePosition( valid, data["LAT"]/scaling,
-                data["LON"]/scaling, data["HMSL"]/1000.0 )
+        self._updatePosition( valid, data.LAT/scaling,
+                data.LON/scaling, data.HMSL/1000.0 )
 
     def handle_NAV_DOP( self, data ):
         if self.gpsfixstatus == 3:
@@ -489,8 +589,8 @@ class UBXDevice( GPSDevice ):
         else:
             valid = 0
         data = data[0]
-        self._updateAccuracy( valid, data["PDOP"]/100.0,
-                data["HDOP"]/100.0, data["VDOP"]/100.0 )
+        self._updateAccuracy( valid, data.PDOP/100.0,
+                data.HDOP/100.0, data.VDOP/100.0 )
 
     def handle_NAV_VELNED( self, data ):
         if self.gpsfixstatus == 3:
@@ -500,19 +600,19 @@ class UBXDevice( GPSDevice ):
         else:
             valid = 0
         data = data[0]
-        self._updateCourse( valid, data["GSpeed"]*0.019438445,
-                data["Heading"]/100000.0, data["VEL_D"]*0.019438445 )
+        self._updateCourse( valid, data.GSpeed*0.019438445,
+                data.Heading/100000.0, data.VEL_D*0.019438445 )
 
     def handle_NAV_SVINFO( self, data ):
         satellites = []
         base = data[0]
         data = data[1:]
         for sat in data:
-            in_use = bool(sat["Flags"] & 0x01)
+            in_use = bool(sat.Flags & 0x01)
             # Don't include satellites that are below the horizon
             # (Gypsy interface requires positive elevation)
-            if sat["Elev"] > 0:
-                satellites.append( (sat["SVID"], in_use, sat["Elev"], sat["Azim"], sat["CNO"]) )
+            if sat.Elev > 0:
+                satellites.append( (sat.SVID, in_use, sat.Elev, sat.Azim, sat.CNO) )
         self._updateSatellites( satellites )
 
     def handle_NAV_TIMEUTC( self, data ):
@@ -521,8 +621,8 @@ class UBXDevice( GPSDevice ):
         # We have valid GPS time (without leap seconds known) much earlier than
         # UTC and they differ by ~17secs at the moment. The leap seconds could
         # be cached so we would know the UTC time +- some seconds much earlier.
-        if data["Valid"] & 0x04:
-            time = calendar.timegm( (data["Year"], data["Month"], data["Day"], data["Hour"], data["Min"], data["Sec"]) )
+        if data.Valid & 0x04:
+            time = calendar.timegm( (data.Year, data.Month, data.Day, data.Hour, data.Min, data.Sec) )
             self._updateTime( time )
 
     # Ignore ACK packets for now
@@ -114,9 +114,13 @@ class Device( resource.Resource ):
             self.modem.recoverFromSuspend( lambda: self._recoverOk( on_ok, on_error ), on_error )
 
     def _recoverOk( self, on_ok, on_error):
+        self.modem.networkState().invalidate()
         mediator.NetworkGetStatus( self, lambda x: self._recoverStatusOk( x, on_ok, on_error ), on_error )
 
     def _recoverStatusOk( self, status, on_ok, on_error ):
+        state = self.modem.networkState()
+        state.setStatus( status )
+        state.statusChanged( status )
         self.Status( status )
         on_ok()
 
@@ -151,6 +155,7 @@ class Device( resource.Resource ):
                           async_callbacks=( "dbus_ok", "dbus_error" ) )
     @resource.checkedmethod
     def SetAntennaPower( self, power, dbus_ok, dbus_error ):
+        self.modem.networkState().invalidate()
         mediator.DeviceSetAntennaPower( self, dbus_ok, dbus_error, power=power )
 
     @dbus.service.method( DBUS_INTERFACE_DEVICE, "", "b",
@@ -332,6 +337,17 @@ class Device( resource.Resource ):
     def RetrievePhonebook( self, category, indexFirst, indexLast, dbus_ok, dbus_error ):
         mediator.SimRetrievePhonebook( self, dbus_ok, dbus_error, category=category, indexFirst=indexFirst, indexLast=indexLast )
 
+    @dbus.service.method( DBUS_INTERFACE_SIM, "sii", "i",
+                          async_callbacks=( "dbus_ok", "dbus_error" ) )
+    @resource.checkedmethod
+    def StreamPhonebook( self, category, indexFirst, indexLast, dbus_ok, dbus_error ):
+        mediator.SimStreamPhonebook( self, dbus_ok, dbus_error, category=category, indexFirst=indexFirst, indexLast=indexLast )
+
+    @resource.queuedsignal
+    @dbus.service.signal( DBUS_INTERFACE_SIM, "sa(iss)" )
+    def PhonebookEntries( self, category, entries ):
+        logger.info( "%d entries retrieved from sim phonebook %s", len( entries ), category )
+
     @dbus.service.method( DBUS_INTERFACE_SIM, "si", "",
                           async_callbacks=( "dbus_ok", "dbus_error" ) )
     @resource.checkedmethod
@@ -363,6 +379,17 @@ class Device( resource.Resource ):
     def RetrieveMessagebook( self, category, dbus_ok, dbus_error ):
         mediator.SimRetrieveMessagebook( self, dbus_ok, dbus_error, category=category )
 
+    @dbus.service.method( DBUS_INTERFACE_SIM, "s", "i",
+                          async_callbacks=( "dbus_ok", "dbus_error" ) )
+    @resource.checkedmethod
+    def StreamMessagebook( self, category, dbus_ok, dbus_error ):
+        mediator.SimStreamMessagebook( self, dbus_ok, dbus_error, category=category )
+
+    @resource.queuedsignal
+    @dbus.service.signal( DBUS_INTERFACE_SIM, "sa(isssa{sv})" )
+    def MessagebookEntries( self, category, entries ):
+        logger.info( "%d messages retrieved from sim messagebook %s", len( entries ), category )
+
     @dbus.service.method( DBUS_INTERFACE_SIM, "i", "sssa{sv}",
                           async_callbacks=( "dbus_ok", "dbus_error" ) )
     @resource.checkedmethod
@@ -447,19 +474,29 @@ class Device( resource.Resource ):
                           async_callbacks=( "dbus_ok", "dbus_error" ) )
     @resource.checkedmethod
     def Register( self, dbus_ok, dbus_error ):
+        self.modem.networkState().invalidate()
         mediator.NetworkRegister( self, dbus_ok, dbus_error )
 
     @dbus.service.method( DBUS_INTERFACE_NETWORK, "", "",
                           async_callbacks=( "dbus_ok", "dbus_error" ) )
     @resource.checkedmethod
     def Unregister( self, dbus_ok, dbus_error ):
+        self.modem.networkState().invalidate()
         mediator.NetworkUnregister( self, dbus_ok, dbus_error )
 
     @dbus.service.method( DBUS_INTERFACE_NETWORK, "", "a{sv}",
                           async_callbacks=( "dbus_ok", "dbus_error" ) )
     @resource.checkedmethod
     def GetStatus( self, dbus_ok, dbus_error ):
-        mediator.NetworkGetStatus( self, dbus_ok, dbus_error )
+        state = self.modem.networkState()
+        status = state.cachedStatus()
+        if status is not None:
+            dbus_ok( status )
+        else:
+            def ok( status ):
+                state.setStatus( status )
+                dbus_ok( status )
+            mediator.NetworkGetStatus( self, ok, dbus_error )
 
     @resource.queuedsignal
     @dbus.service.signal( DBUS_INTERFACE_NETWORK, "a{sv}" )
@@ -470,7 +507,15 @@ class Device( resource.Resource ):
                           async_callbacks=( "dbus_ok", "dbus_error" ) )
     @resource.checkedmethod
     def GetSignalStrength( self, dbus_ok, dbus_error ):
-        mediator.NetworkGetSignalStrength( self, dbus_ok, dbus_error )
+        state = self.modem.networkState()
+        strength = state.cachedStrength()
+        if strength is not None:
+            dbus_ok( strength )
+        else:
+            def ok( strength ):
+                state.setStrength( strength )
+                dbus_ok( strength )
+            mediator.NetworkGetSignalStrength( self, ok, dbus_error )
 
     @resource.queuedsignal
     @dbus.service.signal( DBUS_INTERFACE_NETWORK, "i" )
@@ -487,6 +532,7 @@ class Device( resource.Resource ):
                           async_callbacks=( "dbus_ok", "dbus_error" ) )
     @resource.checkedmethod
     def RegisterWithProvider( self, operator_code, dbus_ok, dbus_error ):
+        self.modem.networkState().invalidate()
         mediator.NetworkRegisterWithProvider( self, dbus_ok, dbus_error, operator_code=operator_code )
 
     @dbus.service.method( DBUS_INTERFACE_NETWORK, "", "ss",
@@ -732,6 +778,18 @@ class Device( resource.Resource ):
         self.modem.inject( channel, str(string) )
         dbus_ok()
 
+    @dbus.service.method( DBUS_INTERFACE_DEBUG, "s", "a{sv}",
+                          async_callbacks=( "dbus_ok", "dbus_error" ) )
+    @resource.checkedmethod
+    def DebugGetChannelStatistics( self, channel, dbus_ok, dbus_error ):
+        dbus_ok( self.modem.channelStatistics( str(channel) ) )
+
+    @dbus.service.method( DBUS_INTERFACE_DEBUG, "s", "a{sai}",
+                          async_callbacks=( "dbus_ok", "dbus_error" ) )
+    @resource.checkedmethod
+    def DebugGetChannelWaitHistograms( self, channel, dbus_ok, dbus_error ):
+        dbus_ok( self.modem.channelWaitHistograms( str(channel) ) )
+
     @dbus.service.method( DBUS_INTERFACE_DEBUG, "s", "s",
                           async_callbacks=( "dbus_ok", "dbus_error" ) )
     @resource.checkedmethod
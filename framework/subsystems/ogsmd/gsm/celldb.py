@@ -1,10 +1,22 @@
 from sys import stdin, stdout, stderr, argv
 from math import sqrt
 from struct import calcsize, pack, unpack
+from mmap import mmap, ACCESS_READ
+from bisect import bisect_right
+from collections import OrderedDict
+from time import time
+import os
 
 CELL_DB = '/etc/freesmartphone/ogsmd/cell.db'
 LA_DB = '/etc/freesmartphone/ogsmd/la.db'
 
+# every INDEX_STEP-th key of a database is kept in memory
+INDEX_STEP = 64
+# number of recently resolved keys remembered per database
+CACHE_SIZE = 512
+# seconds between checks whether a database file has been replaced
+CHECK_INTERVAL = 5
+
 class SimpleCenter(object):
     # FIXME port pyproj to the neo and use it
     def __init__(self):
@@ -65,49 +77,118 @@ class ProjCenter(object):
 
 Center = SimpleCenter
 
-def find(f, format, pattern_format, pattern_data):
-    format_size = calcsize(format)
-    pattern_size = calcsize(pattern_format)
-    pattern = pack(pattern_format, *pattern_data)
-    l = 0
-    f.seek(0, 2)
-    r = f.tell()/format_size
-    while l < r:
-        m = (r+l)/2
-        f.seek(m*format_size)
-        data = f.read(format_size)
-        if pattern == data[:pattern_size]:
-            return unpack(format, data)
-        elif pattern<data[:pattern_size]:
-            r = m
-        elif data[:pattern_size]<pattern:
-            l = m
-        if l+1==r:
+class Database(object):
+    """
+    A file of fixed size records sorted by their big endian key (so the
+    order of the packed keys is the order of the key tuples).
+
+    The file is memory-mapped once and kept open. Every INDEX_STEP-th key is
+    kept in memory, so a lookup is a bisection of that index and a binary
+    search within a single block of the file. Recent results are kept in an
+    LRU cache.
+    """
+    def __init__(self, path, format, key_format):
+        self.path = path
+        self.format = format
+        self.size = calcsize(format)
+        self.key_format = key_format
+        self.key_size = calcsize(key_format)
+        self.data = None
+        self.stamp = None
+        self.checked = 0
+        self.cache = OrderedDict()
+
+    def open(self):
+        f = file(self.path, 'rb')
+        try:
+            stat = os.fstat(f.fileno())
+            if stat.st_size:
+                data = mmap(f.fileno(), 0, access=ACCESS_READ)
+            else: # empty files can't be mapped
+                data = ''
+        finally:
+            f.close()
+        self.close()
+        self.data = data
+        self.stamp = (stat.st_ino, stat.st_mtime, stat.st_size)
+        self.count = len(data) / self.size
+        self.index = [data[i*self.size:i*self.size+self.key_size] for i in xrange(0, self.count, INDEX_STEP)]
+
+    def close(self):
+        if self.data:
+            self.data.close()
+        self.data = None
+        self.cache.clear()
+
+    def check(self):
+        """Opens the file or reopens it if it has been replaced"""
+        now = time()
+        if self.data is not None and now - self.checked < CHECK_INTERVAL:
+            return
+        self.checked = now
+        if self.data is not None:
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return
+            if (stat.st_ino, stat.st_mtime, stat.st_size) == self.stamp:
+                return
+        self.open()
+
+    def find(self, key):
+        pattern = pack(self.key_format, *key)
+        block = bisect_right(self.index, pattern) - 1
+        if block < 0:
             return None
+        l = block * INDEX_STEP
+        r = min(l + INDEX_STEP, self.count)
+        while l < r:
+            m = (l+r)/2
+            offset = m*self.size
+            data = self.data[offset:offset+self.key_size]
+            if data < pattern:
+                l = m+1
+            elif pattern < data:
+                r = m
+            else:
+                return unpack(self.format, self.data[offset:offset+self.size])
+        return None
+
+    def lookup(self, keys):
+        """Returns the records for a list of keys, None for unknown keys"""
+        self.check()
+        cache = self.cache
+        results = []
+        for key in keys:
+            try:
+                result = cache.pop(key)
+            except KeyError:
+                result = self.find(key)
+                if len(cache) >= CACHE_SIZE:
+                    cache.popitem(last=False)
+            cache[key] = result
+            results.append(result)
+        return results
+
+cell_db = Database(CELL_DB, '!HHHHffff', '!HHHH')
+la_db = Database(LA_DB, '!HHHffff', '!HHH')
 
 def get_cell(mcc, mnc, lac, cid):
-    cell_db = file(CELL_DB, 'rb')
-    result = find(cell_db, '!HHHHffff', '!HHHH', (mcc, mnc, lac, cid))
-    cell_db.close()
-    if result:
-        return result[4:]
-    else:
-        return None
+    return get_cells(mcc, mnc, [(lac, cid)])[0]
+
+def get_cells(mcc, mnc, cells):
+    results = cell_db.lookup([(mcc, mnc, lac, cid) for lac, cid in cells])
+    return [result and result[4:] for result in results]
 
 def get_center(mcc, mnc, cells):
     center = Center()
-    cell_db = file(CELL_DB, 'rb')
-    for lac, cid in cells:
-        cell = find(cell_db, '!HHHHffff', '!HHHH', (mcc, mnc, lac, cid))
+    for cell in get_cells(mcc, mnc, cells):
         if cell:
-            center.addPoint(cell[4:7])
-    cell_db.close()
+            center.addPoint(cell[:3])
     return center.calc()
 
 def get_la(mcc, mnc, lac):
-    la_db = file(LA_DB, 'rb')
-    result = find(la_db, '!HHHffff', '!HHH', (mcc, mnc, lac))
-    la_db.close()
+    result = la_db.lookup([(mcc, mnc, lac)])[0]
     if result:
         return result[3:]
     else:
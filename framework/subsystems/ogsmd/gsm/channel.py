@@ -19,10 +19,12 @@ MODULE_NAME = "ogsmd.channel"
 
 import parser
 
+from framework.config import config
+
 import gobject # pygobject
 
 import serial # pyserial
-import Queue, fcntl, os, time, types, re # stdlib
+import bisect, collections, fcntl, inspect, os, time, types, re # stdlib
 
 import logging
 logger = logging.getLogger( MODULE_NAME )
@@ -33,23 +35,136 @@ PRIORITY_HUP = -5
 
 DEFAULT_CHANNEL_TIMEOUT = 5*60
 
+# priority classes of commands, the most urgent first
+COMMAND_CLASSES = [ "call", "auth", "interactive", "background" ]
+
+# commands not matching any of these are interactive
+COMMAND_CLASS_PATTERNS = [
+    ( re.compile( "AT(?:D|A\r|H\d?\r|\+CHLD|\+CHUP|\+VTS|\+CTFR)" ), "call" ),
+    ( re.compile( "AT\+(?:CPIN|CPWD|CLCK)" ), "auth" ),
+    ( re.compile( "AT\+(?:CPBR|CPBF|CMGL|CMGR|CRSM|CSIM|COPS=\?)" ), "background" ),
+]
+
+# configured timeouts of the priority classes, None if not set
+COMMAND_TIMEOUTS = dict( [ ( klass, config.getInt( "ogsmd", "timeout_%s" % klass ) ) for klass in COMMAND_CLASSES ] )
+
+# upper bounds (in milliseconds) of the buckets of the queue wait histograms
+WAIT_HISTOGRAM_BOUNDS = [ 10, 50, 100, 500, 1000, 5000, 10000, 60000 ]
+
 AUTOPREFIX = re.compile( "A?T?(?P<prefix>[\+%!*$\^_&@][A-Z]+)" )
 
 # keys are commands, values are autocomputed response lists
 AUTOPREFIX_CACHE = {}
 
+# extended commands that can be joined with ';' into a single command line
+BATCHABLE = re.compile( 'AT(?P<command>(?P<name>[\+%!*$\^_&@][A-Z]+)(?:\?|=(?:[0-9,]|"[^";]*")*)?)\r\n$' )
+
+# commands that change the modem state, must not be repeated, or return large results
+UNBATCHABLE = set( [ "+CFUN", "+COPS", "+CPIN", "+CLCK", "+CPWD", "+CHLD", "+CMGD", "+CMGS", "+CMSS",
+                     "+CMGW", "+CMGL", "+CMGR", "+CPBR", "+CPBW", "+CUSD", "+CCFC", "+CRSM", "+CSIM" ] )
+
+BATCH_COMMANDS = config.getBool( "ogsmd", "batch_commands", False )
+BATCH_SIZE = config.getInt( "ogsmd", "batch_size", 8 )
+
+# unsolicited responses reporting only the current state; within the coalescing
+# window, only the last one of each gets handled
+COALESCIBLE_UNSOLICITED = set( [ "+CREG", "+CGREG", "+CSQ", "%CSQ", "@HTCCSQ" ] )
+UNSOLICITED_COALESCE_WINDOW = config.getInt( "ogsmd", "unsolicited_coalesce_window", 0 )
+
+# delegate class -> { unsolicited command -> ( method name or None, arity ) }
+DISPATCH_TABLES = {}
+# unknown commands are not remembered beyond that size
+DISPATCH_TABLE_SIZE = 256
+
+def commandClass( data ):
+    """
+    Return the priority class of a command.
+    """
+    for pattern, klass in COMMAND_CLASS_PATTERNS:
+        if pattern.match( data ):
+            return klass
+    return "interactive"
+
 #=========================================================================#
-class PeekholeQueue( Queue.Queue ):
+class PriorityPeekholeQueue( object ):
 #=========================================================================#
     """
-    This class extends the Queue with a method to peek at the
-    first element without having to remove this from the queue.
+    This class implements a queue with one FIFO per priority class
+    and a method to peek at the first element without having to remove
+    this from the queue.
+
+    Once peeked at, the first element stays in front until it is removed,
+    hence more urgent elements can not overtake a command in execution.
+    Internally, elements are kept as [ element, class, time enqueued,
+    send alone ], the latter marking commands that must not be batched.
     """
+    def __init__( self, classes ):
+        self.classes = classes
+        self.queues = dict( [ ( klass, collections.deque() ) for klass in classes ] )
+        self.head = None
+        self.size = 0
+
+    def put( self, element, klass ):
+        self.queues[klass].append( [ element, klass, time.time(), False ] )
+        self.size += 1
+
+    def get( self ):
+        entry = self.peekEntry()
+        self.head = None
+        self.size -= 1
+        # the text of a multiline command has to follow its first line immediately
+        if entry[0][0].endswith( '\r' ) and self.queues[entry[1]]:
+            self.head = self.queues[entry[1]].popleft()
+        return entry[0]
+
     def peek( self ):
-        if self.empty():
+        entry = self.peekEntry()
+        if entry is None:
             return None
         else:
-            return self.queue[0]
+            return entry[0]
+
+    def peekEntry( self ):
+        if self.head is None:
+            for klass in self.classes:
+                if self.queues[klass]:
+                    self.head = self.queues[klass].popleft()
+                    break
+        return self.head
+
+    def entries( self ):
+        """
+        Return the entries in the order they will be taken out of the queue.
+        """
+        entries = [ self.head ] if self.head is not None else []
+        for klass in self.classes:
+            entries.extend( self.queues[klass] )
+        return entries
+
+    def take( self, count ):
+        """
+        Remove the first count entries and return them.
+        """
+        entries = []
+        while len( entries ) < count:
+            entries.append( self.peekEntry() )
+            self.head = None
+        self.size -= count
+        return entries
+
+    def unget( self, entries ):
+        """
+        Put entries back in front of their queues.
+        """
+        for entry in reversed( entries ):
+            self.queues[entry[1]].appendleft( entry )
+        self.size += len( entries )
+
+    def empty( self ):
+        return self.size == 0
+
+    def qsize( self ):
+        return self.size
 
 #=========================================================================#
 class VirtualChannel( object ):
@@ -195,6 +310,22 @@ class VirtualChannel( object ):
         """
         return self.serial.port
 
+    def statistics( self ):
+        """
+        Return a dictionary of statistics about this channel.
+
+        The default implementation returns an empty dictionary.
+        """
+        return {}
+
+    def waitHistograms( self ):
+        """
+        Return a dictionary of queue wait histograms per priority class.
+
+        The default implementation returns an empty dictionary.
+        """
+        return {}
+
     #
     # hooks
     #
@@ -300,6 +431,10 @@ class QueuedVirtualChannel( VirtualChannel ):
 
     When the response arrives, the next command is taken out of the queue.
     If there are no more commands, the 'ready-to-send' watch is removed.
+
+    With batching enabled, extended commands waiting at the head of the queue
+    are joined into a single ';' separated command line, and the response is
+    split up again by the prefixes of the individual commands.
     """
 
     def __init__( self, *args, **kwargs ):
@@ -307,14 +442,33 @@ class QueuedVirtualChannel( VirtualChannel ):
         Initialize.
         """
         VirtualChannel.__init__( self, *args, **kwargs )
-        self.q = PeekholeQueue()
+        self.q = PriorityPeekholeQueue( COMMAND_CLASSES )
         self.installParser()
 
         self.watchTimeout = None
 
-        self.timeout = kwargs.get( "timeout", DEFAULT_CHANNEL_TIMEOUT )
-
-        logger.info( "%s: Creating channel with timeout = %d seconds", self, self.timeout )
+        self.commandTimeout = None
+        # a configured class timeout wins over the default of the channel
+        self.timeouts = {}
+        for klass in COMMAND_CLASSES:
+            if COMMAND_TIMEOUTS[klass] is not None:
+                self.timeouts[klass] = COMMAND_TIMEOUTS[klass]
+            else:
+                self.timeouts[klass] = kwargs.get( "timeout", DEFAULT_CHANNEL_TIMEOUT )
+
+        self.batching = kwargs.get( "batching", BATCH_COMMANDS )
+        self.batchSize = kwargs.get( "batchsize", BATCH_SIZE )
+
+        self.sent = 0
+        self.sentCommands = 0
+        self.batchedCommands = 0
+        self.retriedCommands = 0
+        self.maxQueueDepth = 0
+        self.busyTime = 0.0
+        self.sendTime = None
+        self.waitCounts = dict( [ ( klass, [ 0 ] * ( len( WAIT_HISTOGRAM_BOUNDS ) + 1 ) ) for klass in COMMAND_CLASSES ] )
+
+        logger.info( "%s: Creating channel with timeouts = %s, batching = %s", self, self.timeouts, self.batching )
 
     def installParser( self ):
         """
@@ -324,9 +478,11 @@ class QueuedVirtualChannel( VirtualChannel ):
         """
         self.parser = parser.LowlevelAtParser( self._handleResponseToRequest, self._handleUnsolicitedResponse )
 
-    def enqueue( self, data, response_cb=None, error_cb=None, prefixes=None ):
+    def enqueue( self, data, response_cb=None, error_cb=None, prefixes=None, priority=None ):
         """
         Enqueue data block for sending over the channel.
+
+        The priority class is derived from the command, if not given.
         """
 
         if prefixes is None:
@@ -338,7 +494,8 @@ class QueuedVirtualChannel( VirtualChannel ):
 
         if type( data ) == types.UnicodeType:
             data = str( data )
-        self.q.put( ( data, response_cb, error_cb, prefixes ) )
+        self.q.put( ( data, response_cb, error_cb, prefixes ), priority or commandClass( data ) )
+        self.maxQueueDepth = max( self.maxQueueDepth, self.q.qsize() )
         if not self.connected:
             return
         if self.q.qsize() == 1 and not self.watchReadyToSend:
@@ -348,7 +505,7 @@ class QueuedVirtualChannel( VirtualChannel ):
         """
         Return the number of pending commands.
         """
-        return len( self.q.queue )
+        return self.q.qsize()
 
     def isWaitingForResponse( self ):
         """
@@ -366,6 +523,12 @@ class QueuedVirtualChannel( VirtualChannel ):
 
         return self.q.peek()[3]
 
+    def currentTimeout( self ):
+        """
+        Return the timeout for the command in execution.
+        """
+        return self.timeouts[self.q.peekEntry()[1]]
+
     def cancelCurrentCommand( self ):
         """
         Cancel the command currently in process.
@@ -382,11 +545,40 @@ class QueuedVirtualChannel( VirtualChannel ):
             self.watchReadyToSend = None
             return False
 
+        if self.batching:
+            commands = self._batchQueuedCommands()
+        else:
+            commands = 1
+        self.sent += 1
+        self.sentCommands += commands
+        self.sendTime = time.time()
+        self._accountWaitTime( self.q.peekEntry() )
+
         logger.debug( "%s: sending %d bytes: %s" % ( repr(self), len(self.q.peek()[0]), repr(self.q.peek()[0]) ) )
         self._lowlevelWrite( self.q.peek()[0] ) # 0 = request data
-        self.watchTimeout = gobject.timeout_add_seconds( self.timeout, self._handleCommandTimeout )
+        self.commandTimeout = self.currentTimeout()
+        self.watchTimeout = gobject.timeout_add_seconds( self.commandTimeout, self._handleCommandTimeout )
         return False
 
+    def statistics( self ):
+        """
+        Reimplemented to return the command throughput and queue depth.
+        """
+        return { "queue-depth": self.q.qsize(),
+                 "max-queue-depth": self.maxQueueDepth,
+                 "commands": self.sentCommands,
+                 "command-lines": self.sent,
+                 "batched-commands": self.batchedCommands,
+                 "retried-commands": self.retriedCommands,
+                 "commands-per-second": self.sentCommands / self.busyTime if self.busyTime else 0.0 }
+
+    def waitHistograms( self ):
+        """
+        Return the histograms of the time commands of each priority class
+        spent in the queue. The buckets are bounded by WAIT_HISTOGRAM_BOUNDS.
+        """
+        return dict( [ ( klass, list( histogram ) ) for klass, histogram in self.waitCounts.items() ] )
+
     def readyToRead( self, data ):
         """
         Reimplemented for internal purposes.
@@ -395,7 +587,7 @@ class QueuedVirtualChannel( VirtualChannel ):
         # restart timeout //FIXME: only if we were waiting for a response?
         if self.watchTimeout is not None:
             gobject.source_remove( self.watchTimeout )
-            self.watchTimeout = gobject.timeout_add_seconds( self.timeout, self._handleCommandTimeout )
+            self.watchTimeout = gobject.timeout_add_seconds( self.commandTimeout, self._handleCommandTimeout )
         self.parser.feed( data, self.isWaitingForResponse(), self.validPrefixes() )
 
     def handleUnsolicitedResponse( self, response ):
@@ -440,11 +632,92 @@ class QueuedVirtualChannel( VirtualChannel ):
             logger.debug( "%s: TIMEOUT '%s' => ???" % ( repr(self), reqstring.strip() ) )
         else:
             logger.debug( "%s: TIMEOUT '%s' => ???" % ( repr(self), reqstring.strip() ) )
-            error_cb( reqstring.strip(), ( "timeout", self.timeout ) )
+            error_cb( reqstring.strip(), ( "timeout", self.commandTimeout ) )
 
     #
     # private API
     #
+    def _batchQueuedCommands( self ):
+        """
+        Join the compatible commands at the head of the queue into a single
+        command line. Returns the number of commands the head of the queue
+        now stands for.
+        """
+        entries = []
+        commands = []
+        prefixes = set()
+        for entry in self.q.entries():
+            if len( entries ) == self.batchSize:
+                break
+            if entry[3]:
+                # retrying a command of a failed batch on its own
+                break
+            request = entry[0]
+            match = BATCHABLE.match( request[0] )
+            if match is None or match.group( "name" ) in UNBATCHABLE:
+                break
+            # we need distinct prefixes to split the response
+            requestprefixes = set( request[3] )
+            if not requestprefixes or "" in requestprefixes or "PDU" in requestprefixes:
+                break
+            if [ 1 for new in requestprefixes for old in prefixes if new.startswith( old ) or old.startswith( new ) ]:
+                break
+            entries.append( entry )
+            commands.append( match.group( "command" ) )
+            prefixes.update( requestprefixes )
+
+        if len( entries ) < 2:
+            return 1
+
+        self.q.take( len( entries ) )
+        for entry in entries:
+            self._accountWaitTime( entry )
+        batch = ( "AT%s\r\n" % ";".join( commands ),
+                  lambda request, response: self._handleBatchResponse( entries, response ),
+                  lambda request, error: self._handleBatchError( entries, error ),
+                  prefixes )
+        # entries are in queue order, so the first one is of the most urgent class
+        self.q.unget( [ [ batch, entries[0][1], None, True ] ] )
+        self.batchedCommands += len( entries )
+        return len( entries )
+
+    def _handleBatchResponse( self, entries, response ):
+        """
+        Called, when the response to a command line joined from several commands has been parsed.
+        """
+        if response[-1] != "OK":
+            # the modem stops at the first failing command, but we do not know which
+            # one that was, hence we send all of them again one by one
+            logger.debug( "%s: batch failed with %s, retrying %d commands one by one" % ( repr(self), response[-1], len( entries ) ) )
+            for entry in entries:
+                entry[3] = True
+            self.q.unget( entries )
+            self.sentCommands -= len( entries )
+            self.retriedCommands += len( entries )
+            return
+
+        requests = [ entry[0] for entry in entries ]
+
+        responses = [ [] for request in requests ]
+        current = 0
+        for line in response[:-1]:
+            for index, request in enumerate( requests ):
+                if [ prefix for prefix in request[3] if line.startswith( prefix ) ]:
+                    current = index
+                    break
+            # lines without prefix (e.g. PDUs) belong to the previous line
+            responses[current].append( line )
+        for request, lines in zip( requests, responses ):
+            lines.append( response[-1] )
+            self.handleResponseToRequest( request, lines )
+
+    def _handleBatchError( self, entries, error ):
+        """
+        Called, when a command line joined from several commands timed out.
+        """
+        for entry in entries:
+            self.handleCommandTimeout( entry[0] )
+
     def _handleCommandCancellation( self ):
         """
         Called, when the current command should be cancelled.
@@ -485,6 +758,7 @@ class QueuedVirtualChannel( VirtualChannel ):
         if self.watchTimeout is not None:
             gobject.source_remove( self.watchTimeout )
             self.watchTimeout = None
+        self._updateBusyTime()
         # handle response
         request = self.q.get()
         self.handleResponseToRequest( request, response )
@@ -503,12 +777,30 @@ class QueuedVirtualChannel( VirtualChannel ):
         """
         self.watchTimeout = None
         self.serial.write( "\x1A" )
+        self._updateBusyTime()
         self.handleCommandTimeout( self.q.get() )
         # relaunch
         if not self.watchReadyToSend:
             self.watchReadyToSend = gobject.io_add_watch( self.serial.fd, gobject.IO_OUT, self._readyToSend, priority=PRIORITY_RTS )
         return False
 
+    def _accountWaitTime( self, entry ):
+        """
+        Account the time a queue entry has been waiting to be sent, once.
+        """
+        if entry[2] is not None:
+            waited = ( time.time() - entry[2] ) * 1000
+            self.waitCounts[entry[1]][bisect.bisect_left( WAIT_HISTOGRAM_BOUNDS, waited )] += 1
+            entry[2] = None
+
+    def _updateBusyTime( self ):
+        """
+        Account the time the current command line has been waiting for its response.
+        """
+        if self.sendTime is not None:
+            self.busyTime += time.time() - self.sendTime
+            self.sendTime = None
+
 #=========================================================================#
 class DelegateChannel( QueuedVirtualChannel ):
 #=========================================================================#
@@ -533,6 +825,14 @@ class DelegateChannel( QueuedVirtualChannel ):
                            'N': 'N',
                          }
         self.delegate = None
+        self.handlers = {}
+
+        self.unsolicitedCounts = {}
+        self.coalescedCount = 0
+        self.coalesceWindow = UNSOLICITED_COALESCE_WINDOW
+        self.coalesced = {}
+        self.coalescedOrder = []
+        self.watchCoalesced = None
 
     def setDelegate( self, object ):
         """
@@ -542,6 +842,115 @@ class DelegateChannel( QueuedVirtualChannel ):
             logger.warning( "delegate already set. Ignoring" )
             return
         self.delegate = object
+        self.handlers = {}
+
+    def close( self ):
+        """
+        Reimplemented to drop pending coalesced unsolicited responses.
+        """
+        if self.watchCoalesced is not None:
+            gobject.source_remove( self.watchCoalesced )
+            self.watchCoalesced = None
+        self.coalesced = {}
+        self.coalescedOrder = []
+        return QueuedVirtualChannel.close( self )
+
+    def statistics( self ):
+        """
+        Reimplemented to add the number of unsolicited responses per command.
+        """
+        result = QueuedVirtualChannel.statistics( self )
+        for command, count in self.unsolicitedCounts.items():
+            result["unsolicited:%s" % command] = count
+        result["unsolicited-coalesced"] = self.coalescedCount
+        return result
+
+    def _handler( self, command ):
+        """
+        Return ( bound method, arity ) for an unsolicited command or None,
+        if the delegate can't handle it. Method names are resolved once per
+        delegate class.
+        """
+        try:
+            return self.handlers[command]
+        except KeyError:
+            pass
+        klass = self.delegate.__class__
+        table = DISPATCH_TABLES.setdefault( klass, {} )
+        try:
+            methodname, arity = table[command]
+        except KeyError:
+            # convert unsolicited command to a method name
+            methodname = command.replace( ' ', '_' ) # no spaces in Python identifiers
+            methodname = "%s%s" % ( self.prefixmap[methodname[0]], methodname[1:] ) # no special characters
+            method = getattr( klass, methodname, None )
+            if method is None:
+                methodname = arity = None
+            else:
+                arity = self._arity( method )
+            if len( table ) < DISPATCH_TABLE_SIZE:
+                table[command] = methodname, arity
+        if methodname is None:
+            handler = None
+        else:
+            handler = getattr( self.delegate, methodname ), arity
+        if len( self.handlers ) < DISPATCH_TABLE_SIZE:
+            self.handlers[command] = handler
+        return handler
+
+    def _arity( self, method ):
+        """
+        Return the minimum and maximum number of arguments of an unsolicited
+        handler (the values and the PDU), None if unknown.
+        """
+        function = getattr( method, "im_func", method )
+        try:
+            args, varargs, varkw, defaults = inspect.getargspec( function )
+        except TypeError: # not a python function
+            return None
+        if varargs is not None:
+            return None
+        return len( args ) - 1 - len( defaults or () ), len( args ) - 1
+
+    def _dispatch( self, command, values, response ):
+        handler = self._handler( command )
+        if handler is None:
+            # no appropriate handler found, hand over to generic handler
+            return self.handleUnsolicitedResponse( response[0] )
+        method, arity = handler
+        # unsolicited data contains a PDU?
+        hasPdu = len( response ) == 2
+        if arity is not None and not arity[0] <= 1 + hasPdu <= arity[1]:
+            logger.warning( "(ignoring) unsolicited response %s does not match its handler: %s", command, repr(response) )
+            return False
+        try:
+            if hasPdu:
+                method( values.strip(), response[1] )
+            else:
+                method( values.strip() )
+        except Exception, e:
+            logger.exception( "(ignoring) unhandled exception in unsolicited response handler: %s" % e )
+            return False
+        return True # unsolicited response handled OK
+
+    def _coalesce( self, command, values, response ):
+        if command in self.coalesced:
+            self.coalescedCount += 1
+        else:
+            self.coalescedOrder.append( command )
+        self.coalesced[command] = values, response
+        if self.watchCoalesced is None:
+            self.watchCoalesced = gobject.timeout_add( self.coalesceWindow, self._handleCoalesced )
+        return True
+
+    def _handleCoalesced( self ):
+        self.watchCoalesced = None
+        coalesced, self.coalesced = self.coalesced, {}
+        order, self.coalescedOrder = self.coalescedOrder, []
+        for command in order:
+            values, response = coalesced[command]
+            self._dispatch( command, values, response )
+        return False # don't call me again
 
     def _handleUnsolicitedResponse( self, response ):
         """
@@ -564,27 +973,15 @@ class DelegateChannel( QueuedVirtualChannel ):
             return False
         command, values = data.split( ':', 1 )
 
-        # convert unsolicited command to a method name
-        command = command.replace( ' ', '_' ) # no spaces in Python identifiers
-        methodname = "%s%s" % ( self.prefixmap[command[0]], command[1:] ) # no special characters
-
         try:
-            method = getattr( self.delegate, methodname )
-        except AttributeError:
-            # no appropriate handler found, hand over to generic handler
-            return self.handleUnsolicitedResponse( data )
-        else:
-            try:
-                if len( response ) == 2:
-                    # unsolicited data contains a PDU
-                    method( values.strip(), response[1] )
-                else:
-                    method( values.strip() )
-            except Exception, e:
-                logger.exception( "(ignoring) unhandled exception in unsolicited response handler: %s" % e )
-                return False
+            self.unsolicitedCounts[command] += 1
+        except KeyError:
+            if len( self.unsolicitedCounts ) < DISPATCH_TABLE_SIZE:
+                self.unsolicitedCounts[command] = 1
 
-        return True # unsolicited response handled OK
+        if self.coalesceWindow and command in COALESCIBLE_UNSOLICITED:
+            return self._coalesce( command, values, response )
+        return self._dispatch( command, values, response )
 
 #=========================================================================#
 class AtCommandChannel( DelegateChannel ):
@@ -595,7 +992,7 @@ class AtCommandChannel( DelegateChannel ):
     Commands are prefixed according to v25ter. Multiline commands are handled.
     """
 
-    def enqueue( self, command, response_cb=None, error_cb=None, prefixes=None ):
+    def enqueue( self, command, response_cb=None, error_cb=None, prefixes=None, priority=None ):
         """
         Enqueue a single line or multiline command. Multiline commands have
         a '\r' (NOT '\r\n') embedded after the first line.
@@ -603,11 +1000,13 @@ class AtCommandChannel( DelegateChannel ):
         commands = command.split( '\r', 1 )
 
         if len( commands ) == 1:
-            QueuedVirtualChannel.enqueue( self, "AT%s\r\n" % command, response_cb, error_cb, prefixes )
+            QueuedVirtualChannel.enqueue( self, "AT%s\r\n" % command, response_cb, error_cb, prefixes, priority )
 
         elif len( commands ) == 2:
-            QueuedVirtualChannel.enqueue( self, "AT%s\r" % commands[0], self.onMultilineCommandResponse, self.onMultilineCommandError, prefixes )
-            QueuedVirtualChannel.enqueue( self, "%s\x1A" % commands[1], response_cb, error_cb, prefixes )
+            # both lines need to be in the same queue
+            priority = priority or commandClass( "AT%s\r" % commands[0] )
+            QueuedVirtualChannel.enqueue( self, "AT%s\r" % commands[0], self.onMultilineCommandResponse, self.onMultilineCommandError, prefixes, priority )
+            QueuedVirtualChannel.enqueue( self, "%s\x1A" % commands[1], response_cb, error_cb, prefixes, priority )
 
     def onMultilineCommandResponse( self, request, response ):
         if response != []:
@@ -17,7 +17,20 @@ GSM conversion functions.
 from datetime import datetime
 from const import GSMALPHABET, GSMEXTBYTE, GSMEXTALPHABET, \
     PDUADDR_ENC_TRANS, PDUADDR_DEC_TRANS
-from codecs import register, CodecInfo
+from codecs import register, CodecInfo, charmap_encode, charmap_decode
+from binascii import hexlify, unhexlify
+from array import array
+
+#
+# lookup tables for the GSM default alphabet, built once
+#
+
+# maps unicode ordinals to GSM bytes (extension plane: escape byte + character),
+# the basic plane takes precedence and the first occurence of a character wins
+GSM_ENCODE_MAP = dict( ( ord( char ), chr( GSMEXTBYTE ) + chr( index ) ) for index, char in reversed( list( enumerate( GSMEXTALPHABET ) ) ) )
+GSM_ENCODE_MAP.update( ( ord( char ), chr( index ) ) for index, char in reversed( list( enumerate( GSMALPHABET ) ) ) )
+# charmap decoding table for the basic plane, u'\ufffe' marks undefined bytes
+GSM_DECODE_TABLE = GSMALPHABET[:256] + u'\ufffe' * ( 256 - len( GSMALPHABET ) )
 
 #=========================================================================#
 def flatten(x):
@@ -110,44 +123,35 @@ def encodePDUTime(timeobj):
 #=========================================================================#
 def gsm_default_encode( input, errors = 'strict' ):
 #=========================================================================#
-        result = []
-        for char in input:
-            try:
-                result.append( GSMALPHABET.index( char ) )
-            except ValueError:
-                try:
-                    extbyte = GSMEXTALPHABET.index( char )
-                    result.append( GSMEXTBYTE )
-                    result.append( extbyte )
-                except ValueError:
-                    raise UnicodeError
-                    if errors == 'strict': raise UnicodeError,"invalid SMS character"
-                    elif errors == 'replace': result.append(chr(0x3f)) #question mark
-                    elif errors == 'ignore': pass
-                    else: raise UnicodeError, "unknown error handling"
-        return ''.join( map(chr, result) ), len( input )
+        try:
+            return charmap_encode( input, errors, GSM_ENCODE_MAP )
+        except UnicodeEncodeError, e:
+            raise UnicodeError, "invalid SMS character %s" % repr( e.object[e.start] )
+
+#=========================================================================#
+def gsm_basic_decode( input ):
+#=========================================================================#
+        try:
+            return charmap_decode( input, 'strict', GSM_DECODE_TABLE )[0]
+        except UnicodeDecodeError, e:
+            raise UnicodeError, "character %i unknown in GSM basic plane" % ord( e.object[e.start] )
 
 #=========================================================================#
 def gsm_default_decode( input, error = 'strict' ):
 #=========================================================================#
-        extchar = False
-        result = []
-        for char in input:
-            byte = ord(char)
-            if byte == GSMEXTBYTE:
-                extchar = True
-                continue
-            if extchar:
-                extchar = False
+        input = str( input )
+        # every part but the first starts with the character following an
+        # escape byte; empty parts come from repeated or trailing escapes
+        parts = input.split( chr( GSMEXTBYTE ) )
+        result = [ gsm_basic_decode( parts[0] ) ]
+        for part in parts[1:]:
+            if part:
+                byte = ord( part[0] )
                 try:
-                    result += GSMEXTALPHABET[byte]
+                    result.append( GSMEXTALPHABET[byte] )
                 except IndexError, e:
                     raise UnicodeError, "character %i unknown in GSM extended plane" % (byte)
-            else:
-                try:
-                    result += GSMALPHABET[byte]
-                except IndexError, e:
-                    raise UnicodeError, "character %i unknown in GSM basic plane" % (byte)
+                result.append( gsm_basic_decode( part[1:] ) )
         return u"".join( result ), len(input)
 
 #=========================================================================#
@@ -160,75 +164,105 @@ def gsmcodec(name):
 
 register( gsmcodec )
 
+#
+# Septets are packed little endian, i.e. the packed data of n bytes is the
+# number sum( byte[i] << 8*i ) and septet j is bits 7*j to 7*j+6 of it.
+# Instead of shifting every single character into place, the whole user data
+# is converted into one long integer and all septets are moved at once: in
+# every step, each block of septets is split into halves and the upper half
+# is shifted by one bit per septet it contains.
+#
+
+_SEPTET_MASKS = {}
+
+#=========================================================================#
+def _septet_masks( count ):
+#=========================================================================#
+    """Returns the (mask, shift) steps to spread count septets to bytes"""
+    units = 1
+    while units < count:
+        units *= 2
+    try:
+        return _SEPTET_MASKS[units]
+    except KeyError:
+        steps = []
+        half = units / 2
+        while half:
+            # blocks of 2*half septets, 16*half bits wide when spread
+            lower = ( 1 << 7 * half ) - 1
+            mask = 0
+            for block in xrange( units / half / 2 ):
+                mask |= lower << ( block * 16 * half )
+            steps.append( ( mask, half ) )
+            half /= 2
+        _SEPTET_MASKS[units] = steps
+        return steps
+
 #=========================================================================#
 def unpack_sevenbit( bs, chop = 0 ):
 #=========================================================================#
     """Unpack 7-bit characters"""
-    result = []
-    offset = (7 - chop) % 7
-    carry = 0
-    for b in bs:
-        if not chop:
-            result.append( carry | (b & (0xff >> offset + 1)) << offset )
-        else:
-            chop = 0
-        if offset == 6:
-            result.append( b >> 1 )
-            carry = offset = 0
-        else:
-            carry = b >> 7 - offset
-            offset += 1
-    return "".join( map(chr, result) )
+    data = bytearray( bs )
+    count = ( 8 * len( data ) - chop ) / 7
+    if count <= 0:
+        return ""
+    data.reverse()
+    value = ( int( hexlify( data ), 16 ) >> chop ) & ( ( 1 << 7 * count ) - 1 )
+    for mask, shift in _septet_masks( count ):
+        lower = value & mask
+        value = lower | ( value ^ lower ) << shift
+    return unhexlify( "%0*x" % ( 2 * count, value ) )[::-1]
 
 #=========================================================================#
 def pack_sevenbit( text, crop=0 ):
 #=========================================================================#
     """Pack 7-bit characters"""
-    bs = [ 0 ] + map( ord, text ) + [ 0 ]
-    result = []
-    shift = 7 - crop
-    for i in range(len(bs)-1):
-        if shift == 7:
-            shift = 0
-            continue
-
-        ch1 = bs[i] & 0x7F
-        ch1 = ch1 >> shift
-        ch2 = bs[(i+1)] & 0x7F
-        ch2 = ch2 << (7-shift)
-
-        result.append( ( ch1 | ch2 ) & 0xFF )
+    count = len( text )
+    length = ( 7 * count + crop + 7 ) / 8
+    if not count:
+        return [ 0 ] * length
+    data = bytearray( text )
+    data.reverse()
+    value = int( hexlify( data ), 16 ) & int( "7f" * count, 16 )
+    for mask, shift in reversed( _septet_masks( count ) ):
+        lower = value & mask
+        value = lower | ( value ^ lower ) >> shift
+    return list( bytearray( unhexlify( "%0*x" % ( 2 * length, value << crop ) ) )[::-1] )
 
-        shift += 1
+#=========================================================================#
+def hex_decode( pdu ):
+#=========================================================================#
+    """Converts a string of hex digits into an array of bytes"""
+    try:
+        return array( 'B', unhexlify( pdu ) )
+    except TypeError:
+        # odd length or no hex digits, let int() decide like it always did
+        return array( 'B', [ int( pdu[i:i+2], 16 ) for i in range( 0, len(pdu), 2 ) ] )
 
-    return result
+#=========================================================================#
+def hex_encode( bytes ):
+#=========================================================================#
+    """Converts a sequence of bytes into a string of hex digits"""
+    return hexlify( bytearray( bytes ) ).upper()
 
 #=========================================================================#
 def ira_pdu_to_string( pdu ):
 #=========================================================================#
-    bytes = [ int( pdu[ i:i+2 ], 16 ) for i in range( 0, len(pdu), 2 ) ]
-    return unpack_sevenbit( bytes ).strip()
+    return unpack_sevenbit( hex_decode( pdu ) ).strip()
 
 #=========================================================================#
 def ucs2hexToUnicode( text, errors="strict" ):
 #=========================================================================#
-    bytes = []
-    for i in range( 0, len(text), 2 ):
-        try:
-            bytes.append( int( text[i:i+2], 16 ) )
-        except ValueError:
-            raise UnicodeError
-            if errors == 'strict': raise UnicodeError,"invalid PDU Byte"
-            elif errors == 'replace': bytes.append(0) # replace with 0
-            elif errors == 'ignore': bytes.append(0)
-            else: raise UnicodeError, "unknown error handling"
-    return "".join( map( chr, bytes ) ).decode("utf_16_be") , len(text)
+    try:
+        bytes = hex_decode( text )
+    except ValueError:
+        raise UnicodeError, "invalid PDU Byte"
+    return bytes.tostring().decode("utf_16_be") , len(text)
 
 #=========================================================================#
 def UnicodeToucs2hex( text, errors="strict" ):
 #=========================================================================#
-    bytes = map( ord, text.encode("utf_16_be") )
-    return "".join( ( "%02X" % i for i in bytes) ), len(text)
+    return hexlify( text.encode("utf_16_be") ).upper(), len(text)
 
 #=========================================================================#
 if __name__ == "__main__":
@@ -12,7 +12,7 @@ Module: parser
 
 __version__ = "0.8.5.2"
 
-import os
+import os, re
 DEBUG = os.environ.get( "FSO_DEBUG_PARSER", False )
 
 #=========================================================================#
@@ -238,11 +238,124 @@ class StateBasedLowlevelAtParser( object ):
             return self.state_inline
 
 #=========================================================================#
-LowlevelAtParser = StateBasedLowlevelAtParser
+class ChunkedLowlevelAtParser( StateBasedLowlevelAtParser ):
 #=========================================================================#
+    """
+    A lowlevel AT response parser that assembles lines chunk-wise.
+
+    It is a drop-in replacement for the StateBasedLowlevelAtParser and
+    uses the very same states and line completion logic, but while
+    inside of a line it scans the whole buffer for the next quote or
+    line terminator instead of dispatching every single byte. The quote
+    parity of the current line is tracked incrementally, so assembling
+    a line is linear in its length.
+    """
+
+    delimiters = re.compile( '["\r\n]' )
+
+    def reset( self, yankSolicited=True, keepPrefixes=False ):
+        self.quoted = 0
+        self.quotedLine = ""
+        return StateBasedLowlevelAtParser.reset( self, yankSolicited, keepPrefixes )
+
+    def feed( self, bytes, haveCommand, validPrefixes ):
+        self.haveCommand = haveCommand
+        self.validPrefixes = self.continuationPrefixes.union(validPrefixes)
 
+        if bytes == "\r\n> ":
+            if DEBUG: print "PARSER DEBUG: got continuation character. sending empty response"
+            self.response( [] )
+            self.state = self.reset( keepPrefixes=True )
+            return
+
+        inline = self.state_inline
+        pos = 0
+        end = len( bytes )
+        while pos < end:
+            if self.state == inline:
+                pos, nextstate = self.scanLine( bytes, pos )
+                if nextstate is None:
+                    b = bytes[pos-1]
+            else:
+                b = bytes[pos]
+                if DEBUG: print "PARSER DEBUG: [%s] feeding %s to %s" % ( ( "solicited" if self.haveCommand else "unsolicited" ), repr(b), self.state )
+                nextstate = self.state( b )
+                pos += 1
+
+            if nextstate is None:
+                print "PARSER DEBUG: WARNING: UNDEFINED PARSER STATE! Do not know where to go from %s upon receiving %s" % ( self.state, repr(b) )
+                print "previous bytes were:", repr(bytes)
+                print "current byte is:", repr(b)
+                print "lines:", repr(self.lines)
+                print "curline:", repr(self.curline)
+                print "solicited:", self.haveCommand
+                self.state = self.reset()
+                break
+            else:
+                self.state = nextstate
+
+    def scanLine( self, bytes, pos ):
+        """
+        Append bytes to the current line up to the next line terminator
+        outside of quotes. Returns the position after the consumed bytes
+        and the next state.
+        """
+        line = self.curline
+        # the parity is only valid for the line we computed it for
+        if line is self.quotedLine:
+            quoted = self.quoted
+        else:
+            quoted = line.count( '"' ) % 2
+
+        end = len( bytes )
+        while pos < end:
+            if quoted:
+                index = bytes.find( '"', pos )
+                if index == -1:
+                    line += bytes[pos:]
+                    pos = end
+                else:
+                    line += bytes[pos:index+1]
+                    pos = index + 1
+                    quoted = 0
+                continue
+
+            match = self.delimiters.search( bytes, pos )
+            if match is None:
+                line += bytes[pos:]
+                pos = end
+                continue
+
+            index = match.start()
+            if bytes[index] == '"':
+                line += bytes[pos:index+1]
+                pos = index + 1
+                quoted = 1
+                continue
+
+            self.curline = line + bytes[pos:index]
+            if DEBUG: print "PARSER DEBUG: [%s] scanned %s up to %s" % ( ( "solicited" if self.haveCommand else "unsolicited" ), repr(self.curline), repr(bytes[index]) )
+            if bytes[index] == '\r':
+                return index + 1, self.carriageReturn()
+            # usually this should not happen, but some SMS are badly formatted
+            return index + 1, self.lineCompleted()
+
+        self.curline = self.quotedLine = line
+        self.quoted = quoted
+        return pos, self.state_inline
+
+    def carriageReturn( self ):
+        """
+        Called for a '\r' terminating the current line outside of quotes.
+        """
+        return self.state_inline_r
+
+#=========================================================================#
+LowlevelAtParser = ChunkedLowlevelAtParser
 #=========================================================================#
-class QualcommGsmViolationParser( StateBasedLowlevelAtParser ):
+
+#=========================================================================#
+class StateBasedQualcommGsmViolationParser( StateBasedLowlevelAtParser ):
 #=========================================================================#
     """
     The HTC modems violate v250.ter AT format specification. Although v1 is
@@ -268,6 +381,22 @@ class QualcommGsmViolationParser( StateBasedLowlevelAtParser ):
             if b == '\n':
                 return self.lineCompleted()
 
+#=========================================================================#
+class QualcommGsmViolationParser( ChunkedLowlevelAtParser ):
+#=========================================================================#
+    """
+    The HTC modems violate v250.ter AT format specification. Although v1 is
+    set, they omit the '\n' as error termination. We need to check after
+    every \r whether it's a termination, since the error may not come.
+    """
+    def carriageReturn( self ):
+        if self.curline.startswith( "+CME ERROR" ) \
+        or self.curline.startswith( "+CMS ERROR" ) \
+        or self.curline.startswith( "+EXT ERROR" ):
+            return self.lineCompleted()
+        else:
+            return self.state_inline_r
+
 #=========================================================================#
 if __name__ == "__main__":
 #=========================================================================#
@@ -101,7 +101,7 @@ class SMS(object):
     def decode( cls, pdu, smstype ):
         # first convert the string into a bytestream
         try:
-            bytes = array('B', [ int( pdu[i:i+2], 16 ) for i in range(0, len(pdu), 2) ])
+            bytes = hex_decode( pdu )
         except ValueError:
             raise SMSError, "PDU malformed"
 
@@ -564,7 +564,7 @@ class SMSDeliver(SMS):
             pdubytes.extend( pduudh )
         pdubytes.extend( pduud )
 
-        return "".join( [ "%02X" % (i) for i in pdubytes ] )
+        return hex_encode( pdubytes )
 
 
     def __repr__( self ):
@@ -757,7 +757,7 @@ class SMSDeliverReport(SMS):
                 pdubytes.extend( pduudh )
             pdubytes.extend( pduud )
 
-        return "".join( [ "%02X" % (i) for i in pdubytes ] )
+        return hex_encode( pdubytes )
 
 
     def __repr__( self ):
@@ -976,7 +976,7 @@ class SMSSubmit(SMS):
             pdubytes.extend( pduudh )
         pdubytes.extend( pduud )
 
-        return "".join( [ "%02X" % (i) for i in pdubytes ] )
+        return hex_encode( pdubytes )
 
 
     def __repr__( self ):
@@ -1183,7 +1183,7 @@ class SMSSubmitReport(SMS):
                 pdubytes.extend( pduudh )
             pdubytes.extend( pduud )
 
-        return "".join( [ "%02X" % (i) for i in pdubytes ] )
+        return hex_encode( pdubytes )
 
 
     def __repr__( self ):
@@ -1497,7 +1497,7 @@ class SMSStatusReport(SMS):
                     pdubytes.extend( pduudh )
                 pdubytes.extend( pduud )
 
-        return "".join( [ "%02X" % (i) for i in pdubytes ] )
+        return hex_encode( pdubytes )
 
 
     def __repr__( self ):
@@ -1516,7 +1516,7 @@ class CellBroadcast(SMS):
     @classmethod
     def decode( cls, pdu):
         # first convert the string into a bytestream
-        bytes = [ int( pdu[i:i+2], 16 ) for i in range(0, len(pdu), 2) ]
+        bytes = hex_decode( pdu )
 
         cb = cls()
         cb.sn = bytes[0] << 8 | bytes[1]
@@ -32,12 +32,17 @@ from ogsmd.helpers import safesplit
 from ogsmd.modems import currentModem
 import ogsmd.gsm.sms
 
+from framework.config import config
+
 import gobject
 import re, time, calendar
 
 import logging
 logger = logging.getLogger( MODULE_NAME )
 
+# number of SIM records retrieved per command when streaming phonebooks and messagebooks
+SIM_WINDOW_SIZE = config.getInt( "ogsmd", "sim_window_size", 20 )
+
 #=========================================================================#
 class AbstractMediator( object ):
 #=========================================================================#
@@ -218,6 +223,55 @@ class SimMediator( AbstractMediator, AbstractYieldSupport ):
         self._commchannel = self._object.modem.communicationChannel( "SimMediator" )
         AbstractYieldSupport.__init__( self, *args, **kwargs )
 
+#=========================================================================#
+class SimCachedMediator( SimMediator ):
+#=========================================================================#
+    """
+    Base class for mediators using the SIM cache. Before cachedTrigger() is
+    called, the cache gets activated for the card by reading its ICCID.
+    If that fails, the cache stays inactive and the mediator reads from the SIM.
+
+    Note that only changes done while the cache is active can be tracked. The
+    cached phonebooks and messagebooks are therefore also checked against the
+    storage counts of the SIM before they are used.
+    """
+    def trigger( self ):
+        self._simcache = self._object.modem.simCache()
+        if self._simcache.needsIccid():
+            self._commchannel.enqueue( "+CRSM=176,12258,0,0,10", self.responseFromIccid, self.errorFromIccid )
+        else:
+            self.cachedTrigger()
+
+    def cachedTrigger( self ):
+        assert False, "pure virtual method called"
+
+    def responseFromIccid( self, request, response ):
+        iccid = None
+        if response[-1] == "OK":
+            try:
+                sw1, sw2, payload = safesplit( self._rightHandSide( response[0] ), "," )
+            except ValueError: # response did not include a payload
+                pass
+            else:
+                if int(sw1) == 144 and int(sw2) == 0:
+                    iccid = payload.strip( '"' )
+        if iccid:
+            self._simcache.activate( iccid )
+        else:
+            self._simcache.markUnavailable()
+        self.cachedTrigger()
+
+    def errorFromIccid( self, request, error ):
+        self._simcache.markUnavailable()
+        self.cachedTrigger()
+
+    def _markPhonebookEntryChanged( self, pbcategory, index ):
+        key = "phonebook:%s" % pbcategory
+        cached = self._simcache.get( key )
+        if cached is not None:
+            cached["dirty"].append( index )
+            self._simcache.set( key, cached )
+
 #=========================================================================#
 class SmsMediator( AbstractMediator, AbstractYieldSupport ):
 #=========================================================================#
@@ -709,10 +763,14 @@ class SimSendRestrictedSimCommand( SimMediator ):
             self._ok( *result )
 
 #=========================================================================#
-class SimGetHomeZones( SimMediator ): # a(siii)
+class SimGetHomeZones( SimCachedMediator ): # a(siii)
 #=========================================================================#
-    def trigger( self ):
-        self._commchannel.enqueue( "+CRSM=176,28512,0,0,123", self.responseFromChannel, self.errorFromChannel )
+    def cachedTrigger( self ):
+        result = self._simcache.get( "homezones" )
+        if result is not None:
+            self._ok( result )
+        else:
+            self._commchannel.enqueue( "+CRSM=176,28512,0,0,123", self.responseFromChannel, self.errorFromChannel )
 
     def addHomeZone( self, data, number, result ):
         #print data[0:52]
@@ -745,13 +803,18 @@ class SimGetHomeZones( SimMediator ): # a(siii)
                 result = []
                 for i in xrange( 4 ):
                     self.addHomeZone( payload[34+52*i:34+52*(i+1)], i+1, result )
+                self._simcache.set( "homezones", result )
                 self._ok( result )
 
 #=========================================================================#
-class SimGetIssuer( SimMediator ): # s
+class SimGetIssuer( SimCachedMediator ): # s
 #=========================================================================#
-    def trigger( self ):
-        self._commchannel.enqueue( "+CRSM=176,28486,0,0,17", self.responseFromChannel, self.errorFromChannel )
+    def cachedTrigger( self ):
+        name = self._simcache.get( "issuer" )
+        if name is not None:
+            self._ok( name )
+        else:
+            self._commchannel.enqueue( "+CRSM=176,28486,0,0,17", self.responseFromChannel, self.errorFromChannel )
 
     def responseFromChannel( self, request, response ):
         if response[-1] != "OK":
@@ -772,13 +835,18 @@ class SimGetIssuer( SimMediator ): # s
                         name += chr(c)
                     else:
                         break
+                self._simcache.set( "issuer", name )
                 self._ok( name )
 
 #=========================================================================#
-class SimGetProviderList( SimMediator ): # a{ss}
+class SimGetProviderList( SimCachedMediator ): # a{ss}
 #=========================================================================#
-    def trigger( self ):
-        self._commchannel.enqueue( "+COPN", self.responseFromChannel, self.errorFromChannel )
+    def cachedTrigger( self ):
+        result = self._simcache.get( "providers" )
+        if result is not None:
+            self._ok( result )
+        else:
+            self._commchannel.enqueue( "+COPN", self.responseFromChannel, self.errorFromChannel )
 
     def responseFromChannel( self, request, response ):
         if response[-1] != "OK":
@@ -797,6 +865,7 @@ class SimGetProviderList( SimMediator ): # a{ss}
                     # a problem with different charsets...
                     uname = "<undecodable>"
                 result[ mccmnc.strip( '" ').decode(charset) ] = uname
+            self._simcache.set( "providers", result )
             return self._ok( result )
 
 #=========================================================================#
@@ -880,9 +949,14 @@ class SimGetPhonebookStorageInfo( SimMediator ):
 
 
 #=========================================================================#
-class SimRetrievePhonebook( SimMediator ):
+class SimRetrievePhonebook( SimCachedMediator ):
 #=========================================================================#
-    def trigger( self ):
+    """
+    Retrieves the phonebook. With an active SIM cache, the phonebook is read
+    once and kept. Entries changed via ogsmd since are re-read one by one, the
+    cached phonebook is only used if it matches the storage counts of the SIM.
+    """
+    def cachedTrigger( self ):
         charset = currentModem()._charsets["DEFAULT"]
         try:
             self.pbcategory = const.PHONEBOOK_CATEGORY[self.category]
@@ -898,40 +972,149 @@ class SimRetrievePhonebook( SimMediator ):
             if minimum is None: # don't know yet
                 SimGetPhonebookInfo( self._object, self.tryAgain, self.reportError, category=self.category )
             else:
-                self._commchannel.enqueue( '+CPBS="%s";+CPBR=%d,%d' % ( self.pbcategory.encode(charset), minimum, maximum ), self.responseFromChannel, self.errorFromChannel )
+                self._retrieve( minimum, maximum )
 
     @logged
     def responseFromChannel( self, request, response ):
-        defcharset = currentModem()._charsets["DEFAULT"]
-        charset = currentModem()._charsets["PHONEBOOK"]
         if response[-1] != "OK":
             SimMediator.responseFromChannel( self, request, response )
         else:
-            result = []
-            for entry in response[:-1]:
-                index, number, ntype, name = safesplit( self._rightHandSide( entry ), ',' )
-                index = int( index )
-                number = number.strip( '"' ).decode(defcharset)
-                ntype = int( ntype )
-                name = name.strip('"').decode(charset)
-                result.append( ( index, name, const.phonebookTupleToNumber( number, ntype ) ) )
+            result = [ self._decodeEntry( entry ) for entry in response[:-1] ]
+            # only a complete phonebook can be checked against the storage counts later
+            if self.storage is not None and ( self.minimum, self.maximum ) == self._object.modem.phonebookIndices( self.pbcategory ):
+                entries = dict( [ ( entry[0], entry ) for entry in result ] )
+                self._simcache.set( self._cacheKey(), { "total": self.storage[1], "entries": entries, "dirty": [] } )
             self._ok( result )
 
+    @logged
+    def responseFromStorage( self, request, response ):
+        if response[-1] == "OK":
+            try:
+                name, used, total = safesplit( self._rightHandSide( response[0] ), "," )
+                self.storage = ( int( used ), int( total ) )
+            except ValueError:
+                logger.warning( "can't parse phonebook storage info '%s'" % response[0] )
+        self.cached = self._simcache.get( self._cacheKey() )
+        if self.storage is None or self.cached is None or self.cached["total"] != self.storage[1]:
+            self._retrieveAll()
+        else:
+            self._refreshNext()
+
+    def errorFromStorage( self, request, error ):
+        self._retrieveAll()
+
+    def _refreshNext( self ):
+        if self.cached["dirty"]:
+            charset = currentModem()._charsets["DEFAULT"]
+            self._commchannel.enqueue( '+CPBS="%s";+CPBR=%d' % ( self.pbcategory.encode(charset), self.cached["dirty"][0] ), self.responseFromRefresh, self.errorFromRefresh )
+        elif len( self.cached["entries"] ) != self.storage[0]:
+            logger.info( "cached phonebook %s does not match the SIM, reading it again" % self.pbcategory )
+            self._retrieveAll()
+        else:
+            self._simcache.set( self._cacheKey(), self.cached )
+            entries = self.cached["entries"]
+            self._ok( [ entries[index] for index in sorted( entries ) if self.minimum <= index <= self.maximum ] )
+
+    @logged
+    def responseFromRefresh( self, request, response ):
+        index = self.cached["dirty"][0]
+        if response[-1] == "OK":
+            self.cached["entries"].pop( index, None )
+            for line in response[:-1]:
+                if line.startswith( "+CPBR" ):
+                    entry = self._decodeEntry( line )
+                    self.cached["entries"][entry[0]] = entry
+        elif response[-1] in ( "+CME ERROR: 22", "+CME ERROR: 21" ): # entry not found
+            self.cached["entries"].pop( index, None )
+        else:
+            self._retrieveAll()
+            return
+        # other mediators might have marked the same entry again meanwhile
+        self.cached["dirty"] = [ dirty for dirty in self.cached["dirty"] if dirty != index ]
+        self._refreshNext()
+
+    def errorFromRefresh( self, request, error ):
+        self._retrieveAll()
+
     def tryAgain( self, result ):
-        charset = currentModem()._charsets["DEFAULT"]
         minimum, maximum = self._object.modem.phonebookIndices( self.pbcategory )
         if minimum is None: # still?
             raise DBusError.InternalException( "can't get valid phonebook indices for phonebook %s from modem" % self.pbcategory )
         else:
-            self._commchannel.enqueue( '+CPBS="%s";+CPBR=%d,%d' % ( self.pbcategory.encode(charset), minimum, maximum ), self.responseFromChannel, self.errorFromChannel )
+            self._retrieve( minimum, maximum )
 
     def reportError( self, result ):
         self._error( result )
 
+    def _retrieve( self, minimum, maximum ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.storage = None
+        if self._simcache.isActive():
+            charset = currentModem()._charsets["DEFAULT"]
+            self._commchannel.enqueue( '+CPBS="%s";+CPBS?' % self.pbcategory.encode(charset), self.responseFromStorage, self.errorFromStorage )
+        else:
+            self._retrieveAll()
+
+    def _retrieveAll( self ):
+        charset = currentModem()._charsets["DEFAULT"]
+        self._commchannel.enqueue( '+CPBS="%s";+CPBR=%d,%d' % ( self.pbcategory.encode(charset), self.minimum, self.maximum ), self.responseFromChannel, self.errorFromChannel )
+
+    def _cacheKey( self ):
+        return "phonebook:%s" % self.pbcategory
+
+    def _decodeEntry( self, entry ):
+        defcharset = currentModem()._charsets["DEFAULT"]
+        charset = currentModem()._charsets["PHONEBOOK"]
+        index, number, ntype, name = safesplit( self._rightHandSide( entry ), ',' )
+        index = int( index )
+        number = number.strip( '"' ).decode(defcharset)
+        ntype = int( ntype )
+        name = name.strip('"').decode(charset)
+        return ( index, name, const.phonebookTupleToNumber( number, ntype ) )
+
 #=========================================================================#
-class SimDeleteEntry( SimMediator ):
+class SimStreamPhonebook( SimRetrievePhonebook ): # i
 #=========================================================================#
-    def trigger( self ):
+    """
+    Retrieves the phonebook in windows of SIM_WINDOW_SIZE indices. Entries are
+    delivered window by window via the PhonebookEntries signal, the reply is the
+    number of entries found.
+    """
+    def _retrieve( self, minimum, maximum ):
+        self.next = minimum
+        self.maximum = maximum
+        self.count = 0
+        self._retrieveWindow()
+
+    def _retrieveWindow( self ):
+        charset = currentModem()._charsets["DEFAULT"]
+        last = min( self.next + SIM_WINDOW_SIZE - 1, self.maximum )
+        self._commchannel.enqueue( '+CPBS="%s";+CPBR=%d,%d' % ( self.pbcategory.encode(charset), self.next, last ), self.responseFromChannel, self.errorFromChannel )
+        self.next = last + 1
+
+    @logged
+    def responseFromChannel( self, request, response ):
+        if response[-1] == "OK":
+            entries = [ self._decodeEntry( entry ) for entry in response[:-1] ]
+        elif response[-1] == "+CME ERROR: 22": # no entries in this window
+            entries = []
+        else:
+            SimMediator.responseFromChannel( self, request, response )
+            return
+
+        if entries:
+            self.count += len( entries )
+            self._object.PhonebookEntries( self.category, entries )
+        if self.next <= self.maximum:
+            self._retrieveWindow()
+        else:
+            self._ok( self.count )
+
+#=========================================================================#
+class SimDeleteEntry( SimCachedMediator ):
+#=========================================================================#
+    def cachedTrigger( self ):
         try:
             self.pbcategory = const.PHONEBOOK_CATEGORY[self.category]
         except KeyError:
@@ -939,10 +1122,15 @@ class SimDeleteEntry( SimMediator ):
         else:
             self._commchannel.enqueue( '+CPBS="%s";+CPBW=%d,,,' % ( self.pbcategory, self.index ), self.responseFromChannel, self.errorFromChannel )
 
+    def responseFromChannel( self, request, response ):
+        if response[-1] == "OK":
+            self._markPhonebookEntryChanged( self.pbcategory, self.index )
+        SimMediator.responseFromChannel( self, request, response )
+
 #=========================================================================#
-class SimStoreEntry( SimMediator ):
+class SimStoreEntry( SimCachedMediator ):
 #=========================================================================#
-    def trigger( self ):
+    def cachedTrigger( self ):
         charset = currentModem()._charsets["PHONEBOOK"]
         defcharset = currentModem()._charsets["DEFAULT"]
         try:
@@ -962,6 +1150,11 @@ class SimStoreEntry( SimMediator ):
             name = name.encode(charset)
             self._commchannel.enqueue( '+CPBS="%s";+CPBW=%d,"%s",%d,"%s"' % ( self.pbcategory.encode(defcharset), self.index, number, ntype, name ), self.responseFromChannel, self.errorFromChannel )
 
+    def responseFromChannel( self, request, response ):
+        if response[-1] == "OK":
+            self._markPhonebookEntryChanged( self.pbcategory, self.index )
+        SimMediator.responseFromChannel( self, request, response )
+
 #=========================================================================#
 class SimRetrieveEntry( SimMediator ):
 #=========================================================================#
@@ -992,10 +1185,14 @@ class SimRetrieveEntry( SimMediator ):
                     self._ok( name, const.phonebookTupleToNumber( number, ntype ) )
 
 #=========================================================================#
-class SimGetServiceCenterNumber( SimMediator ):
+class SimGetServiceCenterNumber( SimCachedMediator ):
 #=========================================================================#
-    def trigger( self ):
-        self._commchannel.enqueue( "+CSCA?", self.responseFromChannel, self.errorFromChannel )
+    def cachedTrigger( self ):
+        number = self._simcache.get( "service-center" )
+        if number is not None:
+            self._ok( number )
+        else:
+            self._commchannel.enqueue( "+CSCA?", self.responseFromChannel, self.errorFromChannel )
 
     @logged
     def responseFromChannel( self, request, response ):
@@ -1006,7 +1203,9 @@ class SimGetServiceCenterNumber( SimMediator ):
             else:
                 number, ntype = result, 145
             number = number.replace( '+', '' ) # normalize
-            self._ok( const.phonebookTupleToNumber( number.strip( '"' ), int(ntype) ) )
+            number = const.phonebookTupleToNumber( number.strip( '"' ), int(ntype) )
+            self._simcache.set( "service-center", number )
+            self._ok( number )
         else:
             SimMediator.responseFromChannel( self, request, response )
 
@@ -1028,15 +1227,54 @@ class SimGetMessagebookInfo( SimMediator ):
             self._ok( result )
 
 #=========================================================================#
-class SimRetrieveMessagebook( SimMediator ):
+class SimRetrieveMessagebook( SimCachedMediator ):
 #=========================================================================#
-    def trigger( self ):
+    """
+    Retrieves the messages of a category. With an active SIM cache, the result
+    is kept until the messagebook changes or the storage counts of the SIM differ.
+    """
+    def cachedTrigger( self ):
+        self.storage = None
         try:
-            category = const.SMS_PDU_STATUS_IN[self.category]
+            self.status = const.SMS_PDU_STATUS_IN[self.category]
         except KeyError:
             self._error( DBusError.InvalidParameter( "valid categories are %s" % const.SMS_PDU_STATUS_IN.keys() ) )
         else:
-            self._commchannel.enqueue( '+CMGL=%i' % category, self.responseFromChannel, self.errorFromChannel )
+            if self._simcache.isActive():
+                self._commchannel.enqueue( '+CPMS?', self.responseFromStorage, self.errorFromStorage )
+            else:
+                self._retrieveAll()
+
+    @logged
+    def responseFromStorage( self, request, response ):
+        if response[-1] == "OK":
+            values = safesplit( self._rightHandSide( response[0] ), ',' )
+            try:
+                self.storage = ( values[0].strip( '"' ), int( values[1] ), int( values[2] ) )
+            except ( IndexError, ValueError ):
+                logger.warning( "can't parse message storage info '%s'" % response[0] )
+        cached = self._simcache.get( "messagebook:%s" % self.category )
+        if self.storage is not None and cached is not None and cached["storage"] == self.storage:
+            self._ok( cached["messages"] )
+        else:
+            self._retrieveAll()
+
+    def errorFromStorage( self, request, error ):
+        self._retrieveAll()
+
+    def _retrieveAll( self ):
+        self._commchannel.enqueue( '+CMGL=%i' % self.status, self.responseFromChannel, self.errorFromChannel )
+
+    def _updateCache( self, result ):
+        # listing marks unread messages as read on the SIM
+        if [ 1 for message in result if message[1] == "unread" ]:
+            self._simcache.invalidate( "messagebook:" )
+        if self.storage is not None:
+            if self.category == "unread":
+                messages = []
+            else:
+                messages = [ ( index, "read" if status == "unread" else status, number, contents, properties ) for ( index, status, number, contents, properties ) in result ]
+            self._simcache.set( "messagebook:%s" % self.category, { "storage": self.storage, "messages": messages } )
 
     @logged
     def responseFromChannel( self, request, response ):
@@ -1071,14 +1309,15 @@ class SimRetrieveMessagebook( SimMediator ):
                         result.append( ( index, status, str(sms.addr), sms.ud, sms.properties ) )
                 else:
                     logger.warning( "SinRetrieveMessagebook encountered strange answer to AT+CMGL: '%s'" % line )
+            self._updateCache( result )
             self._ok( result )
         else:
             SimMediator.responseFromChannel( self, request, response )
 
 #=========================================================================#
-class SimRetrieveMessage( SimMediator ):
+class SimRetrieveMessage( SimCachedMediator ):
 #=========================================================================#
-    def trigger( self ):
+    def cachedTrigger( self ):
         self._commchannel.enqueue( '+CMGR=%d' % self.index, self.responseFromChannel, self.errorFromChannel )
 
     @logged
@@ -1097,6 +1336,8 @@ class SimRetrieveMessage( SimMediator ):
                       direction = "guess-deliver"
                     else:
                       direction = "guess-submit"
+                    if status == "unread": # has been marked as read now
+                        self._simcache.invalidate( "messagebook:" )
                     length = int(header.groupdict()["pdulen"])
                     inbody = True
                 elif inbody == True:
@@ -1110,17 +1351,134 @@ class SimRetrieveMessage( SimMediator ):
             self._ok( *result )
 
 #=========================================================================#
-class SimSetServiceCenterNumber( SimMediator ):
+class SimStreamMessagebook( SimCachedMediator ): # i
 #=========================================================================#
-    def trigger( self ):
+    """
+    Retrieves the messagebook. Messages are delivered in windows of
+    SIM_WINDOW_SIZE via the MessagebookEntries signal, the reply is the
+    number of messages found.
+
+    The "all" and "unread" categories are read one message at a time, which
+    marks unread messages as read, as listing them would. The other categories
+    are listed with +CMGL, so reading them doesn't touch unread messages.
+    """
+    def cachedTrigger( self ):
+        try:
+            self.status = const.SMS_PDU_STATUS_IN[self.category]
+        except KeyError:
+            self._error( DBusError.InvalidParameter( "valid categories are %s" % const.SMS_PDU_STATUS_IN.keys() ) )
+        else:
+            self._commchannel.enqueue( '+CPMS="SM","SM","SM"', self.responseFromStorage, self.errorFromChannel )
+
+    @logged
+    def responseFromStorage( self, request, response ):
+        if response[-1] != "OK":
+            SimMediator.responseFromChannel( self, request, response )
+        else:
+            afull, amax, bfull, bmax, cfull, cmax = safesplit( self._rightHandSide( response[0] ), ',' )
+            self.used = int( afull )
+            self.maximum = int( amax )
+            self.index = 0
+            self.seen = 0
+            self.count = 0
+            self.entries = []
+            if self.category in ( "all", "unread" ):
+                self._retrieveNext()
+            else:
+                self._commchannel.enqueue( '+CMGL=%i' % self.status, self.responseFromListing, self.errorFromChannel )
+
+    def _retrieveNext( self ):
+        # no need to look further, once all used records have been seen
+        if self.index < self.maximum and self.seen < self.used:
+            self.index += 1
+            self._commchannel.enqueue( '+CMGR=%d' % self.index, self.responseFromChannel, self.errorFromChannel )
+        else:
+            self._flush()
+            self._ok( self.count )
+
+    def _flush( self ):
+        if self.entries:
+            self.count += len( self.entries )
+            self._object.MessagebookEntries( self.category, self.entries )
+            self.entries = []
+
+    @logged
+    def responseFromChannel( self, request, response ):
+        if response[-1] == "OK":
+            status = None
+            for line in response[:-1]:
+                if line.startswith( "+CMGR" ):
+                    header = const.PAT_SMS_PDU_HEADER_SINGLE.match( self._rightHandSide(line) )
+                    if header is not None:
+                        status = int(header.groupdict()["status"])
+                elif status is not None:
+                    self.seen += 1
+                    if status == const.SMS_PDU_STATUS_IN["unread"]: # has been marked as read now
+                        self._simcache.invalidate( "messagebook:" )
+                    if self.status in ( status, const.SMS_PDU_STATUS_IN["all"] ):
+                        self.entries.append( self._decodeMessage( self.index, status, line ) )
+                    status = None
+                else:
+                    logger.warning( "SimStreamMessagebook encountered strange answer to AT+CMGR: '%s'" % line )
+        elif response[-1] != "+CMS ERROR: 321": # empty record
+            self._flush()
+            SimMediator.responseFromChannel( self, request, response )
+            return
+
+        if len( self.entries ) >= SIM_WINDOW_SIZE:
+            self._flush()
+        self._retrieveNext()
+
+    @logged
+    def responseFromListing( self, request, response ):
+        # +CMS ERROR: 321 (not found) if there are no messages of the category
+        if response[-1] not in ( "OK", "+CMS ERROR: 321" ):
+            SimMediator.responseFromChannel( self, request, response )
+            return
+        header = None
+        for line in response[:-1]:
+            if line.startswith( "+CMGL" ):
+                header = const.PAT_SMS_PDU_HEADER.match( self._rightHandSide(line) )
+            elif header is not None:
+                self.entries.append( self._decodeMessage( int(header.groupdict()["index"]), int(header.groupdict()["status"]), line ) )
+                header = None
+                if len( self.entries ) >= SIM_WINDOW_SIZE:
+                    self._flush()
+            else:
+                logger.warning( "SimStreamMessagebook encountered strange answer to AT+CMGL: '%s'" % line )
+        self._flush()
+        self._ok( self.count )
+
+    def _decodeMessage( self, index, status, pdu ):
+        status = const.SMS_PDU_STATUS_OUT[status]
+        if "read" in status:
+            direction = "guess-deliver"
+        else:
+            direction = "guess-submit"
+        try:
+            sms = ogsmd.gsm.sms.SMS.decode( pdu, direction )
+        except UnicodeError:
+            return ( index, status, "Error decoding", "Error decoding", {} )
+        else:
+            return ( index, status, str(sms.addr), sms.ud, sms.properties )
+
+#=========================================================================#
+class SimSetServiceCenterNumber( SimCachedMediator ):
+#=========================================================================#
+    def cachedTrigger( self ):
         if not self.number.startswith( '+' ):
             self.number = "+%s" % self.number
         self._commchannel.enqueue( '+CSCA="%s",145' % self.number, self.responseFromChannel, self.errorFromChannel )
 
+    def responseFromChannel( self, request, response ):
+        if response[-1] == "OK":
+            self._simcache.set( "service-center", None )
+        SimMediator.responseFromChannel( self, request, response )
+
 #=========================================================================#
-class SimStoreMessage( SimMediator ):
+class SimStoreMessage( SimCachedMediator ):
 #=========================================================================#
-    def trigger( self ):
+    def cachedTrigger( self ):
         sms = ogsmd.gsm.sms.SMSSubmit()
         # Use PDUAddress
         sms.addr = ogsmd.gsm.sms.PDUAddress.guess( self.number )
@@ -1133,18 +1491,20 @@ class SimStoreMessage( SimMediator ):
         if response[-1] != "OK":
             SimMediator.responseFromChannel( self, request, response )
         else:
+            self._simcache.invalidate( "messagebook:" )
             self._ok( int(self._rightHandSide(response[0])) )
 
 #=========================================================================#
-class SimSendStoredMessage( SimMediator ):
+class SimSendStoredMessage( SimCachedMediator ):
 #=========================================================================#
-    def trigger( self ):
+    def cachedTrigger( self ):
         self._commchannel.enqueue( "+CMSS=%d" % self.index, self.responseFromChannel, self.errorFromChannel )
 
     def responseFromChannel( self, request, response ):
         if response[-1] != "OK":
             SimMediator.responseFromChannel( self, request, response )
         else:
+            self._simcache.invalidate( "messagebook:" ) # status changes to sent
             timestamp = ""
             result = safesplit( self._rightHandSide(response[0]), ',' )
             mr = result[0]
@@ -1154,11 +1514,16 @@ class SimSendStoredMessage( SimMediator ):
             self._ok( int(mr), timestamp )
 
 #=========================================================================#
-class SimDeleteMessage( SimMediator ):
+class SimDeleteMessage( SimCachedMediator ):
 #=========================================================================#
-    def trigger( self ):
+    def cachedTrigger( self ):
         self._commchannel.enqueue( "+CMGD=%d" % self.index, self.responseFromChannel, self.errorFromChannel )
 
+    def responseFromChannel( self, request, response ):
+        if response[-1] == "OK":
+            self._simcache.invalidate( "messagebook:" )
+        SimMediator.responseFromChannel( self, request, response )
+
 #
 # SMS Mediators
 #
@@ -1507,10 +1872,10 @@ class CallEmergency( CallMediator ):
 #=========================================================================#
     def trigger( self ):
         if self.number in const.EMERGENCY_NUMBERS:
-            # FIXME once we have a priority queue, insert these with maximum priority
-            self._commchannel.enqueue( 'H' ) # hang up (just in case)
-            self._commchannel.enqueue( '+CFUN=1;+COPS=0,0' )
-            self._commchannel.enqueue( 'D%s;' % self.number ) # dial emergency number
+            # all in the call class, so they are sent first and in this order
+            self._commchannel.enqueue( 'H', priority="call" ) # hang up (just in case)
+            self._commchannel.enqueue( '+CFUN=1;+COPS=0,0', priority="call" )
+            self._commchannel.enqueue( 'D%s;' % self.number, priority="call" ) # dial emergency number
         else:
             self._error( DBusError.CallNotAnEmergencyNumber( "valid emergency numbers are %s" % const.EMERGENCY_NUMBERS ) )
 
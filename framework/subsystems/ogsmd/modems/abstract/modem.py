@@ -17,6 +17,8 @@ __version__ = "0.9.9.5"
 MODULE_NAME = "ogsmd.modem.abstract"
 
 from framework.config import config
+from ogsmd.modems.abstract.simcache import SimCache
+from ogsmd.modems.abstract.networkstate import NetworkState
 
 import gobject
 import sys, types
@@ -48,6 +50,8 @@ class AbstractModem( object ):
         self._data = {}                         # misc modem-wide data, set/get from channels
         self._phonebookIndices = {}             # min. index, max. index
         self._phonebookSizes = {}               # number length, name length
+        self._simCache = SimCache()             # data read from the SIM card
+        self._networkState = NetworkState()     # last known network status
 
         self._data["sim-buffers-sms"] = True
         self._data["sms-buffered-cb"] = "2,1,2,1,1"
@@ -112,6 +116,7 @@ class AbstractModem( object ):
         for channel in self._channels.values():
             # FIXME: We're throwing away the result here :/
             channel.close()
+        self._networkState.reset()
 
     def reinit( self ):
         """
@@ -161,6 +166,18 @@ class AbstractModem( object ):
         """
         self._channels[channel].readyToRead( string )
 
+    def channelStatistics( self, channel ):
+        """
+        Returns the statistics of a channel.
+        """
+        return self._channels[channel].statistics()
+
+    def channelWaitHistograms( self, channel ):
+        """
+        Returns the queue wait histograms of a channel.
+        """
+        return self._channels[channel].waitHistograms()
+
     def simPinState( self ):
         """
         Returns the SIM PIN state
@@ -188,6 +205,9 @@ class AbstractModem( object ):
         if state == "READY":
             for channel in self._channels.itervalues():
                 channel.modemStateSimUnlocked()
+        else:
+            # the card might have been changed
+            self._simCache.deactivate()
 
     def setSimReady( self, ready ):
         """
@@ -197,6 +217,20 @@ class AbstractModem( object ):
         if ready == True:
             for channel in self._channels.itervalues():
                 channel.modemStateSimReady()
+        else:
+            self._simCache.deactivate()
+
+    def simCache( self ):
+        """
+        Returns the cache for the data of the SIM card.
+        """
+        return self._simCache
+
+    def networkState( self ):
+        """
+        Returns the last known state of the network.
+        """
+        return self._networkState
 
     def setPhonebookIndices( self, category, first, last ):
         """
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+The Open GSM Daemon - Python Implementation
+
+GPLv2 or later
+
+Package: ogsmd.modems.abstract
+Module: networkstate
+
+Keeps the last known state of the network, so that status requests can
+be answered without talking to the modem and signals are only sent on changes.
+"""
+
+__version__ = "0.1.0"
+MODULE_NAME = "ogsmd.modems.abstract.networkstate"
+
+from framework.config import config
+
+import time
+
+import logging
+logger = logging.getLogger( MODULE_NAME )
+
+NETWORK_STATUS_TTL = config.getInt( "ogsmd", "network_status_ttl", 10 )
+NETWORK_STRENGTH_HYSTERESIS = config.getInt( "ogsmd", "network_strength_hysteresis", 0 )
+
+#=========================================================================#
+class NetworkState( object ):
+#=========================================================================#
+    """
+    The last known registration, operator, lac/cid and signal strength.
+
+    A status is fresh for NETWORK_STATUS_TTL seconds after it has been queried
+    from the modem. Unsolicited updates keep the values current, but don't
+    extend the freshness.
+    """
+    def __init__( self ):
+        self.reset()
+
+    def reset( self ):
+        """
+        Forget everything, e.g. because the modem has been closed.
+        """
+        self.status = {}
+        self.statusTime = 0
+        self.strength = None
+        self.strengthTime = 0
+        self.sentStatus = None
+        self.sentStrength = None
+
+    def invalidate( self ):
+        """
+        Mark the known values as outdated, e.g. after a registration request.
+        """
+        self.statusTime = 0
+        self.strengthTime = 0
+
+    def cachedStatus( self ):
+        """
+        Return a copy of the status, if it is fresh. None otherwise.
+        """
+        if time.time() - self.statusTime < NETWORK_STATUS_TTL:
+            return dict( self.status )
+        return None
+
+    def cachedStrength( self ):
+        """
+        Return the signal strength, if it is fresh. None otherwise.
+        """
+        if time.time() - self.strengthTime < NETWORK_STATUS_TTL:
+            return self.strength
+        return None
+
+    def setStatus( self, status ):
+        """
+        Store a complete status as queried from the modem.
+        """
+        now = time.time()
+        self.status = dict( status )
+        self.statusTime = now
+        if "strength" in status:
+            self.strength = status["strength"]
+            self.strengthTime = now
+
+    def updateStatus( self, values ):
+        """
+        Update some values of the status, e.g. from unsolicited responses.
+        """
+        self.status.update( values )
+
+    def setStrength( self, strength ):
+        """
+        Store the signal strength as queried from or reported by the modem.
+        """
+        self.strength = strength
+        self.strengthTime = time.time()
+        if "strength" in self.status:
+            self.status["strength"] = strength
+
+    def statusChanged( self, status ):
+        """
+        Return whether a status differs from the one sent last. The strength
+        counts as changed only beyond NETWORK_STRENGTH_HYSTERESIS.
+        If so, the status is remembered as being sent.
+        """
+        if self.sentStatus is not None and self._sameStatus( self.sentStatus, status ):
+            return False
+        self.sentStatus = dict( status )
+        return True
+
+    def strengthChanged( self, strength ):
+        """
+        Return whether a signal strength differs from the one sent last beyond
+        NETWORK_STRENGTH_HYSTERESIS. If so, it is remembered as being sent.
+        """
+        if not self._strengthChanged( self.sentStrength, strength ):
+            return False
+        self.sentStrength = strength
+        return True
+
+    def _sameStatus( self, old, new ):
+        for key in set( old ) | set( new ):
+            if key != "strength" and old.get( key ) != new.get( key ):
+                return False
+        if "strength" in old and "strength" in new:
+            return not self._strengthChanged( old["strength"], new["strength"] )
+        return ( "strength" in old ) == ( "strength" in new )
+
+    def _strengthChanged( self, old, new ):
+        return old is None or abs( new - old ) > NETWORK_STRENGTH_HYSTERESIS
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+The Open GSM Daemon - Python Implementation
+
+GPLv2 or later
+
+Package: ogsmd.modems.abstract
+Module: simcache
+
+Keeps data read from SIM cards across restarts of the daemon,
+keyed by the ICCID of the card.
+"""
+
+__version__ = "0.1.0"
+MODULE_NAME = "ogsmd.modems.abstract.simcache"
+
+from framework.config import config
+from framework.persist import persist
+
+import time
+
+import logging
+logger = logging.getLogger( MODULE_NAME )
+
+SIM_CACHE = config.getBool( "ogsmd", "sim_cache", True )
+SIM_CACHE_CARDS = config.getInt( "ogsmd", "sim_cache_cards", 4 )
+
+#=========================================================================#
+class SimCache( object ):
+#=========================================================================#
+    """
+    The cache of the SIM card currently inserted.
+
+    The cache is inactive until the ICCID of the card is known. While
+    inactive, nothing is found and nothing is stored.
+    """
+    def __init__( self ):
+        self.iccid = None
+        self.data = None
+        self.unavailable = False
+
+    def enabled( self ):
+        return SIM_CACHE
+
+    def isActive( self ):
+        return self.iccid is not None
+
+    def needsIccid( self ):
+        """
+        Whether the ICCID of the card should be read to activate the cache.
+        """
+        return SIM_CACHE and self.iccid is None and not self.unavailable
+
+    def markUnavailable( self ):
+        """
+        The ICCID could not be read, don't try again for this card.
+        """
+        self.unavailable = True
+
+    def activate( self, iccid ):
+        """
+        Activate the cache for the card with the given ICCID.
+        """
+        cards = persist.get( "ogsmd", "simcache" ) or {}
+        self.iccid = iccid
+        self.data = cards.get( iccid, {} )
+        logger.info( "using sim cache for %s with %d entries", iccid, len( self.data ) )
+
+    def deactivate( self ):
+        """
+        Deactivate the cache, e.g. because the card has been removed.
+        """
+        if self.iccid is not None:
+            logger.info( "sim cache for %s deactivated", self.iccid )
+        self.iccid = None
+        self.data = None
+        self.unavailable = False
+
+    def get( self, key ):
+        if self.data is None:
+            return None
+        return self.data.get( key, None )
+
+    def set( self, key, value ):
+        """
+        Store a value, None removes it.
+        """
+        if self.data is None:
+            return
+        if value is None:
+            self.data.pop( key, None )
+        else:
+            self.data[key] = value
+        self._store()
+
+    def invalidate( self, prefix ):
+        """
+        Remove all values with keys starting with prefix.
+        """
+        if self.data is None:
+            return
+        for key in [ key for key in self.data if key.startswith( prefix ) ]:
+            del self.data[key]
+        self._store()
+
+    def _store( self ):
+        cards = persist.get( "ogsmd", "simcache" ) or {}
+        self.data["last-used"] = time.time()
+        cards[self.iccid] = self.data
+        # forget the cards not seen for the longest time
+        while len( cards ) > SIM_CACHE_CARDS:
+            oldest = min( cards, key=lambda iccid: cards[iccid].get( "last-used", 0 ) )
+            del cards[oldest]
+        persist.set( "ogsmd", "simcache", cards )
+        persist.sync( "ogsmd" )
@@ -45,8 +45,21 @@ class AbstractUnsolicitedResponseDelegate( object ):
 
         self._syncTimeout = None
 
-    def _sendStatus( self ):
-        self._object.Status( self.operator, self.register, self.strength )
+    def _sendStatus( self, status ):
+        """
+        Send the Status signal, unless nothing changed since the last one.
+        """
+        if self._object.modem.networkState().statusChanged( status ):
+            self._object.Status( status ) # send dbus signal
+
+    def _sendSignalStrength( self, strength ):
+        """
+        Send the SignalStrength signal, unless nothing changed since the last one.
+        """
+        state = self._object.modem.networkState()
+        state.setStrength( strength )
+        if state.strengthChanged( strength ):
+            self._object.SignalStrength( strength ) # send dbus signal
 
     #
     # unsolicited callbacks (alphabetically sorted, please keep it that way)
@@ -120,7 +133,13 @@ class AbstractUnsolicitedResponseDelegate( object ):
         if len( values ) >= 3:
             self.lac = values[1].strip( '"' ).decode(charset)
             self.cid = values[2].strip( '"' ).decode(charset)
-        self._mediator.NetworkGetStatus( self._object, self.statusOK, self.statusERR )
+        # a mere cell change doesn't need to query everything again
+        state = self._object.modem.networkState()
+        status = state.cachedStatus()
+        if status is not None and status.get( "registration" ) == self.register:
+            self.statusOK( status, query=False )
+        else:
+            self._mediator.NetworkGetStatus( self._object, self.statusOK, self.statusERR )
 
     # +CLIP: "+496912345678",145,,,,0
     def plusCLIP( self, righthandside ):
@@ -176,6 +195,7 @@ class AbstractUnsolicitedResponseDelegate( object ):
         if storage != '"SM"':
             logger.warning( "unhandled +CMTI message notification" )
         else:
+            self._object.modem.simCache().invalidate( "messagebook:" )
             self._object.IncomingStoredMessage( int(index) )
 
     # +CRING: VOICE
@@ -226,12 +246,17 @@ class AbstractUnsolicitedResponseDelegate( object ):
     # helpers
     #
 
-    def statusOK( self, status ):
+    def statusOK( self, status, query=True ):
         if self.lac is not None:
             status["lac"] = self.lac
         if self.cid is not None:
             status["cid"] = self.cid
-        self._object.Status( status ) # send dbus signal
+        state = self._object.modem.networkState()
+        if query:
+            state.setStatus( status )
+        else:
+            state.updateStatus( status )
+        self._sendStatus( status )
 
     def statusERR( self, values ):
         logger.warning( "statusERR... ignoring" )
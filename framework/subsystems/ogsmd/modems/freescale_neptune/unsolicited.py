@@ -70,7 +70,7 @@ class UnsolicitedResponseDelegate( AbstractUnsolicitedResponseDelegate ):
         logger.debug("EZX: CHARGE LEVEL:", chargelevel)
 
     def CIEV_1( self, signallevel ):
-        self._object.SignalStrength( 20*signallevel )
+        self._sendSignalStrength( 20*signallevel )
         logger.debug("EZX: SIGNAL: ", signallevel)
 
     def CIEV_2( self, service ):
@@ -173,7 +173,8 @@ class UnsolicitedResponseDelegate( AbstractUnsolicitedResponseDelegate ):
             roaming = self._object.modem.data( "network:roaming", False )
             status["registration"] = "roaming" if roaming else "home"
             status["provider"] = values[1]
-        self._object.Status( status )
+        self._object.modem.networkState().updateStatus( status )
+        self._sendStatus( status )
 
     # RING: 1
     def RING( self, calltype ):
@@ -37,7 +37,7 @@ class UnsolicitedResponseDelegate( AbstractUnsolicitedResponseDelegate ):
     def atHTCCSQ( self, righthandside ):
         """Indicates signal strength"""
         value = int( righthandside )
-        self._object.SignalStrength( 20*value )
+        self._sendSignalStrength( 20*value )
 
     # +PB_READY
     def plusPB_READY( self, righthandside ):
@@ -358,4 +358,4 @@ class UnsolicitedResponseDelegate( AbstractUnsolicitedResponseDelegate ):
         signal strength report
         """
         strength, snr, quality = safesplit( righthandside, "," )
-        self._object.SignalStrength( const.signalQualityToPercentage( int(strength) ) ) # send dbus signal
+        self._sendSignalStrength( const.signalQualityToPercentage( int(strength) ) )
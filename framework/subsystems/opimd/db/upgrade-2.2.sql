@@ -0,0 +1,4 @@
+-- messages_threads is created by the messages domain, ask it to fill it
+REPLACE INTO info VALUES('rebuild_messages_threads', '1');
+-- update version info
+REPLACE INTO info VALUES('version', '2.2');
@@ -0,0 +1,13 @@
+-- add the normalized phonenumber columns, normalize_number is registered by opimd
+ALTER TABLE contacts_phonenumber ADD COLUMN normalized TEXT;
+UPDATE contacts_phonenumber SET normalized = normalize_number(value);
+ALTER TABLE messages_phonenumber ADD COLUMN normalized TEXT;
+UPDATE messages_phonenumber SET normalized = normalize_number(value);
+ALTER TABLE calls_phonenumber ADD COLUMN normalized TEXT;
+UPDATE calls_phonenumber SET normalized = normalize_number(value);
+-- lookups use the index on normalized now
+DROP INDEX IF EXISTS contacts_phonenumber_value;
+DROP INDEX IF EXISTS messages_phonenumber_value;
+DROP INDEX IF EXISTS calls_phonenumber_value;
+-- update version info
+REPLACE INTO info VALUES('version', '2.3');
@@ -0,0 +1,5 @@
+-- replaced by the <prefix>_date_sort indexes
+DROP INDEX IF EXISTS calls_date_value;
+DROP INDEX IF EXISTS messages_date_value;
+-- update version info
+REPLACE INTO info VALUES('version', '2.4');
@@ -42,8 +42,12 @@ import framework.patterns.tasklet as tasklet
 from framework.config import config, rootdir
 
 import re
+import json
+import base64
 import db_upgrade
 
+from collections import OrderedDict
+
 try:
     import phoneutils
     from phoneutils import normalize_number
@@ -63,6 +67,11 @@ except:
         b = normalize_number(str(b))
         return cmp(a, b)
 
+def normalize_phonenumber(value):
+    """Returns the form of a phonenumber stored in the normalized column of
+    the phonenumber tables, numbers are equal if their normalized forms are"""
+    return normalize_number(str(value))
+
 
 
 
@@ -76,6 +85,21 @@ def regex_matches(string, pattern):
         logger.error("While matching regex (pattern = %s, string = %s) got: %s",unicode(pattern), unicode(string), exp)
     return 0
 
+def make_continuation_token(sortby, descending, key, eid):
+    """Returns an opaque token for continuing a query sorted by sortby after
+    the entry eid, whose sort key is key"""
+    return base64.urlsafe_b64encode(json.dumps([sortby, bool(descending), key, eid]))
+
+def parse_continuation_token(token):
+    """Returns [sortby, descending, key, eid] of a continuation token"""
+    try:
+        parsed = json.loads(base64.urlsafe_b64decode(str(token)))
+        if type(parsed) != list or len(parsed) != 4:
+            raise ValueError()
+    except (TypeError, ValueError):
+        raise InvalidField("_after is not a valid continuation token")
+    return parsed
+
 def dict_factory(description, row, skip_field = None):
     """Used for creating column-based dictionaries from simple resultset rows (ie lists)"""
     d = {}
@@ -88,14 +112,93 @@ rootdir = os.path.join( rootdir, 'opim' )
 
 _SQLITE_FILE_NAME = os.path.join(rootdir,'pim.db')
 
+# Number of entries fetched by a single retrieve query, keeps the number of
+# bound parameters below SQLITE_MAX_VARIABLE_NUMBER (999) for all domains
+_RETRIEVE_CHUNK_SIZE = 100
+
+# Number of entries kept in the per-domain entry cache (0 disables it)
+_ENTRY_CACHE_SIZE = config.getInt('opimd', 'entry_cache_size', 256)
+
+# Number of ids a restricted search query checks at once. Shorter id lists are
+# padded with NULLs, so the SQL text doesn't depend on the number of ids
+_MATCH_CHUNK_SIZE = 32
+
+# Number of query shapes whose generated SQL is kept per domain (0 disables it)
+_QUERY_SHAPE_CACHE_SIZE = config.getInt('opimd', 'query_shape_cache_size', 64)
+
+# Number of prepared statements kept by sqlite for each connection
+_STATEMENT_CACHE_SIZE = 256
+
+# Keep a full text index of the tables of _FULLTEXT_TYPES, for ~Field queries
+_FULLTEXT_INDEX = config.getBool('opimd', 'fulltext_index', True)
+_FULLTEXT_TYPES = ('text', 'longtext', 'name')
+
+def fulltext_supported(con):
+    """Checks if sqlite was built with the FTS4 module and unicode61 tokenizer"""
+    try:
+        con.execute("CREATE VIRTUAL TABLE temp.fulltext_check USING fts4(value, tokenize=unicode61)")
+        con.execute("DROP TABLE temp.fulltext_check")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+#----------------------------------------------------------------------------#
+class LRUCache(object):
+#----------------------------------------------------------------------------#
+    """A bounded LRU cache counting hits and misses. Used for the raw
+    (field_name, value) rows of entries, keyed by entry id, and for the SQL
+    generated for a query shape"""
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self._entries.pop(key, None)
+        if len(self._entries) >= self.size:
+            # drop the least recently used entry
+            self._entries.popitem(last=False)
+        self._entries[key] = value
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_statistics(self):
+        return {'size':len(self._entries), 'capacity':self.size, 'hits':self.hits, 'misses':self.misses}
+
+
 class DbHandler(object):
     con = None
     db_prefix = "generic"
 #FIXME: should change both to sets instead of lists
     tables = None
     table_types = None
+    cache = None
+    query_shapes = None
+    fulltext = False
+    fulltext_tables = None
     def __init__(self):
         self.tables = []
+        self.fulltext_tables = []
+        self.cache = LRUCache(_ENTRY_CACHE_SIZE)
+        self.query_shapes = LRUCache(_QUERY_SHAPE_CACHE_SIZE)
         if self.table_types == None:
             self.table_types = []
         #A list of all the basic types that deserve a table, maybe in the future
@@ -113,10 +216,17 @@ class DbHandler(object):
     def init_db(self):
         try:
             new_db = not os.path.isfile(_SQLITE_FILE_NAME)
-            self.con = sqlite3.connect(_SQLITE_FILE_NAME, isolation_level=None)
+            self.con = sqlite3.connect(_SQLITE_FILE_NAME, isolation_level=None,
+                                       cached_statements=_STATEMENT_CACHE_SIZE)
             self.con.text_factory = sqlite3.OptimizedUnicode
             self.con.create_collation("compare_numbers", numbers_compare)
             self.con.create_function("regex_matches", 2, regex_matches)
+            self.con.create_function("normalize_number", 1, normalize_phonenumber)
+
+            if _FULLTEXT_INDEX:
+                self.fulltext = fulltext_supported(self.con)
+                if not self.fulltext:
+                    logger.warning("sqlite lacks FTS4 support, full text index disabled")
 
             cur = self.con.cursor()
             cur.execute("""
@@ -166,6 +276,7 @@ class DbHandler(object):
                     """)
                     
             self.tables = []
+            self.fulltext_tables = []
             for type in self.table_types:
                     cur.executescript("CREATE TABLE IF NOT EXISTS " + \
                                       self.db_prefix + "_" + type + \
@@ -173,7 +284,8 @@ class DbHandler(object):
                                       + self.db_prefix + \
                                       "_id REFERENCES " + self.db_prefix + \
                                       "(" + self.db_prefix + "_id), field_name TEXT, value " + \
-                                      self.get_db_type_name(type) + " NOT NULL);" + \
+                                      self.get_db_type_name(type) + " NOT NULL" + \
+                                      self.get_db_extra_columns(type) + ");" + \
                                       "CREATE INDEX IF NOT EXISTS " + \
                                       self.db_prefix + "_" + type + "_" + self.db_prefix + \
                                       "_id ON " + self.db_prefix + "_" + type + \
@@ -182,6 +294,7 @@ class DbHandler(object):
                     self.tables.append(self.db_prefix + "_" + type)
 
                     cur.execute(self.get_create_type_index(type))
+                    self.update_fulltext_index(cur, type)
 
             self.con.commit()
             cur.close()
@@ -192,7 +305,69 @@ class DbHandler(object):
     def get_create_type_index(self, type):
         if type == "phonenumber":
             return "CREATE INDEX IF NOT EXISTS " + self.db_prefix + "_" + type + \
-                   "_value ON " + self.db_prefix + "_" + type + "(value COLLATE compare_numbers)"
+                   "_normalized ON " + self.db_prefix + "_" + type + "(normalized)"
+        elif type == "date":
+            # lets sorted (and keyset paginated) queries walk the index
+            return "CREATE INDEX IF NOT EXISTS " + self.db_prefix + "_" + type + \
+                   "_sort ON " + self.db_prefix + "_" + type + "(field_name, value, " + self.db_prefix + "_id)"
+        return ""
+    def update_fulltext_index(self, cur, type):
+        """Creates the full text index of the table of a type, or drops it if
+        the index is disabled. The index is kept up to date by triggers and
+        reads the text from the table itself."""
+        if type not in _FULLTEXT_TYPES:
+            return
+        table = self.db_prefix + "_" + type
+        fulltext = table + "_fulltext"
+        if not self.fulltext:
+            cur.executescript("""
+                    DROP TRIGGER IF EXISTS """ + fulltext + """_insert;
+                    DROP TRIGGER IF EXISTS """ + fulltext + """_delete;
+                    DROP TRIGGER IF EXISTS """ + fulltext + """_update_before;
+                    DROP TRIGGER IF EXISTS """ + fulltext + """_update_after;
+                    """)
+            try:
+                cur.execute("DROP TABLE IF EXISTS " + fulltext)
+            except sqlite3.OperationalError:
+                # no FTS4 module to drop it, it isn't used without the triggers
+                pass
+            return
+
+        # the index is only up to date if the triggers were there all the time
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name = ?", (fulltext + "_insert", ))
+        up_to_date = cur.fetchone() != None
+        cur.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS """ + fulltext + """
+                    USING fts4(content=""" + table + """, value, tokenize=unicode61);
+                CREATE TRIGGER IF NOT EXISTS """ + fulltext + """_insert AFTER INSERT ON """ + table + """ BEGIN
+                    INSERT INTO """ + fulltext + """ (docid, value) VALUES (new.""" + table + """_id, new.value);
+                END;
+                CREATE TRIGGER IF NOT EXISTS """ + fulltext + """_delete BEFORE DELETE ON """ + table + """ BEGIN
+                    DELETE FROM """ + fulltext + """ WHERE docid = old.""" + table + """_id;
+                END;
+                CREATE TRIGGER IF NOT EXISTS """ + fulltext + """_update_before BEFORE UPDATE ON """ + table + """ BEGIN
+                    DELETE FROM """ + fulltext + """ WHERE docid = old.""" + table + """_id;
+                END;
+                CREATE TRIGGER IF NOT EXISTS """ + fulltext + """_update_after AFTER UPDATE ON """ + table + """ BEGIN
+                    INSERT INTO """ + fulltext + """ (docid, value) VALUES (new.""" + table + """_id, new.value);
+                END;
+                """)
+        if not up_to_date:
+            logger.info("Building full text index of %s", table)
+            cur.execute("INSERT INTO " + fulltext + " (" + fulltext + ") VALUES ('rebuild')")
+        self.fulltext_tables.append(table)
+    def get_fulltext_compare_string(self, table, field):
+        """Returns the condition matching the rows of table against a full
+        text query, using its full text index"""
+        if table not in self.fulltext_tables:
+            raise InvalidField("Field '%s' has no full text index." % (field, ))
+        return " " + table + "_id IN (SELECT docid FROM " + table + "_fulltext WHERE value MATCH ?) "
+    def get_db_extra_columns(self, type):
+        """Returns the columns a table of the type has besides value"""
+        if type == "phonenumber":
+            # value normalized with normalize_phonenumber, so lookups don't
+            # need the (python) compare_numbers collation and can use an index
+            return ", normalized TEXT"
         return ""
     def get_table_name(self, field):
         if self.domain.is_reserved_field(field):
@@ -203,6 +378,10 @@ class DbHandler(object):
             return table
         else:
             return self.db_prefix + '_generic'
+    def get_id_index(self, table):
+        """Returns the clause making sqlite look up rows of table by entry id,
+        it would prefer a value index when the field name is known"""
+        return " INDEXED BY " + table + "_" + self.db_prefix + "_id"
     def get_table_name_from_type(self, type):
         name = self.db_prefix + "_" + type
         if name in self.tables:
@@ -210,7 +389,9 @@ class DbHandler(object):
         else:
             return None
     def get_value_compare_string(self, type, field, operator):
-        if type == "phonenumber" or TypeManager.Types.get(type) in (int, float, long, bool):
+        if type == "phonenumber" and self.get_table_name_from_type(type):
+            return " normalized " + operator + " ? "
+        elif type == "phonenumber" or TypeManager.Types.get(type) in (int, float, long, bool):
             return " value " + operator + " ? "
         else:
             #FIXME: raise error if operator is not '='
@@ -255,25 +436,73 @@ class DbHandler(object):
             #FIXME: sholud be a nice hash table and not a boolean
             if table == self.db_prefix + "_phonenumber" and join_parameters.get('resolve'):
                 query = query + " UNION SELECT '@Contacts', contacts_id FROM " \
-                        + table + " JOIN contacts_phonenumber USING (value)" \
-                        + " WHERE " + self.db_prefix + "_id=:id "
+                        + table + " p JOIN contacts_phonenumber c ON c.normalized = p.normalized" \
+                        + " WHERE p." + self.db_prefix + "_id=:id "
         return query
-    def build_search_query(self, query_desc):
-        """Recieves a dictionary and makes an sql query that returns all the
-        id's of those who meet the dictionaries restrictions"""
-        params = []
+    def build_batch_retrieve_query(self, ids):
+        """Same as build_retrieve_query without joins, but for a list of ids
+        at once. Every returned row is prefixed with the id of the entry it
+        belongs to."""
+        in_ids = " IN (" + ",".join("?" * len(ids)) + ")"
+        selects = []
+        for table in self.tables:
+            selects.append("SELECT " + self.db_prefix + "_id, field_name, value FROM " + \
+                        table + " WHERE " + self.db_prefix + "_id" + in_ids)
+        return {'Query':" UNION ".join(selects), 'Parameters':list(ids) * len(selects)}
+    def build_batch_resolve_query(self, ids):
+        """Returns a query resolving the phonenumbers of the given entries to
+        contact ids, or None if this domain has no phonenumbers"""
+        table = self.db_prefix + "_phonenumber"
+        if table not in self.tables:
+            return None
+        in_ids = " IN (" + ",".join("?" * len(ids)) + ")"
+        query = "SELECT DISTINCT p." + self.db_prefix + "_id, c.contacts_id FROM " \
+                        + table + " p JOIN contacts_phonenumber c ON c.normalized = p.normalized" \
+                        + " WHERE p." + self.db_prefix + "_id" + in_ids + " ORDER BY 1, 2"
+        return {'Query':query, 'Parameters':list(ids)}
+    def get_query_shape(self, query_desc):
+        """Returns a hashable description of everything in query_desc that
+        affects the generated SQL: the field names with their operators, the
+        number of values of each field, and the sort flags"""
+        shape = []
+        for name, value in query_desc.iteritems():
+            if name in ('_limit', '_limit_start', '_resolve_phonenumber', '_retrieve_full_contact'):
+                continue
+            elif name == '_sortby':
+                shape.append((name, unicode(value)))
+            elif type(value) == Array or type(value) == list:
+                shape.append((name, len(value)))
+            else:
+                shape.append((name, None))
+        shape.sort()
+        return tuple(shape)
+
+    def build_search_template(self, query_desc, restrict = False):
+        """Makes the sql query for the shape of query_desc, without the limits.
+        Returns the query and the layout of its parameters: ('const', value)
+        for parameters that are part of the shape, ('value', key, name,
+        field_type, index) for those taken from query_desc[key] (or from
+        its index'th value) and ('ids', ) for the _MATCH_CHUNK_SIZE ids the
+        query is restricted to, if restrict is set"""
+        layout = []
         not_first = False
+        if restrict:
+            id_filter = self.db_prefix + "_id IN (" + ",".join("?" * _MATCH_CHUNK_SIZE) + ") AND "
+        else:
+            id_filter = ""
         
         if '_at_least_one' in query_desc:
             table_join_operator = " UNION "
         else:
             table_join_operator = " INTERSECT "        
         query = ""
-        for name, value in query_desc.iteritems():
+        # Sorted, so that equal shapes always generate the same SQL text
+        for key in sorted(query_desc.keys()):
+            name = key
             #skip system fields
             if name.startswith('_'):
                 #FIXME: put this in a central place!
-                if name not in ('_at_least_one', '_sortdesc', '_sortby', '_limit', '_limit_start', '_resolve_phonenumber', '_retrieve_full_contact'):
+                if name not in ('_at_least_one', '_sortdesc', '_sortby', '_after', '_limit', '_limit_start', '_resolve_phonenumber', '_retrieve_full_contact'):
                     raise InvalidField("Query rule '%s' does not exist." % (name, ))
                 else:
                     continue
@@ -298,6 +527,9 @@ class DbHandler(object):
             elif name.startswith('!'):
                 operator = '!='
                 name = name[1:]
+            elif name.startswith('~'):
+                operator = 'MATCH'
+                name = name[1:]
             else:
                 operator = '='
 
@@ -307,32 +539,40 @@ class DbHandler(object):
                 if not table:
                     raise InvalidField("Type '%s' does not exist." % (field_type, ))
                 query = query + "SELECT DISTINCT " + self.db_prefix + "_id FROM " + \
-                        table + " WHERE ("
+                        table + (restrict and self.get_id_index(table) or "") + " WHERE " + id_filter + "("
+                if restrict:
+                    layout.append(('ids', ))
             else:
                 field_type = self.domain.field_type_from_name(name)
                 table = self.get_table_name(name)
                 if not table:
                     raise InvalidField("Field '%s' is reserved for internal use." % (name, ))
                 query = query + "SELECT DISTINCT " + self.db_prefix + "_id FROM " + \
-                        table + " WHERE field_name = ? AND ("
-                params.append(str(name))
+                        table + (restrict and self.get_id_index(table) or "") + " WHERE " + id_filter + "field_name = ? AND ("
+                if restrict:
+                    layout.append(('ids', ))
+                layout.append(('const', str(name)))
             #If multi values, make OR connections
-            comp_string = self.get_value_compare_string(field_type, name, operator)
+            if operator == 'MATCH':
+                comp_string = self.get_fulltext_compare_string(table, name)
+            else:
+                comp_string = self.get_value_compare_string(field_type, name, operator)
             
+            value = query_desc[key]
             if type(value) == Array or type(value) == list:
                 first_val = True
                 
-                for val in value:
+                for index in range(len(value)):
                     if first_val:
                         first_val = False
                     else:
                         query = query + " OR "
                     
                     query = query + comp_string
-                    params.append(self.get_value_compare_object(field_type, name, val))
+                    layout.append(('value', key, name, field_type, index))
             else:
                 query = query + comp_string
-                params.append(self.get_value_compare_object(field_type, name, value))
+                layout.append(('value', key, name, field_type, None))
             
             query = query + ")"
             
@@ -341,15 +581,38 @@ class DbHandler(object):
         #If there are no restrictions get everything
         if query == "":
             query = "SELECT " + self.db_prefix + "_id FROM " + self.db_prefix
+            if restrict:
+                query = query + " WHERE " + id_filter[:-len(" AND ")]
+                layout.append(('ids', ))
         if '_sortby' in query_desc:
             sortby = query_desc['_sortby']
+            if '_sortdesc' in query_desc:
+                (order, seek) = (" DESC", " < ")
+            else:
+                (order, seek) = ("", " > ")
             query = "SELECT DISTINCT " + self.db_prefix + "_id FROM (" + query + \
                         ") JOIN " + self.get_table_name(sortby) + " USING (" + \
-                        self.db_prefix + "_id) WHERE field_name = ? ORDER BY value"
-            params.append(sortby)
-            if '_sortdesc' in query_desc:
-                query = query + " DESC"
+                        self.db_prefix + "_id) WHERE field_name = ?"
+            layout.append(('const', sortby))
+            if '_after' in query_desc:
+                # keyset pagination: seek past the (value, id) of the token,
+                # written so that sqlite can use the value as index range
+                query = query + " AND value " + seek.strip() + "= ? AND (value" + seek + "? OR " + \
+                        self.db_prefix + "_id" + seek + "?)"
+                layout.append(('after', ))
+            # ids break ties, so the order is stable between pages
+            query = query + " ORDER BY value" + order + ", " + self.db_prefix + "_id" + order
+        elif '_after' in query_desc:
+            raise InvalidField("_after can only be used together with _sortby")
 
+        return {'Query':query, 'Layout':layout}
+
+    def build_search_query(self, query_desc, ids = None):
+        """Recieves a dictionary and makes an sql query that returns all the
+        id's of those who meet the dictionaries restrictions. The SQL text
+        is generated once per query shape and reused afterwards.
+        If ids is given, only those ids (at most _MATCH_CHUNK_SIZE of them) are
+        looked at and limits are ignored."""
         limit_start = 0
         if '_limit_start' in query_desc:
             try:
@@ -364,6 +627,39 @@ class DbHandler(object):
             except:
                 raise InvalidField("_limit should be an integer value")
 
+        restrict = ids != None
+        if restrict:
+            if len(ids) > _MATCH_CHUNK_SIZE:
+                raise QueryFailed("Too many ids to restrict a query to")
+            ids = list(ids) + [None] * (_MATCH_CHUNK_SIZE - len(ids))
+            limit_start = 0
+            limit_end = -1
+
+        shape = self.get_query_shape(query_desc) + (('', restrict), )
+        template = self.query_shapes.get(shape)
+        if template == None:
+            template = self.build_search_template(query_desc, restrict)
+            self.query_shapes.put(shape, template)
+
+        params = []
+        for param in template['Layout']:
+            if param[0] == 'const':
+                params.append(param[1])
+            elif param[0] == 'ids':
+                params.extend(ids)
+            elif param[0] == 'after':
+                (sortby, descending, key, eid) = parse_continuation_token(query_desc['_after'])
+                if sortby != query_desc['_sortby'] or descending != ('_sortdesc' in query_desc):
+                    raise InvalidField("_after token belongs to a query sorted differently")
+                params.extend([key, key, eid])
+            else:
+                (kind, key, name, field_type, index) = param
+                value = query_desc[key]
+                if index != None:
+                    value = value[index]
+                params.append(self.get_value_compare_object(field_type, name, value))
+
+        query = template['Query']
         if (limit_start != 0 or limit_end != -1):
             query = query + " LIMIT ?,?"
             params.extend([limit_start, limit_end])
@@ -423,9 +719,9 @@ class DbHandler(object):
                 map[field] = name    
         return map
         
-    def get_full_result(self, raw_result, join_parameters, description = None):
-        if raw_result == None:
-            return None
+    def split_result(self, raw_result, description = None):
+        """Splits a raw search result set into the list of entry ids and the
+        list of other columns of each row"""
         #convert from a list of tuples of ids to a list of ids
         ids = map(lambda x: x[0], raw_result)
 
@@ -441,64 +737,158 @@ class DbHandler(object):
         else:
             other_fields = []
 
+        return (ids, other_fields)
+
+    def get_full_result(self, raw_result, join_parameters, description = None):
+        if raw_result == None:
+            return None
+        (ids, other_fields) = self.split_result(raw_result, description)
         return self.get_content(ids, join_parameters, other_fields)
 
-    def query(self, query_desc):
+    def get_join_parameters(self, query_desc):
         #FIXME: join_parametrs should be cool, and not just a simple hash
         join_parameters = {}
-        query = self.build_search_query(query_desc)
-        if query == None:
-            logger.error("Failed creating search query for %s", str(query_desc))
-            raise QueryFailed("Failed creating search query.")
         if query_desc.get('_resolve_phonenumber'):
             join_parameters['resolve'] = True
             if query_desc.get('_retrieve_full_contact'):
                 join_parameters['full'] = True
+        return join_parameters
+
+    def query_ids(self, query_desc):
+        """Runs a search query without fetching the content of the matching entries
+
+        @return tuple of (list of ids, list of other fields, join parameters)"""
+        query = self.build_search_query(query_desc)
+        if query == None:
+            logger.error("Failed creating search query for %s", str(query_desc))
+            raise QueryFailed("Failed creating search query.")
 
         cur = self.con.cursor()
         cur.execute(query['Query'], query['Parameters'])
-        res = self.get_full_result(cur.fetchall(), join_parameters, cur.description)
+        (ids, other_fields) = self.split_result(cur.fetchall(), cur.description)
         cur.close()
-        return res
+        return (ids, other_fields, self.get_join_parameters(query_desc))
 
-    def raw_sql(self, query_desc):
-        #FIXME: join_parametrs should be cool, and not just a simple hash
-        join_parameters = {}
+    def match_ids(self, query_desc, ids):
+        """Checks which of the given entries match a query, only looking at
+        those entries. Limits of the query are ignored.
+
+        @return set of the matching ids"""
+        matching = set()
+        cur = self.con.cursor()
+        for start in xrange(0, len(ids), _MATCH_CHUNK_SIZE):
+            query = self.build_search_query(query_desc, ids[start:start + _MATCH_CHUNK_SIZE])
+            cur.execute(query['Query'], query['Parameters'])
+            matching.update(map(lambda x: x[0], cur.fetchall()))
+        cur.close()
+        return matching
+
+    def get_sort_keys(self, ids, field):
+        """Returns a dict of the value of field, as sqlite sorts it, of each of
+        the given entries that has the field"""
+        table = self.get_table_name(field)
+        if table == self.db_prefix + "_phonenumber":
+            column = "normalized"
+        else:
+            column = "value"
+        keys = {}
+        cur = self.con.cursor()
+        for start in xrange(0, len(ids), _RETRIEVE_CHUNK_SIZE):
+            chunk = ids[start:start + _RETRIEVE_CHUNK_SIZE]
+            cur.execute("SELECT " + self.db_prefix + "_id, " + column + " FROM " + table + self.get_id_index(table) + \
+                        " WHERE field_name = ? AND " + self.db_prefix + "_id IN (" + ",".join("?" * len(chunk)) + ")",
+                        [field] + list(chunk))
+            for (eid, key) in cur.fetchall():
+                keys.setdefault(eid, key)
+        cur.close()
+        return keys
+
+    def query(self, query_desc):
+        (ids, other_fields, join_parameters) = self.query_ids(query_desc)
+        return self.get_content(ids, join_parameters, other_fields)
+
+    def raw_sql_ids(self, query_desc):
+        """Runs a raw SQL query without fetching the content of the matching entries
+
+        @return tuple of (list of ids, list of other fields, join parameters)"""
         query = self.build_sql_query(query_desc)
         if query == None:
             logger.error("Failed creating threads query for %s", str(query_desc))
             raise QueryFailed("Failed creating threads query.")
-        if query_desc.get('_resolve_phonenumber'):
-            join_parameters['resolve'] = True
-            if query_desc.get('_retrieve_full_contact'):
-                join_parameters['full'] = True
 
         cur = self.con.cursor()
         cur.execute(query['Query'], query['Parameters'])
-        res = self.get_full_result(cur.fetchall(), join_parameters, cur.description)
+        (ids, other_fields) = self.split_result(cur.fetchall(), cur.description)
         cur.close()
-        return res
+        return (ids, other_fields, self.get_join_parameters(query_desc))
+
+    def raw_sql(self, query_desc):
+        (ids, other_fields, join_parameters) = self.raw_sql_ids(query_desc)
+        return self.get_content(ids, join_parameters, other_fields)
 
     def get_content(self, ids, join_parameters, other_fields = []):
+        raw = {}
+        missing = []
+        for id in ids:
+            rows = self.cache.get(id)
+            if rows == None:
+                missing.append(id)
+            else:
+                raw[id] = rows
+
         cur = self.con.cursor()
+        # Fetch the fields of a whole chunk of entries with a single query
+        # instead of running the retrieve query once per entry
+        for start in xrange(0, len(missing), _RETRIEVE_CHUNK_SIZE):
+            query = self.build_batch_retrieve_query(missing[start:start + _RETRIEVE_CHUNK_SIZE])
+            cur.execute(query['Query'], query['Parameters'])
+            for row in cur:
+                raw.setdefault(row[0], []).append(row[1:])
+        for id in missing:
+            self.cache.put(id, raw.setdefault(id, []))
+
+        # Joined fields depend on other domains, so they are never cached
+        #FIXME: sholud be a nice hash table and not a boolean
+        resolved = {}
+        if join_parameters.get('resolve'):
+            for start in xrange(0, len(ids), _RETRIEVE_CHUNK_SIZE):
+                query = self.build_batch_resolve_query(ids[start:start + _RETRIEVE_CHUNK_SIZE])
+                if query == None:
+                    break
+                cur.execute(query['Query'], query['Parameters'])
+                for row in cur:
+                    resolved.setdefault(row[0], []).append(('@Contacts', row[1]))
+        cur.close()
+
+        contents = {}
+        for id in raw:
+            contents[id] = self.sanitize_result(raw[id] + resolved.get(id, []))
+
+        #FIXME: Here we check for @Contacts, but we should handle crazier joins.
+        if join_parameters.get('full'):
+            contact_ids = set()
+            for tmp in contents.itervalues():
+                if tmp.has_key('@Contacts'):
+                    if type(tmp.get('@Contacts')) != list:
+                        #make it a list for easier handling
+                        tmp['@Contacts'] = [tmp['@Contacts'],]
+                    contact_ids.update(tmp['@Contacts'])
+            if contact_ids:
+                #get full contact content, all at once!
+                contact_domain = DomainManager.get_domain_handler('Contacts')
+                contacts = {}
+                for contact in contact_domain.db_handler.get_content(list(contact_ids), {}):
+                    contacts[contact['EntryId']] = contact
+                for tmp in contents.itervalues():
+                    if tmp.has_key('@Contacts'):
+                        tmp['@Contacts'] = map(lambda x: dbus.Dictionary(contacts[x], signature='sv'), tmp['@Contacts'])
+                        if len(tmp['@Contacts']) == 1:
+                            tmp['@Contacts'] = tmp['@Contacts'][0]
+
         res = []
-        query = self.build_retrieve_query(join_parameters)
         row_index = 0
         for id in ids:
-            cur.execute(query, {'id': id})
-            tmp = self.sanitize_result(cur.fetchall())
-
-            #FIXME: Here we check for @Contacts, but we should handle crazier joins.
-            if join_parameters.get('full') and tmp.has_key('@Contacts'):
-                contact_domain = DomainManager.get_domain_handler('Contacts')
-                if type(tmp.get('@Contacts')) != list:
-                    #make it a list for easier handling
-                    tmp['@Contacts'] = [tmp['@Contacts'],]
-                tmp['@Contacts'] = map(lambda x: dbus.Dictionary(x, signature='sv'), contact_domain.db_handler.get_content(tmp['@Contacts'], {}))
-                if len(tmp['@Contacts']) == 1:
-                    tmp['@Contacts'] = tmp['@Contacts'][0]
-                #get full contact content!
-                pass
+            tmp = dict(contents.get(id, {}))
             tmp['Path'] = self.domain.id_to_path(id)
             tmp['EntryId'] = id
             # include any other custom field from query
@@ -510,7 +900,6 @@ class DbHandler(object):
 
             row_index += 1
             res.append(tmp)
-        cur.close()
         return res
         
     def add_field_type(self, name, type):
@@ -518,13 +907,20 @@ class DbHandler(object):
         cur.execute("INSERT INTO " + self.db_prefix + "_fields (field_name, type) " \
                         "VALUES (?, ?)", (name, type))
         if self.get_table_name(name) != self.db_prefix + "_generic":
-                cur.execute("INSERT INTO " + self.get_table_name(name) + " (" + self.db_prefix + "_id, field_name, value)" + \
-                                " SELECT " + self.db_prefix + "_id, field_name, value FROM " + self.db_prefix + "_generic" + \
+                columns = self.db_prefix + "_id, field_name, value"
+                values = columns
+                if self.get_table_name(name) == self.db_prefix + "_phonenumber":
+                    columns = columns + ", normalized"
+                    values = values + ", normalize_number(value)"
+                cur.execute("INSERT INTO " + self.get_table_name(name) + " (" + columns + ")" + \
+                                " SELECT " + values + " FROM " + self.db_prefix + "_generic" + \
                                 " WHERE field_name = ?;", (name, ))
                 cur.execute("DELETE FROM " + self.db_prefix + "_generic WHERE field_name = ?;"
                                 , (name, ))
         self.con.commit()
         cur.close()
+        self.cache.clear()
+        self.query_shapes.clear()
         
     def remove_field_type(self, name):
         cur = self.con.cursor()
@@ -537,6 +933,8 @@ class DbHandler(object):
                         , (name, )) 
         self.con.commit()
         cur.close()
+        self.cache.clear()
+        self.query_shapes.clear()
         
     def load_field_types(self):
         cur = self.con.cursor()
@@ -553,61 +951,145 @@ class DbHandler(object):
         cur.close()
         return (count > 0)
         
-    def add_entry(self, entry_data):
-        cur = self.con.cursor()
-        cur.execute("INSERT INTO " + self.db_prefix + " (name) VALUES('')")
-        eid = cur.lastrowid
+    def get_entry_rows(self, eid, entry_data, rows):
+        """Collects the (id, field, value) rows to insert for an entry into
+        rows, a dict of lists keyed by table name"""
         for field in entry_data:
             table = self.get_table_name(field)
             field_type = self.domain.field_type_from_name(field)
             if table == None:
                     continue
-            if type(entry_data[field]) == Array or type(entry_data[field]) == list:
-                for value in entry_data[field]:
-                    if value != "" and value != None:
-                        cur.execute('INSERT INTO ' + table + ' (' + self.db_prefix + '_id, Field_name, Value) VALUES (?,?,?)',
-                                (eid, field, self.get_value_object(field_type, field, value)))
+            for value in field_value_to_list(entry_data[field]):
+                if value != "" and value != None:
+                    rows.setdefault(table, []).append((eid, field, self.get_value_object(field_type, field, value)))
+
+    def insert_rows(self, cur, rows):
+        for table, values in rows.iteritems():
+            if table == self.db_prefix + '_phonenumber':
+                values = map(lambda (eid, field, value): (eid, field, value, normalize_phonenumber(value)), values)
+                cur.executemany('INSERT INTO ' + table + ' (' + self.db_prefix + '_id, Field_name, Value, Normalized) VALUES (?,?,?,?)', values)
             else:
-                if entry_data[field] != "" and entry_data[field] != None:
-                    cur.execute('INSERT INTO ' + table + ' (' + self.db_prefix + '_id, Field_name, Value) VALUES (?,?,?)', \
-                                (eid, field, self.get_value_object(field_type, field, entry_data[field])))        
-        self.con.commit()
-        cur.close()
+                cur.executemany('INSERT INTO ' + table + ' (' + self.db_prefix + '_id, Field_name, Value) VALUES (?,?,?)', values)
+
+    def entries_changing(self, cur, eids):
+        """Called inside the transaction before entries are updated or deleted
+
+        @return whatever entries_changed needs to know about the old entries"""
+        return None
+
+    def entries_changed(self, cur, eids, old):
+        """Called inside the transaction after entries have been added, updated
+        or deleted, before it is committed, to keep derived tables in sync"""
+        pass
+
+    def add_entry(self, entry_data):
+        return self.add_entries([entry_data, ])[0]
+    def add_entries(self, entries_data):
+        """Adds a list of entries in a single transaction
+
+        @return list of the ids of the new entries"""
+        cur = self.con.cursor()
+        eids = []
+        rows = {}
+        cur.execute("BEGIN")
+        try:
+            for entry_data in entries_data:
+                cur.execute("INSERT INTO " + self.db_prefix + " (name) VALUES('')")
+                eid = cur.lastrowid
+                eids.append(eid)
+                self.get_entry_rows(eid, entry_data, rows)
+            self.insert_rows(cur, rows)
+            self.entries_changed(cur, eids, None)
+            cur.execute("COMMIT")
+        except:
+            cur.execute("ROLLBACK")
+            raise
+        finally:
+            cur.close()
+            for eid in eids:
+                self.cache.invalidate(eid)
+
+        return eids
+    def get_missing_ids(self, cur, eids):
+        """Returns the ids of the given entries that do not exist"""
+        existing = set()
+        for start in xrange(0, len(eids), _RETRIEVE_CHUNK_SIZE):
+            chunk = eids[start:start + _RETRIEVE_CHUNK_SIZE]
+            cur.execute("SELECT " + self.db_prefix + "_id FROM " + self.db_prefix + " WHERE " + \
+                        self.db_prefix + "_id IN (" + ",".join("?" * len(chunk)) + ")", chunk)
+            existing.update(map(lambda x: x[0], cur.fetchall()))
+        return filter(lambda x: x not in existing, eids)
 
-        return eid
     def upd_entry(self, eid, entry_data):
-        #FIXME: most of it can be merged with add_entry
+        return len(self.upd_entries([(eid, entry_data), ])) > 0
+    def upd_entries(self, entries_data):
+        """Updates a list of (id, entry data) pairs in a single transaction.
+        Nothing is updated if any of the entries does not exist.
+
+        @return list of the ids that do not exist"""
+        # Merge updates of the same entry, so later values win
+        merged = OrderedDict()
+        for (eid, entry_data) in entries_data:
+            merged.setdefault(eid, {}).update(entry_data)
+
         cur = self.con.cursor()
-        for field in entry_data:
-            table = self.get_table_name(field)
-            field_type = self.domain.field_type_from_name(field)
-            if table == None:
-                    continue
-            cur.execute("DELETE FROM " + table + " WHERE " + self.db_prefix + \
-                        "_id = ? AND field_name = ?", (eid, field))
-            if type(entry_data[field]) == Array or type(entry_data[field]) == list:
-                for value in entry_data[field]:
-                    if value != "" and value != None:
-                        cur.execute("INSERT INTO " + table + " (" + self.db_prefix + "_id, Field_name, Value) VALUES (?,?,?)",
-                                        (eid, field, self.get_value_object(field_type, field, value)))
-            elif entry_data[field] == "" or entry_data[field] == None:
-                pass
-            else:
-                cur.execute("INSERT INTO " + table + " (" + self.db_prefix + "_id, Field_name, Value) VALUES (?,?,?)",
-                                (eid, field, self.get_value_object(field_type, field, entry_data[field])))
-               
-        self.con.commit()
-        cur.close()
-        
+        deletes = {}
+        rows = {}
+        for (eid, entry_data) in merged.iteritems():
+            for field in entry_data:
+                table = self.get_table_name(field)
+                if table != None:
+                    deletes.setdefault(table, []).append((eid, field))
+            self.get_entry_rows(eid, entry_data, rows)
+        cur.execute("BEGIN")
+        try:
+            missing = self.get_missing_ids(cur, merged.keys())
+            if missing:
+                cur.execute("ROLLBACK")
+                return missing
+            old = self.entries_changing(cur, merged.keys())
+            for table, values in deletes.iteritems():
+                cur.executemany("DELETE FROM " + table + " WHERE " + self.db_prefix + \
+                        "_id = ? AND field_name = ?", values)
+            self.insert_rows(cur, rows)
+            self.entries_changed(cur, merged.keys(), old)
+            cur.execute("COMMIT")
+        except:
+            cur.execute("ROLLBACK")
+            raise
+        finally:
+            cur.close()
+            for eid in merged:
+                self.cache.invalidate(eid)
+        return []
+
     def del_entry(self, eid):
+        return len(self.del_entries([eid, ])) > 0
+    def del_entries(self, eids):
+        """Deletes a list of entries in a single transaction. Nothing is
+        deleted if any of the entries does not exist.
+
+        @return list of the ids that do not exist"""
+        for eid in eids:
+            self.cache.invalidate(eid)
         cur = self.con.cursor()
-        cur.execute("DELETE FROM " + self.db_prefix + " WHERE " + self.db_prefix + "_id=?",(eid,))
-        if cur.rowcount == 0:
+        values = map(lambda x: (x, ), set(eids))
+        cur.execute("BEGIN")
+        try:
+            missing = self.get_missing_ids(cur, eids)
+            if missing:
+                cur.execute("ROLLBACK")
+                return missing
+            old = self.entries_changing(cur, eids)
+            cur.executemany("DELETE FROM " + self.db_prefix + " WHERE " + self.db_prefix + "_id=?", values)
+            for table in self.tables:
+                cur.executemany("DELETE FROM " + table + " WHERE " + self.db_prefix + "_id=?", values)
+            self.entries_changed(cur, eids, old)
+            cur.execute("COMMIT")
+        except:
+            cur.execute("ROLLBACK")
+            raise
+        finally:
             cur.close()
-            return True
-        for table in self.tables:
-            cur.execute("DELETE FROM " + table + " WHERE " + self.db_prefix + "_id=?",(eid,))
-        self.con.commit()
-        cur.close()
-        return False
+        return []
         
@@ -31,6 +31,9 @@
  1.0 - old table schema
  2.0 - new table schema
  2.1 - MessageSent and MessageRead changed to use only New for both
+ 2.2 - summary table for message threads
+ 2.3 - normalized column in phonenumber tables
+ 2.4 - sort indexes replace the value indexes of dates
 """
 
 import sys, os
@@ -45,7 +48,10 @@ from framework.config import config, rootdir
 DB_VERSIONS = (
     "1.0",
     "2.0",
-    "2.1"
+    "2.1",
+    "2.2",
+    "2.3",
+    "2.4"
 )
 
 # values returned by check_version
@@ -88,8 +94,9 @@ def upgrade(version, cur, con):
 
     base_path = os.path.dirname(__file__)
 
-    # begin to run upgrade script from the current version to the latest one
-    version_index = DB_VERSIONS.index(version) if version != None else 0
+    # begin to run upgrade script from the current version to the latest one,
+    # upgrade-X.sql upgrades to version X so skip the current version's script
+    version_index = DB_VERSIONS.index(version) + 1 if version != None else 0
     for i in range(version_index, len(DB_VERSIONS)):
         try:
             sql = open(os.path.join(base_path, 'db', 'upgrade-%s.sql' % (DB_VERSIONS[i])), 'r')
@@ -101,3 +108,13 @@ def upgrade(version, cur, con):
         con.commit()
 
     return True
+
+def check_rebuild(cur, name):
+    """Checks if an upgrade script flagged a derived table for rebuilding.
+    Derived tables are (re)filled by the domain owning them, once it's loaded."""
+    cur.execute("SELECT value FROM info WHERE field_name = ?", ('rebuild_' + name, ))
+    return cur.fetchone() != None
+
+def rebuild_done(cur, name):
+    """Clears the rebuild flag set by an upgrade script."""
+    cur.execute("DELETE FROM info WHERE field_name = ?", ('rebuild_' + name, ))
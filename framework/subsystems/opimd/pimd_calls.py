@@ -69,11 +69,6 @@ class CallsDbHandler(DbHandler):
         self.table_types = ['phonenumber', 'date', 'boolean']
         super(CallsDbHandler, self).__init__()
         self.create_db()
-    def get_create_type_index(self, type):
-        if type == "date":
-            return "CREATE INDEX IF NOT EXISTS " + self.db_prefix + "_" + type + \
-                   "_value ON " + self.db_prefix + "_" + type + "(value DESC)"
-        return super(CallsDbHandler, self).get_create_type_index(type)
 #----------------------------------------------------------------------------#
 class QueryManager(DBusFBObject):
 #----------------------------------------------------------------------------#
@@ -121,10 +116,21 @@ class QueryManager(DBusFBObject):
         """Checks whether a newly added entry matches one or more queries so they can signal clients
 
         @param entry_id Call ID of the call that was added"""
+        self.check_entries([entry_id, ])
+
+    def check_entries(self, entry_ids):
+        """Checks added, updated or deleted entries against all queries so they can signal clients
+        the changes of their results
+
+        @param entry_ids Call IDs of the calls that were changed"""
         for (query_id, query_handler) in self._queries.items():
-            if query_handler.check_new_entry(entry_id):
-                entry_path = self.id_to_path(entry_id)
-                self.EntryAdded(entry_path, rel_path='/' + str(query_id))
+            changes = query_handler.check_entries(entry_ids)
+            if changes == None:
+                self.ResultsReset(query_handler.get_result_count(), rel_path='/' + str(query_id))
+                continue
+            for (signal, entry_id, position) in changes:
+                entry_path = self.db_handler.domain.id_to_path(entry_id)
+                getattr(self, signal)(entry_path, position, rel_path='/' + str(query_id))
 
     def check_query_id_ok( self, num_id ):
         """
@@ -133,11 +139,29 @@ class QueryManager(DBusFBObject):
         if not num_id in self._queries:
             raise InvalidQueryID( "Existing query IDs: %s" % self._queries.keys() )
 
-    def EntryAdded(self, path, rel_path=None):
-        self.CallAdded(path, rel_path=rel_path)
+    def EntryAdded(self, path, position, rel_path=None):
+        self.CallAdded(path, position, rel_path=rel_path)
+
+    def EntryRemoved(self, path, position, rel_path=None):
+        self.CallRemoved(path, position, rel_path=rel_path)
 
-    @dbus_signal(_DIN_QUERY, "s", rel_path_keyword="rel_path")
-    def CallAdded(self, path, rel_path=None):
+    def EntryChanged(self, path, position, rel_path=None):
+        self.CallChanged(path, position, rel_path=rel_path)
+
+    @dbus_signal(_DIN_QUERY, "si", rel_path_keyword="rel_path")
+    def CallAdded(self, path, position, rel_path=None):
+        pass
+
+    @dbus_signal(_DIN_QUERY, "si", rel_path_keyword="rel_path")
+    def CallRemoved(self, path, position, rel_path=None):
+        pass
+
+    @dbus_signal(_DIN_QUERY, "si", rel_path_keyword="rel_path")
+    def CallChanged(self, path, position, rel_path=None):
+        pass
+
+    @dbus_signal(_DIN_QUERY, "i", rel_path_keyword="rel_path")
+    def ResultsReset(self, count, rel_path=None):
         pass
 
     @dbus_method(_DIN_QUERY, "", "i", rel_path_keyword="rel_path")
@@ -188,6 +212,14 @@ class QueryManager(DBusFBObject):
         return self._queries[num_id].get_multiple_results(sender, num_entries)
 
 
+    @dbus_method(_DIN_QUERY, "", "s", rel_path_keyword="rel_path")
+    def GetContinuationToken(self, rel_path):
+        num_id = int(rel_path[1:])
+        self.check_query_id_ok( num_id )
+
+        return self._queries[num_id].get_continuation_token()
+
+
     @dbus_method(_DIN_QUERY, "", "", rel_path_keyword="rel_path")
     def Dispose(self, rel_path):
         num_id = int(rel_path[1:])
@@ -355,6 +387,62 @@ class CallDomain(Domain, GenericDomain):
                     self.MissedCall(_DBUS_PATH_CALLS+ '/' + str(num_id))
         self.update(num_id, data)
 
+    def NewEntries(self, paths):
+        self.NewCalls(paths)
+
+    @dbus_signal(_DIN_CALLS, "as")
+    def NewCalls(self, paths):
+        pass
+
+    @dbus_method(_DIN_CALLS, "aa{sv}", "as")
+    def AddMultiple(self, entries_data):
+        """Adds a list of calls in a single transaction
+
+        @param entries_data List of calls, each in the format of Add
+        @return Paths of the newly created d-bus call objects"""
+        result = self.add_multiple(entries_data)
+        self.count_new_missed_calls()
+        return result
+
+    def EntriesUpdated(self, data):
+        self.UpdatedCalls(data)
+
+    @dbus_signal(_DIN_CALLS, "a{sa{sv}}")
+    def UpdatedCalls(self, data):
+        pass
+
+    @dbus_method(_DIN_CALLS, "a{sa{sv}}", "")
+    def UpdateMultiple(self, entries_data):
+        """Updates a list of calls in a single transaction
+
+        @param entries_data Dict of call path to the fields to update"""
+        self.update_multiple(entries_data)
+        self.count_new_missed_calls()
+
+    def EntriesDeleted(self, paths):
+        self.DeletedCalls(paths)
+
+    @dbus_signal(_DIN_CALLS, "as")
+    def DeletedCalls(self, paths):
+        pass
+
+    @dbus_method(_DIN_CALLS, "as", "")
+    def DeleteMultiple(self, paths):
+        """Deletes a list of calls in a single transaction
+
+        @param paths Paths of the calls to delete"""
+        self.delete_multiple(paths)
+        self.count_new_missed_calls()
+
+    @dbus_method(_DIN_CALLS, "", "a{sv}")
+    def GetCacheStatistics(self):
+        """Returns the statistics of the entry cache and of the query shape
+        cache of this domain
+
+        @return Dict with size, capacity, hits and misses of the entry cache
+        and the same keys prefixed with shape_ for the query shape cache"""
+        return self.get_cache_statistics()
+
     @dbus_method(_DIN_FIELDS, "ss", "")
     def AddField(self, name, type):
         self.add_new_field(name, type)
@@ -383,6 +471,13 @@ class CallDomain(Domain, GenericDomain):
     def NewMissedCalls(self, amount):
         pass
 
+    def count_new_missed_calls(self):
+        """Recounts new missed calls after bulk changes, signalling if the amount changed"""
+        missed = len(self.db_handler.query_ids({'Answered':0, 'Direction': 'in', 'New': 1})[0])
+        if missed != self._new_missed_calls:
+            self._new_missed_calls = missed
+            self.NewMissedCalls(self._new_missed_calls)
+
     @dbus_method(_DIN_CALLS, "", "i")
     def GetNewMissedCalls(self):
         return self._new_missed_calls
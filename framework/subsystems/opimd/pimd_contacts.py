@@ -121,10 +121,21 @@ class QueryManager(DBusFBObject):
         """Checks whether a newly added entry matches one or more queries so they can signal clients
 
         @param entry_id Contact ID of the contact that was added"""
+        self.check_entries([entry_id, ])
+
+    def check_entries(self, entry_ids):
+        """Checks added, updated or deleted entries against all queries so they can signal clients
+        the changes of their results
+
+        @param entry_ids Contact IDs of the contacts that were changed"""
         for (query_id, query_handler) in self._queries.items():
-            if query_handler.check_new_entry(entry_id):
-                entry_path = self.id_to_path(entry_id)
-                self.EntryAdded(entry_path, rel_path='/' + str(query_id))
+            changes = query_handler.check_entries(entry_ids)
+            if changes == None:
+                self.ResultsReset(query_handler.get_result_count(), rel_path='/' + str(query_id))
+                continue
+            for (signal, entry_id, position) in changes:
+                entry_path = self.db_handler.domain.id_to_path(entry_id)
+                getattr(self, signal)(entry_path, position, rel_path='/' + str(query_id))
 
     def check_query_id_ok( self, num_id ):
         """
@@ -133,11 +144,29 @@ class QueryManager(DBusFBObject):
         if not num_id in self._queries:
             raise InvalidQueryID( "Existing query IDs: %s" % self._queries.keys() )
 
-    def EntryAdded(self, path, rel_path=None):
-        self.ContactAdded(path, rel_path=rel_path)
+    def EntryAdded(self, path, position, rel_path=None):
+        self.ContactAdded(path, position, rel_path=rel_path)
+
+    def EntryRemoved(self, path, position, rel_path=None):
+        self.ContactRemoved(path, position, rel_path=rel_path)
+
+    def EntryChanged(self, path, position, rel_path=None):
+        self.ContactChanged(path, position, rel_path=rel_path)
+
+    @dbus_signal(_DIN_QUERY, "si", rel_path_keyword="rel_path")
+    def ContactAdded(self, path, position, rel_path=None):
+        pass
+
+    @dbus_signal(_DIN_QUERY, "si", rel_path_keyword="rel_path")
+    def ContactRemoved(self, path, position, rel_path=None):
+        pass
+
+    @dbus_signal(_DIN_QUERY, "si", rel_path_keyword="rel_path")
+    def ContactChanged(self, path, position, rel_path=None):
+        pass
 
-    @dbus_signal(_DIN_QUERY, "s", rel_path_keyword="rel_path")
-    def ContactAdded(self, path, rel_path=None):
+    @dbus_signal(_DIN_QUERY, "i", rel_path_keyword="rel_path")
+    def ResultsReset(self, count, rel_path=None):
         pass
 
     @dbus_method(_DIN_QUERY, "", "i", rel_path_keyword="rel_path")
@@ -188,6 +217,14 @@ class QueryManager(DBusFBObject):
         return self._queries[num_id].get_multiple_results(sender, num_entries)
 
 
+    @dbus_method(_DIN_QUERY, "", "s", rel_path_keyword="rel_path")
+    def GetContinuationToken(self, rel_path):
+        num_id = int(rel_path[1:])
+        self.check_query_id_ok( num_id )
+
+        return self._queries[num_id].get_continuation_token()
+
+
     @dbus_method(_DIN_QUERY, "", "", rel_path_keyword="rel_path")
     def Dispose(self, rel_path):
         num_id = int(rel_path[1:])
@@ -335,6 +372,58 @@ class ContactDomain(Domain, GenericDomain):
 
         self.update(num_id, data)
 
+    def NewEntries(self, paths):
+        self.NewContacts(paths)
+
+    @dbus_signal(_DIN_CONTACTS, "as")
+    def NewContacts(self, paths):
+        pass
+
+    @dbus_method(_DIN_CONTACTS, "aa{sv}", "as")
+    def AddMultiple(self, entries_data):
+        """Adds a list of contacts in a single transaction
+
+        @param entries_data List of contacts, each in the format of Add
+        @return Paths of the newly created d-bus contact objects"""
+        return self.add_multiple(entries_data)
+
+    def EntriesUpdated(self, data):
+        self.UpdatedContacts(data)
+
+    @dbus_signal(_DIN_CONTACTS, "a{sa{sv}}")
+    def UpdatedContacts(self, data):
+        pass
+
+    @dbus_method(_DIN_CONTACTS, "a{sa{sv}}", "")
+    def UpdateMultiple(self, entries_data):
+        """Updates a list of contacts in a single transaction
+
+        @param entries_data Dict of contact path to the fields to update"""
+        self.update_multiple(entries_data)
+
+    def EntriesDeleted(self, paths):
+        self.DeletedContacts(paths)
+
+    @dbus_signal(_DIN_CONTACTS, "as")
+    def DeletedContacts(self, paths):
+        pass
+
+    @dbus_method(_DIN_CONTACTS, "as", "")
+    def DeleteMultiple(self, paths):
+        """Deletes a list of contacts in a single transaction
+
+        @param paths Paths of the contacts to delete"""
+        self.delete_multiple(paths)
+
+    @dbus_method(_DIN_CONTACTS, "", "a{sv}")
+    def GetCacheStatistics(self):
+        """Returns the statistics of the entry cache and of the query shape
+        cache of this domain
+
+        @return Dict with size, capacity, hits and misses of the entry cache
+        and the same keys prefixed with shape_ for the query shape cache"""
+        return self.get_cache_statistics()
+
     @dbus_method(_DIN_FIELDS, "ss", "")
     def AddField(self, name, type):
         self.add_new_field(name, type)
@@ -103,17 +103,6 @@ class QueryManager(DBusFBObject):
         return DBUS_PATH_BASE_FSO + '/' + self.domain_name + '/Queries/' + str(query_id)
 
 
-    def check_new_entry(self, entry_id):
-        """Checks whether a newly added entry matches one or more queries so they can signal clients
-
-        @param entry_id entry ID of the entry that was added"""
-#FIXME: TBD
-        for (query_id, query_handler) in self._queries.items():
-            if query_handler.check_new_entry(entry_id):
-                entry = self._entries[entry_id]
-                entry_path = entry['Path']
-                self.EntryAdded(entry_path, rel_path='/' + str(query_id))
-
     def check_query_id_ok( self, num_id ):
         """
         Checks whether a query ID is existing. Raises InvalidQueryID, if not.
@@ -292,6 +281,15 @@ class GenericDomain():
         self.NewEntry(result)
         return result
 
+    def add_multiple(self, entries_data):
+        eids = self.db_handler.add_entries(entries_data)
+
+        # As we just added new entries, we check them against all queries to see if they match
+        self.query_manager.check_entries(eids)
+        result = map(self.id_to_path, eids)
+        self.NewEntries(result)
+        return result
+
     def update(self, num_id, data):
         # Make sure the requested entry exists
 
@@ -299,6 +297,7 @@ class GenericDomain():
             raise InvalidEntryID()
 
         self.db_handler.upd_entry(num_id, data)
+        self.query_manager.check_entries([num_id, ])
         self.EntryUpdated(data, rel_path='/'+str(num_id))
 
     def delete(self, num_id):
@@ -308,8 +307,29 @@ class GenericDomain():
         if self.db_handler.del_entry(num_id):
             raise InvalidEntryID()
 
+        self.query_manager.check_entries([num_id, ])
         self.EntryDeleted(rel_path='/'+str(num_id))
 
+    def update_multiple(self, entries_data):
+        updates = []
+        for (path, data) in entries_data.iteritems():
+            updates.append((self.path_to_id(path), data))
+
+        missing = self.db_handler.upd_entries(updates)
+        if missing:
+            raise InvalidEntryID( "Entries %s do not exist, nothing updated" % (map(self.id_to_path, missing), ))
+
+        self.query_manager.check_entries(map(lambda x: x[0], updates))
+        self.EntriesUpdated(entries_data)
+
+    def delete_multiple(self, paths):
+        missing = self.db_handler.del_entries(map(self.path_to_id, paths))
+        if missing:
+            raise InvalidEntryID( "Entries %s do not exist, nothing deleted" % (map(self.id_to_path, missing), ))
+
+        self.query_manager.check_entries(map(self.path_to_id, paths))
+        self.EntriesDeleted(paths)
+
     def get_multiple_fields(self, num_id, field_list):
         # Make sure the requested entry exists
         self.check_entry_id(num_id)
@@ -347,6 +367,11 @@ class GenericDomain():
             return res[0]
         else:
             return {}
+    def get_cache_statistics(self):
+        stats = self.db_handler.cache.get_statistics()
+        for key, value in self.db_handler.query_shapes.get_statistics().iteritems():
+            stats['shape_' + key] = value
+        return stats
     def get_full_content(self, rel_path):
         num_id = int(rel_path[1:])
 
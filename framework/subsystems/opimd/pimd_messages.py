@@ -42,7 +42,8 @@ from framework.config import config, busmap
 
 from pimd_generic import GenericDomain
 
-from db_handler import DbHandler
+from db_handler import DbHandler, _RETRIEVE_CHUNK_SIZE
+import db_upgrade
 
 
 #----------------------------------------------------------------------------#
@@ -76,11 +77,103 @@ class MessagesDbHandler(DbHandler):
         self.table_types = ['phonenumber', 'text', 'date', 'boolean']
         super(MessagesDbHandler, self).__init__()
         self.create_db()
-    def get_create_type_index(self, type):
-        if type == "date":
-            return "CREATE INDEX IF NOT EXISTS " + self.db_prefix + "_" + type + \
-                   "_value ON " + self.db_prefix + "_" + type + "(value DESC)"
-        return super(MessagesDbHandler, self).get_create_type_index(type)
+        self.create_threads_table()
+
+    def create_threads_table(self):
+        """Creates the summary of message threads: last message, total and
+        unread count for every (normalized) peer"""
+        cur = self.con.cursor()
+        cur.executescript("""
+                CREATE TABLE IF NOT EXISTS """ + self.db_prefix + """_threads (
+                    peer TEXT PRIMARY KEY,
+                    last_id INTEGER,
+                    last_timestamp INTEGER,
+                    total_count INTEGER NOT NULL,
+                    unread_count INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS """ + self.db_prefix + """_threads_last_timestamp
+                    ON """ + self.db_prefix + """_threads(last_timestamp DESC);
+                """)
+        if db_upgrade.check_rebuild(cur, self.db_prefix + '_threads'):
+            logger.info("Rebuilding summary of message threads")
+            cur.execute("BEGIN")
+            try:
+                cur.execute("DELETE FROM " + self.db_prefix + "_threads")
+                cur.execute("SELECT DISTINCT normalized FROM " + self.db_prefix + "_phonenumber WHERE field_name = 'Peer'")
+                self.update_threads(cur, map(lambda x: x[0], cur.fetchall()))
+                cur.execute("COMMIT")
+            except:
+                cur.execute("ROLLBACK")
+                raise
+            db_upgrade.rebuild_done(cur, self.db_prefix + '_threads')
+        self.con.commit()
+        cur.close()
+
+    def get_peers(self, cur, eids):
+        """Returns the normalized peers of a list of messages"""
+        peers = []
+        for start in xrange(0, len(eids), _RETRIEVE_CHUNK_SIZE):
+            chunk = eids[start:start + _RETRIEVE_CHUNK_SIZE]
+            cur.execute("SELECT normalized FROM " + self.db_prefix + "_phonenumber WHERE " + \
+                        self.db_prefix + "_id IN (" + ",".join("?" * len(chunk)) + ") AND field_name = 'Peer'", chunk)
+            peers.extend(map(lambda x: x[0], cur.fetchall()))
+        return peers
+
+    def update_threads(self, cur, peers):
+        """Recalculates the thread summary of the given normalized peers, only
+        looking at the messages of those peers. Must be called inside the
+        transaction changing the messages, so the summary can't get out of sync."""
+        db_prefix = self.db_prefix
+        for peer in set(peers):
+            cur.execute("SELECT COUNT(*) FROM " + db_prefix + "_phonenumber " \
+                        "WHERE field_name = 'Peer' AND normalized = ?", (peer, ))
+            total_count = cur.fetchone()[0]
+            if total_count == 0:
+                cur.execute("DELETE FROM " + db_prefix + "_threads WHERE peer = ?", (peer, ))
+                continue
+
+            cur.execute("""
+                SELECT COUNT(*) FROM
+                    (
+                    """ + db_prefix + """_boolean b
+                    JOIN
+                    """ + db_prefix + """_phonenumber p
+                    ON b.""" + db_prefix + """_id = p.""" + db_prefix + """_id AND
+                    b.field_name = 'New'
+                    )
+                    JOIN
+                    """ + db_prefix + """_text x
+                    ON b.""" + db_prefix + """_id = x.""" + db_prefix + """_id
+                    AND x.field_name = 'Direction'
+                    WHERE
+                    b.value = '1' AND
+                    x.value = 'in' AND
+                    p.field_name = 'Peer' AND p.normalized = ?
+                """, (peer, ))
+            unread_count = cur.fetchone()[0]
+
+            cur.execute("""
+                SELECT p.""" + db_prefix + """_id, t.value FROM
+                    """ + db_prefix + """_phonenumber p
+                    JOIN
+                    """ + db_prefix + """_date t
+                    ON p.""" + db_prefix + """_id = t.""" + db_prefix + """_id AND
+                    t.field_name = 'Timestamp'
+                    WHERE p.field_name = 'Peer' AND p.normalized = ?
+                    ORDER BY t.value DESC, p.""" + db_prefix + """_id DESC LIMIT 1
+                """, (peer, ))
+            last = cur.fetchone() or (None, None)
+
+            cur.execute("REPLACE INTO " + db_prefix + "_threads " \
+                        "(peer, last_id, last_timestamp, total_count, unread_count) VALUES (?,?,?,?,?)",
+                        (peer, last[0], last[1], total_count, unread_count))
+
+    def entries_changing(self, cur, eids):
+        return self.get_peers(cur, eids)
+
+    def entries_changed(self, cur, eids, old_peers):
+        self.update_threads(cur, (old_peers or []) + self.get_peers(cur, eids))
+
 #----------------------------------------------------------------------------#
 class QueryManager(DBusFBObject):
 #----------------------------------------------------------------------------#
@@ -131,52 +224,12 @@ class QueryManager(DBusFBObject):
 
         db_prefix = self.db_handler.db_prefix
         query['sql'] = """
-SELECT m.""" + db_prefix + """_id """ + db_prefix + """_id,
-    (
-        SELECT COUNT(*) FROM """ + db_prefix + """_phonenumber
-        WHERE field_name = 'Peer'
-        AND value = p1.value
-    ) TotalCount,
-    (
-        SELECT COUNT(*) FROM
-            (
-            """ + db_prefix + """_boolean b
-            JOIN
-            """ + db_prefix + """_phonenumber p
-            ON b.""" + db_prefix + """_id = p.""" + db_prefix + """_id AND
-            b.field_name = 'New'
-            )
-            JOIN
-            """ + db_prefix + """_text x
-            ON b.""" + db_prefix + """_id = x.""" + db_prefix + """_id
-            AND x.field_name = 'Direction'
-            WHERE
-            b.value = '1' AND
-            x.value = 'in' AND
-            p.field_name = 'Peer' AND p.value = p1.value
-    ) UnreadCount
-    FROM (
-        """ + db_prefix + """ m
-        JOIN
-        """ + db_prefix + """_date t
-        USING (""" + db_prefix + """_id)
-    ) JOIN """ + db_prefix + """_phonenumber p1
-        USING (""" + db_prefix + """_id)
-
-    WHERE t.field_name = 'Timestamp' AND
-    t.value IN (
-        SELECT MAX(timestamp) timestamp FROM (
-        (
-        SELECT date_t.""" + db_prefix + """_id AS """ + db_prefix + """_id, date_t.value AS timestamp FROM
-            """ + db_prefix + """_date AS date_t
-        WHERE date_t.field_name = 'Timestamp'
-        ) res_t
-        JOIN """ + db_prefix + """_phonenumber num_t ON
-            res_t.""" + db_prefix + """_id = num_t.""" + db_prefix + """_id AND num_t.field_name = 'Peer'
-        )
-        GROUP BY num_t.value
-    )
-    ORDER BY t.value DESC
+SELECT last_id """ + db_prefix + """_id,
+    total_count TotalCount,
+    unread_count UnreadCount
+    FROM """ + db_prefix + """_threads
+    WHERE last_id IS NOT NULL
+    ORDER BY last_timestamp DESC
         """
 
         query_handler = SingleRawSQLQueryHandler(query, self.db_handler, dbus_sender)
@@ -193,10 +246,21 @@ SELECT m.""" + db_prefix + """_id """ + db_prefix + """_id,
         """Checks whether a newly added entry matches one or more queries so they can signal clients
 
         @param entry_id Message ID of the message that was added"""
+        self.check_entries([entry_id, ])
+
+    def check_entries(self, entry_ids):
+        """Checks added, updated or deleted entries against all queries so they can signal clients
+        the changes of their results
+
+        @param entry_ids Message IDs of the messages that were changed"""
         for (query_id, query_handler) in self._queries.items():
-            if query_handler.check_new_entry(entry_id):
-                entry_path = self.id_to_path(entry_id)
-                self.EntryAdded(entry_path, rel_path='/' + str(query_id))
+            changes = query_handler.check_entries(entry_ids)
+            if changes == None:
+                self.ResultsReset(query_handler.get_result_count(), rel_path='/' + str(query_id))
+                continue
+            for (signal, entry_id, position) in changes:
+                entry_path = self.db_handler.domain.id_to_path(entry_id)
+                getattr(self, signal)(entry_path, position, rel_path='/' + str(query_id))
 
     def check_query_id_ok( self, num_id ):
         """
@@ -205,11 +269,29 @@ SELECT m.""" + db_prefix + """_id """ + db_prefix + """_id,
         if not num_id in self._queries:
             raise InvalidQueryID( "Existing query IDs: %s" % self._queries.keys() )
 
-    def EntryAdded(self, path, rel_path=None):
-        self.MessageAdded(path, rel_path=rel_path)
+    def EntryAdded(self, path, position, rel_path=None):
+        self.MessageAdded(path, position, rel_path=rel_path)
+
+    def EntryRemoved(self, path, position, rel_path=None):
+        self.MessageRemoved(path, position, rel_path=rel_path)
+
+    def EntryChanged(self, path, position, rel_path=None):
+        self.MessageChanged(path, position, rel_path=rel_path)
+
+    @dbus_signal(_DIN_QUERY, "si", rel_path_keyword="rel_path")
+    def MessageAdded(self, path, position, rel_path=None):
+        pass
 
-    @dbus_signal(_DIN_QUERY, "s", rel_path_keyword="rel_path")
-    def MessageAdded(self, path, rel_path=None):
+    @dbus_signal(_DIN_QUERY, "si", rel_path_keyword="rel_path")
+    def MessageRemoved(self, path, position, rel_path=None):
+        pass
+
+    @dbus_signal(_DIN_QUERY, "si", rel_path_keyword="rel_path")
+    def MessageChanged(self, path, position, rel_path=None):
+        pass
+
+    @dbus_signal(_DIN_QUERY, "i", rel_path_keyword="rel_path")
+    def ResultsReset(self, count, rel_path=None):
         pass
 
     @dbus_method(_DIN_QUERY, "", "i", rel_path_keyword="rel_path")
@@ -260,6 +342,14 @@ SELECT m.""" + db_prefix + """_id """ + db_prefix + """_id,
         return self._queries[num_id].get_multiple_results(sender, num_entries)
 
 
+    @dbus_method(_DIN_QUERY, "", "s", rel_path_keyword="rel_path")
+    def GetContinuationToken(self, rel_path):
+        num_id = int(rel_path[1:])
+        self.check_query_id_ok( num_id )
+
+        return self._queries[num_id].get_continuation_token()
+
+
     @dbus_method(_DIN_QUERY, "", "", rel_path_keyword="rel_path")
     def Dispose(self, rel_path):
         num_id = int(rel_path[1:])
@@ -388,6 +478,13 @@ class MessageDomain(Domain, GenericDomain):
         return self.query_manager.process_query_threads(query, sender)
 
 
+    def count_unread_messages(self):
+        """Recounts unread messages after bulk changes, signalling if the amount changed"""
+        unread = len(self.db_handler.query_ids({'Direction': 'in', 'New':1})[0])
+        if unread != self._unread_messages:
+            self._unread_messages = unread
+            self.UnreadMessages(self._unread_messages)
+
     @dbus_method(_DIN_MESSAGES, "", "i")
     def GetUnreadMessages(self):
         return self._unread_messages
@@ -478,6 +575,62 @@ class MessageDomain(Domain, GenericDomain):
             self.UnreadMessages(self._unread_messages)
         self.update(num_id, data)
 
+    def NewEntries(self, paths):
+        self.NewMessages(paths)
+
+    @dbus_signal(_DIN_MESSAGES, "as")
+    def NewMessages(self, paths):
+        pass
+
+    @dbus_method(_DIN_MESSAGES, "aa{sv}", "as")
+    def AddMultiple(self, entries_data):
+        """Adds a list of messages in a single transaction
+
+        @param entries_data List of messages, each in the format of Add
+        @return Paths of the newly created d-bus message objects"""
+        result = self.add_multiple(entries_data)
+        self.count_unread_messages()
+        return result
+
+    def EntriesUpdated(self, data):
+        self.UpdatedMessages(data)
+
+    @dbus_signal(_DIN_MESSAGES, "a{sa{sv}}")
+    def UpdatedMessages(self, data):
+        pass
+
+    @dbus_method(_DIN_MESSAGES, "a{sa{sv}}", "")
+    def UpdateMultiple(self, entries_data):
+        """Updates a list of messages in a single transaction
+
+        @param entries_data Dict of message path to the fields to update"""
+        self.update_multiple(entries_data)
+        self.count_unread_messages()
+
+    def EntriesDeleted(self, paths):
+        self.DeletedMessages(paths)
+
+    @dbus_signal(_DIN_MESSAGES, "as")
+    def DeletedMessages(self, paths):
+        pass
+
+    @dbus_method(_DIN_MESSAGES, "as", "")
+    def DeleteMultiple(self, paths):
+        """Deletes a list of messages in a single transaction
+
+        @param paths Paths of the messages to delete"""
+        self.delete_multiple(paths)
+        self.count_unread_messages()
+
+    @dbus_method(_DIN_MESSAGES, "", "a{sv}")
+    def GetCacheStatistics(self):
+        """Returns the statistics of the entry cache and of the query shape
+        cache of this domain
+
+        @return Dict with size, capacity, hits and misses of the entry cache
+        and the same keys prefixed with shape_ for the query shape cache"""
+        return self.get_cache_statistics()
+
     @dbus_method(_DIN_FIELDS, "ss", "")
     def AddField(self, name, type):
         self.add_new_field(name, type)
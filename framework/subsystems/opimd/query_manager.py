@@ -33,12 +33,102 @@ MODULE_NAME = "opimd"
 from dbus.service import FallbackObject as DBusFBObject
 from helpers import *
 from operator import itemgetter
+from collections import OrderedDict
 
 import db_handler
 
+from framework.config import config
+
 import logging
 logger = logging.getLogger( MODULE_NAME )
 
+# Lazy result sets: number of entries hydrated at once and number of hydrated
+# pages kept around per query
+_LAZY_QUERIES = config.getBool( MODULE_NAME, "lazy_queries", True )
+_PAGE_SIZE = config.getInt( MODULE_NAME, "query_page_size", 32 )
+_CACHED_PAGES = config.getInt( MODULE_NAME, "query_cached_pages", 4 )
+
+# Changes of more entries than this are signalled to a query as a single
+# reset of its results, instead of one signal per entry
+_SIGNAL_BATCH_SIZE = config.getInt( MODULE_NAME, "query_signal_batch_size", 16 )
+
+#----------------------------------------------------------------------------#
+class LazyResultSet(object):
+#----------------------------------------------------------------------------#
+    """Keeps only the ordered ids of a query result and fetches the content of
+    the entries page by page, when they are first requested.
+
+    Note that entries are read at the time they are requested, not at the
+    time the query was run."""
+
+    def __init__(self, db_handler, ids, other_fields, join_parameters, page_size = _PAGE_SIZE, cached_pages = _CACHED_PAGES):
+        self.db_handler = db_handler
+        self.ids = ids
+        self.other_fields = other_fields
+        self.join_parameters = join_parameters
+        self.page_size = max(1, page_size)
+        self.cached_pages = max(1, cached_pages)
+        self._pages = OrderedDict()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.ids)
+        if index < 0 or index >= len(self.ids):
+            raise IndexError("result index out of range")
+
+        (page, offset) = divmod(index, self.page_size)
+        return self.get_page(page)[offset]
+
+    def get_page(self, page):
+        """Returns the hydrated entries of a page, fetching them if needed"""
+        try:
+            entries = self._pages.pop(page)
+        except KeyError:
+            start = page * self.page_size
+            end = start + self.page_size
+            entries = self.db_handler.get_content(self.ids[start:end], self.join_parameters, self.other_fields[start:end])
+            if len(self._pages) >= self.cached_pages:
+                # drop the least recently used page
+                self._pages.popitem(last=False)
+        self._pages[page] = entries
+        return entries
+
+    def insert(self, index, eid):
+        """Inserts an entry into the result set, before index"""
+        self.ids.insert(index, eid)
+        # the id column, as a search query would have returned it
+        self.other_fields.insert(index, {self.db_handler.db_prefix + '_id':eid})
+        self._pages.clear()
+
+    def remove(self, index):
+        """Removes the entry at index from the result set"""
+        del self.ids[index]
+        del self.other_fields[index]
+        self._pages.clear()
+
+def _insert_position(keys, key, descending):
+    """Returns the index to insert key at into the sorted list keys, after
+    any equal keys"""
+    lo = 0
+    hi = len(keys)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if (descending and keys[mid] < key) or (not descending and keys[mid] > key):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def _shift_positions(positions, position, count):
+    """Moves the positions at or after position by count, after count
+    entries were inserted at (or, if negative, removed from) position"""
+    for (eid, current) in positions.items():
+        if current >= position:
+            positions[eid] = current + count
+
 class BaseQueryMatcher(object):
     query_obj = None
 
@@ -59,6 +149,27 @@ class BaseQueryMatcher(object):
 
         matches = []
 
+    def match_lazy(self, db_handler):
+        """Tries to match a db_handler to the current query, without fetching the entries
+
+        @param a db_handler
+        @return LazyResultSet of entries that match"""
+
+        BaseQueryMatcher.match(self, db_handler)
+        (ids, other_fields, join_parameters) = self.match_ids(db_handler)
+        return LazyResultSet(db_handler, ids, other_fields, join_parameters)
+
+    def match_ids_among(self, db_handler, ids):
+        """Checks which of the given entries match the current query, without
+        looking at other entries
+
+        @param a db_handler
+        @param ids List of entry IDs to check
+        @return Set of the matching entry IDs, None if the query can't be
+                checked for single entries"""
+
+        return None
+
 #----------------------------------------------------------------------------#
 class QueryMatcher(BaseQueryMatcher):
 #----------------------------------------------------------------------------#
@@ -71,6 +182,15 @@ class QueryMatcher(BaseQueryMatcher):
         BaseQueryMatcher.match(self, db_handler)
         return db_handler.query(self.query_obj)
 
+    def match_ids(self, db_handler):
+        return db_handler.query_ids(self.query_obj)
+
+    def match_ids_among(self, db_handler, ids):
+        # Whether an entry is in a limited result depends on all the others
+        if '_limit' in self.query_obj or '_limit_start' in self.query_obj:
+            return None
+        return db_handler.match_ids(self.query_obj, ids)
+
 #----------------------------------------------------------------------------#
 class RawSQLQueryMatcher(BaseQueryMatcher):
 #----------------------------------------------------------------------------#
@@ -89,13 +209,18 @@ class RawSQLQueryMatcher(BaseQueryMatcher):
         BaseQueryMatcher.match(self, db_handler)
         return db_handler.raw_sql(self.query_obj)
 
+    def match_ids(self, db_handler):
+        return db_handler.raw_sql_ids(self.query_obj)
+
 #----------------------------------------------------------------------------#
 class BaseQueryHandler(object):
     """A base query handler to extend from."""
 #----------------------------------------------------------------------------#
     db_handler = None
     query = None      # The query this handler is processing
+    matcher = None
     _entries = None
+    _sort_keys = None # The sort keys of _entries, for sorted queries, once needed
     cursors = None    # The next entry we'll serve, depending on the client calling us
 
     def __init__(self, query, db_handler, matcher, dbus_sender):
@@ -110,16 +235,31 @@ class BaseQueryHandler(object):
         self.sanitize_query()
 
         self.db_handler = db_handler
-        self._entries = matcher.match(self.db_handler)
+        self.matcher = matcher
+        self.run_query()
         self.cursors = {}
 
-        # TODO Register with all entries to receive updates
-
 
     def dispose(self):
-        """Unregisters from all entries to allow this instance to be eaten by GC"""
-        # TODO Unregister from all entries
-        pass
+        """Drops the result set to allow this instance to be eaten by GC"""
+        self._entries = None
+        self._sort_keys = None
+
+
+    def run_query(self):
+        """(Re)runs the query, replacing the result set"""
+        if _LAZY_QUERIES:
+            self._entries = self.matcher.match_lazy(self.db_handler)
+        else:
+            self._entries = self.matcher.match(self.db_handler)
+        self._sort_keys = None
+
+
+    def get_entry_ids(self):
+        """Returns the ordered list of the IDs of the entries in the result set"""
+        if _LAZY_QUERIES:
+            return self._entries.ids
+        return map(lambda x: x['EntryId'], self._entries)
 
 
     def sanitize_query(self):
@@ -234,24 +374,196 @@ class BaseQueryHandler(object):
         return result
 
 
-    def check_new_entry(self, entry_id):
-        """Checks whether a newly added entry matches this so it can signal clients
+    def check_entries(self, entry_ids):
+        """Checks added, updated or deleted entries against this query and
+        updates the result set accordingly. Only the given entries are looked
+        at, unless the query can't be checked for single entries (limited and
+        raw SQL queries, or lazy queries disabled), then it is rerun.
+        If more than _SIGNAL_BATCH_SIZE entries changed, the query is rerun
+        and the cursors are rewound instead.
+
+        @param entry_ids IDs of the entries that changed
+        @return List of (signal, entry ID, position) tuples describing the
+                changes of the result set, signal being EntryAdded,
+                EntryRemoved or EntryChanged. Positions are those after the
+                change (before it for EntryRemoved), with earlier changes of
+                the list already applied. None if the results were reset."""
+
+        # drop duplicates, keeping the order
+        entry_ids = list(OrderedDict.fromkeys(entry_ids))
+        if len(entry_ids) > _SIGNAL_BATCH_SIZE:
+            return self.reset_query()
+
+        matching = None
+        if _LAZY_QUERIES:
+            matching = self.matcher.match_ids_among(self.db_handler, entry_ids)
+        if matching == None:
+            return self.rerun_query(entry_ids)
+
+        ids = self._entries.ids
+        changed = set(entry_ids)
+        sortby = self.query.get('_sortby')
+        descending = '_sortdesc' in self.query
+        if sortby:
+            # Sort keys of the entries that didn't change. The changed ones
+            # already have their new values in the database, so their old
+            # keys are unknown; until each of them is moved, it is skipped
+            # when looking for positions.
+            if self._sort_keys == None:
+                # ids break ties, as in the query
+                stable = filter(lambda x: x not in changed, ids)
+                keys = self.db_handler.get_sort_keys(stable, sortby)
+                stable = map(lambda x: (keys.get(x), x), stable)
+            else:
+                stable = filter(lambda x: x[1] not in changed, self._sort_keys)
+            self._sort_keys = None
+            keys = self.db_handler.get_sort_keys(filter(lambda x: x in matching, entry_ids), sortby)
+
+        # current positions of the changed entries in the result set
+        positions = {}
+        for (position, eid) in enumerate(ids):
+            if eid in changed:
+                positions[eid] = position
+
+        changes = []
+        for eid in entry_ids:
+            old_position = positions.pop(eid, None)
+
+            if old_position != None:
+                self._entries.remove(old_position)
+                _shift_positions(positions, old_position, -1)
+
+            if eid in matching:
+                if sortby:
+                    index = _insert_position(stable, (keys.get(eid), eid), descending)
+                    stable.insert(index, (keys.get(eid), eid))
+                    # insert before the entry following it in stable, past
+                    # the changed entries not moved yet
+                    position = index
+                    for pending in sorted(positions.values()):
+                        if pending <= position:
+                            position += 1
+                        else:
+                            break
+                elif old_position != None:
+                    position = old_position
+                else:
+                    position = len(ids)
+                self._entries.insert(position, eid)
+                _shift_positions(positions, position, 1)
+            else:
+                position = None
+
+            if old_position == None and position != None:
+                changes.append(('EntryAdded', eid, position))
+                self.move_cursors(position, 1)
+            elif old_position != None and position == None:
+                changes.append(('EntryRemoved', eid, old_position))
+                self.move_cursors(old_position, -1)
+            elif old_position != None:
+                changes.append(('EntryChanged', eid, position))
+                if position != old_position:
+                    self.move_cursors(old_position, -1)
+                    self.move_cursors(position, 1)
+
+        if sortby:
+            self._sort_keys = stable
+        return changes
+
+
+    def rerun_query(self, entry_ids):
+        """Reruns the query and compares the old and new result set. If more
+        than _SIGNAL_BATCH_SIZE entries differ, the cursors are rewound.
+
+        @param entry_ids IDs of the entries that changed
+        @return List of changes, like check_entries, None if reset"""
+
+        old_ids = self.get_entry_ids()
+        self.run_query()
+        new_ids = self.get_entry_ids()
+
+        old_set = set(old_ids)
+        new_set = set(new_ids)
+        if len(old_set ^ new_set) > _SIGNAL_BATCH_SIZE:
+            return self.reset_cursors()
+
+        changes = []
+        # removals from the end, so positions of earlier removals stay valid
+        for position in reversed(range(len(old_ids))):
+            if old_ids[position] not in new_set:
+                changes.append(('EntryRemoved', old_ids[position], position))
+
+        # then walk the new result set, adding new entries and moving those
+        # whose position changed
+        current = filter(lambda x: x in new_set, old_ids)
+        moved = set()
+        for position in range(len(new_ids)):
+            eid = new_ids[position]
+            if position < len(current) and current[position] == eid:
+                continue
+            if eid in old_set:
+                current.remove(eid)
+                moved.add(eid)
+                changes.append(('EntryChanged', eid, position))
+            else:
+                changes.append(('EntryAdded', eid, position))
+            if len(changes) > _SIGNAL_BATCH_SIZE:
+                return self.reset_cursors()
+            current.insert(position, eid)
+
+        new_positions = dict(map(lambda x: (x[1], x[0]), enumerate(new_ids)))
+        for eid in entry_ids:
+            if eid in old_set and eid in new_set and eid not in moved:
+                changes.append(('EntryChanged', eid, new_positions[eid]))
+        if len(changes) > _SIGNAL_BATCH_SIZE:
+            return self.reset_cursors()
+        return changes
+
+
+    def reset_query(self):
+        """Reruns the query and rewinds all cursors, for changes too big to
+        be signalled entry by entry
+
+        @return None, as check_entries does for reset results"""
+
+        self.run_query()
+        return self.reset_cursors()
+
+
+    def reset_cursors(self):
+        """Rewinds the cursors of all clients, after the result set was reset
+
+        @return None, as check_entries does for reset results"""
+
+        self.cursors = {}
+        return None
+
 
-        @param entry_id entry ID of the entry that was added
-        @return True if entry matches this query, False otherwise
+    def get_continuation_token(self):
+        """Returns a token for the entries following the last one of this
+        (sorted) result set: a query with the same rules and the token as
+        _after seeks directly to them, instead of skipping _limit_start
+        entries.
 
-        @todo Currently this messes up the order of the result set if a specific order was desired"""
-        return False
+        @return Continuation token, empty if the result set is empty"""
 
+        sortby = self.query.get('_sortby')
+        if not sortby:
+            raise InvalidField("Continuation tokens need a query with _sortby")
+        ids = self.get_entry_ids()
+        if not ids:
+            return ""
+        key = self.db_handler.get_sort_keys([ids[-1], ], sortby).get(ids[-1])
+        return db_handler.make_continuation_token(sortby, '_sortdesc' in self.query, key, ids[-1])
 
-        # TODO Register with the new entry to receive changes
 
-        # We *should* reset all cursors *if* the result set is ordered, however
-        # in order to prevent confusion, this is left for the client to do.
-        # Rationale: clients with unordered queries can just use get_result()
-        # and be done with it. For those, theres's no need to re-read all results.
+    def move_cursors(self, position, count):
+        """Keeps the cursors pointing at the same entries after count entries
+        were inserted at (or, if count is negative, removed from) position"""
 
-        # Let clients know that this result set changed
+        for (dbus_sender, cursor) in self.cursors.items():
+            if cursor > position:
+                self.cursors[dbus_sender] = max(position, cursor + count)
 
 #----------------------------------------------------------------------------#
 class SingleQueryHandler(BaseQueryHandler):
@@ -53,8 +53,29 @@ class PimTests(unittest.TestCase):
         query = dbus.Interface(query, 'org.freesmartphone.PIM.ContactQuery')
         count = query.GetResultCount()
         results = query.GetMultipleResults(count)
-        
-        
+
+    def _sorted_names(self, query_path):
+        query = self.bus.get_object('org.freesmartphone.opimd', query_path)
+        query = dbus.Interface(query, 'org.freesmartphone.PIM.ContactQuery')
+        query.Rewind()
+        return [str(res['Name']) for res in query.GetMultipleResults(-1)]
+
+    def test_update_sorted_query(self):
+        """Update several contacts of an open sorted query and check it stays sorted"""
+        self.pim_sources.InitAllEntries()
+        paths = self.pim_contacts.AddMultiple([{'Name':name, 'Note':"sorted-query-test"} for name in "ABCDEFGHIJ"])
+        try:
+            rules = {'Note':"sorted-query-test", '_sortby':'Name'}
+            live_path = self.pim_contacts.Query(rules)
+            # move entries past each other, in both directions
+            self.pim_contacts.UpdateMultiple({paths[8]:{'Name':"C5"}, paths[1]:{'Name':"H5"}, paths[5]:{'Name':"F5"}})
+            fresh = self._sorted_names(self.pim_contacts.Query(rules))
+            self.assertEqual(fresh, ['A', 'C', 'C5', 'D', 'E', 'F5', 'G', 'H', 'H5', 'J'])
+            self.assertEqual(self._sorted_names(live_path), fresh)
+        finally:
+            self.pim_contacts.DeleteMultiple(paths)
+
+
 if __name__ == '__main__':
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(PimTests)
     result = unittest.TextTestRunner(verbosity=3).run(suite)
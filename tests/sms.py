@@ -22,6 +22,8 @@ import test
 import datetime
 import framework.patterns.tasklet as tasklet
 from framework.subsystems.ogsmd.gsm.sms import *
+from framework.subsystems.ogsmd.gsm.convert import hex_decode, hex_encode, \
+    pack_sevenbit, unpack_sevenbit, gsm_default_decode
 
 class SMSTests(unittest.TestCase):
     """Some test cases for the sms subsystem"""
@@ -265,10 +267,77 @@ class SMSTests(unittest.TestCase):
         diff = (diff.seconds*1000 + diff.microseconds/1000.0)/n
         print "%.3fms ... " % diff
 
+class ConvertTests(unittest.TestCase):
+    """Edge cases of the conversion helpers the sms subsystem is built on"""
+
+    def test_hex_decode(self):
+        """Ensure hex_decode returns the bytes of a PDU"""
+
+        self.assert_(list(hex_decode("0791")) == [0x07, 0x91])
+        self.assert_(list(hex_decode("")) == [])
+
+    def test_hex_decode_odd_length(self):
+        """Ensure a PDU of odd length decodes the last digit as a byte of its own"""
+
+        self.assert_(list(hex_decode("ABC")) == [0xAB, 0x0C])
+
+    def test_hex_decode_invalid(self):
+        """Ensure a PDU with non-hex digits raises ValueError"""
+
+        self.assertRaises(ValueError, hex_decode, "0G")
+
+    def test_pack_sevenbit(self):
+        """Pack septets with and without fill bits in front"""
+
+        self.assert_(hex_encode(pack_sevenbit("hello")) == "E8329BFD06")
+        self.assert_(hex_encode(pack_sevenbit("hello", 1)) == "D06536FB0D")
+        self.assert_(len(pack_sevenbit("abcdefg")) == 7)
+        self.assert_(len(pack_sevenbit("abcdefgh")) == 7)
+        self.assert_(pack_sevenbit("", 3) == [0])
+
+    def test_unpack_sevenbit(self):
+        """Unpack septets with and without fill bits to chop"""
+
+        self.assert_(unpack_sevenbit(hex_decode("E8329BFD06")) == "hello")
+        self.assert_(unpack_sevenbit(hex_decode("D06536FB0D"), 1) == "hello")
+        # the last septet of 7 full octets is padding
+        self.assert_(unpack_sevenbit(pack_sevenbit("abcdefg")) == "abcdefg\x00")
+        self.assert_(unpack_sevenbit([]) == "")
+        self.assert_(unpack_sevenbit([0x41], 7) == "")
+
+    def test_sevenbit_roundtrip(self):
+        """Ensure unpacking returns the packed text for all fill bit counts"""
+
+        for crop in range(7):
+            for text in ["a", "hello", "abcdefg", "abcdefgh", "x" * 160]:
+                result = unpack_sevenbit(pack_sevenbit(text, crop), crop)
+                self.assert_(result[:len(text)] == text, (text, crop))
+
+    def test_gsm_default_decode_escape(self):
+        """Decode characters of the extension plane, behind the escape byte"""
+
+        self.assert_(gsm_default_decode("\x1b\x14") == (u"^", 2))
+        self.assert_(gsm_default_decode("a\x1b(b") == (u"a{b", 4))
+        # a trailing or repeated escape is dropped
+        self.assert_(gsm_default_decode("a\x1b") == (u"a", 2))
+        self.assert_(gsm_default_decode("\x1b\x1b\x14") == (u"^", 3))
+
+    def test_gsm_default_decode_unknown_escape(self):
+        """Ensure an escaped byte outside the extension plane raises UnicodeError"""
+
+        self.assertRaises(UnicodeError, gsm_default_decode, "\x1b\x80")
+
+    def test_gsm_default_roundtrip(self):
+        """Ensure text with extension characters survives encoding"""
+
+        text = u"a{b^c}[d]|~\\"
+        self.assert_(text.encode("gsm_default").decode("gsm_default") == text)
+
 
 if __name__ == '__main__':
 
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(SMSTests)
+    suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(ConvertTests))
     result = unittest.TextTestRunner(verbosity=3).run(suite)
 
 
@@ -1,7 +1,22 @@
 from sys import stdin, stdout, stderr
 from pyproj import Proj, transform
 from math import sqrt
-from struct import pack
+from struct import pack, unpack, calcsize, error as StructError
+from heapq import merge
+from tempfile import mkdtemp, mkstemp
+from optparse import OptionParser
+import os
+
+# Builds cell.db and la.db for ogsmd.gsm.celldb from CSV logs of cell
+# observations (first line: the ';' separated column names).
+#
+# Input is processed as a stream: per cell and location area only the
+# bounding box of the observations (in ECEF coordinates) is kept. When
+# more than --max-entries boxes are in memory, they are written as a sorted
+# run to a temporary file; all runs are merged when writing the databases.
+# Several input files are read in parallel worker processes.
+#
+# Usage: make_cell_db.py [options] [input.csv ...] (stdin without files)
 
 NETWORKS = {
     '20205': (202, 5),
@@ -40,41 +55,13 @@ NETWORKS = {
 pwgs84 = Proj(proj='lonlat',datum='WGS84')
 pecef = Proj(proj='geocent', datum='WGS84')
 
-class Center(object):
-    def __init__(self):
-        self.points = []
-
-    def addPoint(self, point):
-        self.points.append(point)
-
-    def calc(self):
-        ecefs = []
-        for lat, long, alt in self.points:
-            ecefs.append(transform(pwgs84, pecef, long, lat, alt))
-        x_min = min([ecef[0] for ecef in ecefs])
-        x_max = max([ecef[0] for ecef in ecefs])
-        x_mid = (x_min+x_max)/2
-        x_size = x_max-x_min
-        y_min = min([ecef[1] for ecef in ecefs])
-        y_max = max([ecef[1] for ecef in ecefs])
-        y_mid = (y_min+y_max)/2
-        y_size = y_max-y_min
-        z_min = min([ecef[2] for ecef in ecefs])
-        z_max = max([ecef[2] for ecef in ecefs])
-        z_mid = (z_min+z_max)/2
-        z_size = z_max-z_min
-        size = sqrt(x_size**2 + y_size**2 + z_size**2) 
-        long, lat, alt = transform(pecef, pwgs84, x_mid, y_mid, z_mid)
-        return (lat, long, alt, size, len(ecefs))
+CELL_KEY = 'HHHH'
+LA_KEY = 'HHH'
+# key, x_min, x_max, y_min, y_max, z_min, z_max, number of points
+RUN_FORMAT = '!%sddddddI'
 
-cells = {}
-las = {}
-
-keys = stdin.readline().strip().split(";")
-
-for line in stdin.readlines():
-    if not line:
-        continue
+def parse(keys, line):
+    """Returns the cell key and ECEF location of an observation or None"""
     data = dict(zip(keys, line.strip().split(";")))
     for key in ['cell_mcc', 'cell_mnc', 'cell_arfcn', 'signal', 'gps_time']:
         data[key] = int(data[key])
@@ -85,51 +72,169 @@ for line in stdin.readlines():
     if not data['cell_mcc']<999 or not data['cell_mnc']<999:
         data['cell_mcc'], data['cell_mnc'] = (0, 0)
     if not data['cell_la']<=0xFFFF or not data['cell_id']<=0xFFFF:
-        continue
+        return None
     if data['cell_mcc']==0 or (data['cell_mcc']==0 and data['cell_mnc']==0):
         if len(data['provider']) == 4: 
-            continue
+            return None
         elif data['provider'] == '99999':
-            continue
+            return None
         elif data['provider'] in NETWORKS:
             data['cell_mcc'], data['cell_mnc'] = NETWORKS[data['provider']]
         else:
             stderr.write(line)
-            continue
+            return None
     if data['cell_mcc']==0 and data['cell_mnc']==0:
-        continue
+        return None
     cell_key = (data['cell_mcc'], data['cell_mnc'], data['cell_la'], data['cell_id'])
-    cell_loc = (data['gps_lat'], data['gps_long'], data['gps_alt'])
-    cell = cells.setdefault(cell_key, Center())
-    cell.addPoint(cell_loc)
-    la_key = cell_key[:-1]
-    la = las.setdefault(la_key, Center())
-    la.addPoint(cell_loc)
+    ecef = transform(pwgs84, pecef, data['gps_long'], data['gps_lat'], data['gps_alt'])
+    return (cell_key, ecef)
 
-cells = cells.items()
-cells.sort()
-las = las.items()
-las.sort()
+def add(table, key, ecef):
+    x, y, z = ecef
+    box = table.get(key)
+    if box is None:
+        table[key] = [x, x, y, y, z, z, 1]
+        return
+    if x < box[0]: box[0] = x
+    elif x > box[1]: box[1] = x
+    if y < box[2]: box[2] = y
+    elif y > box[3]: box[3] = y
+    if z < box[4]: box[4] = z
+    elif z > box[5]: box[5] = z
+    box[6] += 1
 
-cell_db = file('cell.db', 'wb')
-for (cell_key, cell) in cells:
-    cell_loc = cell.calc()
-    print cell_key, cell_loc
-    try:
-        data = pack('!HHHHffff', *(cell_key+cell_loc)[:-1])
-        cell_db.write(data)
-    except:
-        pass
-cell_db.close()
+def combine(box, other):
+    box[0] = min(box[0], other[0])
+    box[1] = max(box[1], other[1])
+    box[2] = min(box[2], other[2])
+    box[3] = max(box[3], other[3])
+    box[4] = min(box[4], other[4])
+    box[5] = max(box[5], other[5])
+    box[6] += other[6]
 
-la_db = file('la.db', 'wb')
-for (la_key, la) in las:
-    la_loc = la.calc()
-    print la_key, la_loc
-    try:
-        data = pack('!HHHffff', *(la_key+la_loc)[:-1])
-        la_db.write(data)
-    except:
-        pass
-la_db.close()
+def write_run(table, key_format, tmpdir):
+    format = RUN_FORMAT % key_format
+    fd, path = mkstemp(suffix='.run', dir=tmpdir)
+    run = os.fdopen(fd, 'wb')
+    for key in sorted(table):
+        run.write(pack(format, *(key + tuple(table[key]))))
+    run.close()
+    table.clear()
+    return path
+
+def read_run(path, key_format):
+    format = RUN_FORMAT % key_format
+    size = calcsize(format)
+    run = file(path, 'rb')
+    data = run.read(size)
+    while data:
+        values = unpack(format, data)
+        yield (values[:len(key_format)], list(values[len(key_format):]))
+        data = run.read(size)
+    run.close()
 
+def merge_runs(paths, key_format):
+    """Merges sorted runs, yielding every key once with its combined box"""
+    current = None
+    for key, box in merge(*[read_run(path, key_format) for path in paths]):
+        if current is not None and current[0] == key:
+            combine(current[1], box)
+        else:
+            if current is not None:
+                yield current
+            current = (key, box)
+    if current is not None:
+        yield current
+
+def ingest(task):
+    """Reads one input file, returns the runs written for cells and LAs"""
+    path, tmpdir, max_entries = task
+    cells = {}
+    las = {}
+    cell_runs = []
+    la_runs = []
+    if path == '-':
+        input = stdin
+    else:
+        input = file(path, 'r')
+    keys = input.readline().strip().split(";")
+    for line in input:
+        if not line.strip():
+            continue
+        result = parse(keys, line)
+        if result is None:
+            continue
+        cell_key, ecef = result
+        add(cells, cell_key, ecef)
+        add(las, cell_key[:-1], ecef)
+        if len(cells) >= max_entries:
+            cell_runs.append(write_run(cells, CELL_KEY, tmpdir))
+        if len(las) >= max_entries:
+            la_runs.append(write_run(las, LA_KEY, tmpdir))
+    if input is not stdin:
+        input.close()
+    if cells:
+        cell_runs.append(write_run(cells, CELL_KEY, tmpdir))
+    if las:
+        la_runs.append(write_run(las, LA_KEY, tmpdir))
+    return (cell_runs, la_runs)
+
+def center(box):
+    x_mid = (box[0]+box[1])/2
+    x_size = box[1]-box[0]
+    y_mid = (box[2]+box[3])/2
+    y_size = box[3]-box[2]
+    z_mid = (box[4]+box[5])/2
+    z_size = box[5]-box[4]
+    size = sqrt(x_size**2 + y_size**2 + z_size**2) 
+    long, lat, alt = transform(pecef, pwgs84, x_mid, y_mid, z_mid)
+    return (lat, long, alt, size)
+
+def write_db(filename, format, runs, key_format, verbose):
+    count = 0
+    db = file(filename, 'wb')
+    for (key, box) in merge_runs(runs, key_format):
+        loc = center(box)
+        if verbose:
+            print key, loc + (box[6],)
+        try:
+            db.write(pack(format, *(key+loc)))
+            count += 1
+        except StructError:
+            pass
+    db.close()
+    return count
+
+if __name__=="__main__":
+    parser = OptionParser(usage="%prog [options] [input.csv ...]")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+        help="number of worker processes reading input files")
+    parser.add_option("-m", "--max-entries", dest="max_entries", type="int", default=500000,
+        help="cells or LAs kept in memory per worker before writing a sorted run")
+    parser.add_option("-d", "--directory", dest="directory", default=".",
+        help="directory to write cell.db and la.db to")
+    parser.add_option("-t", "--tmpdir", dest="tmpdir", default=None,
+        help="directory for temporary runs")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
+        help="print every cell and LA written")
+    (options, inputs) = parser.parse_args()
+
+    tmpdir = mkdtemp(prefix='make_cell_db', dir=options.tmpdir)
+    tasks = [(path, tmpdir, options.max_entries) for path in inputs or ['-']]
+    try:
+        if options.jobs > 1 and len(tasks) > 1:
+            from multiprocessing import Pool
+            pool = Pool(options.jobs)
+            results = pool.map(ingest, tasks)
+            pool.close()
+        else:
+            results = map(ingest, tasks)
+        cell_runs = sum([result[0] for result in results], [])
+        la_runs = sum([result[1] for result in results], [])
+        cells = write_db(os.path.join(options.directory, 'cell.db'), '!HHHHffff', cell_runs, CELL_KEY, options.verbose)
+        las = write_db(os.path.join(options.directory, 'la.db'), '!HHHffff', la_runs, LA_KEY, options.verbose)
+        stderr.write("%d cells and %d LAs from %d runs\n" % (cells, las, len(cell_runs) + len(la_runs)))
+    finally:
+        for path in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, path))
+        os.rmdir(tmpdir)